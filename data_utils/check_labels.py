@@ -0,0 +1,23 @@
+import sys, argparse
+from data_utils import validate_corpus
+
+doc = """ Check that the labels of an NER dataset in column text format
+    (tokens in the first column, labels in the other columns, empty
+    lines between sentences) are consistent with a label encoding, and
+    print the errors found, with their line numbers (starting at 1)."""
+
+parser = argparse.ArgumentParser(description=doc)
+parser.add_argument("-e", "--encoding", choices=["BIO-1", "BIO-2", "BILOU", "IO"], default="BIO-2")
+parser.add_argument("-c", "--column", type=int, default=-1, help="index of label column (default: last)")
+parser.add_argument("-m", "--max-errors", type=int, default=20, help="max nb of errors printed")
+parser.add_argument("input", help="path of input file")
+args = parser.parse_args()
+
+nb_errors, errors = validate_corpus(args.input, encoding=args.encoding, label_col=args.column, max_errors=args.max_errors)
+for (line, msg) in errors:
+    print("Line {}: {}".format(line+1, msg))
+if nb_errors > len(errors):
+    print("... ({} more)".format(nb_errors - len(errors)))
+print("Nb errors: {}".format(nb_errors))
+if nb_errors:
+    sys.exit(1)
@@ -0,0 +1,425 @@
+import os, hashlib, json, tempfile, shutil, locale
+import numpy as np
+
+# Name of the environment variable that specifies the directory in
+# which load_corpus caches parsed files (no caching if it is not set)
+CACHE_DIR_VAR = "NER_EVAL_CACHE_DIR"
+
+
+class Corpus(object):
+    """Columnar representation of an NER dataset in column text format
+    (whitespace-separated columns, tokens in the first column, labels
+    in the other columns, empty lines between sentences).
+
+    The file is parsed once. Tokens and labels are interned, and
+    stored as arrays of integer ids, along with the offsets of the
+    sentences, so that all the scripts that need some of the columns
+    can share the same object instead of re-reading the file.
+
+    Label columns are aligned on the right, as with negative indices
+    (the last column is -1, the one before is -2, etc.), so files in
+    which the number of columns varies from one line to the next can
+    still be loaded. In that case, the number of label columns is the
+    minimum over all lines, positive column indices can not be used,
+    and the columns in between are kept as strings in extra_fields.
+
+    Attributes:
+    - token_vocab: list of unique tokens
+    - token_ids: int32 array of token ids, shape (nb tokens,)
+    - label_vocab: list of unique labels (shared by all label columns)
+    - label_ids: int32 array of label ids, shape (nb tokens, nb label columns)
+    - sent_starts: array containing the offset of the first token of
+      each sentence, followed by the number of tokens
+    - sent_lines: array containing the line number (zero-indexed) of
+      the first token of each sentence
+    - nb_lines: number of lines in the file (including empty lines)
+    - uniform: True if all the non-empty lines have the same number of columns
+    - extra_fields: None if uniform, otherwise list containing, for
+      each token, the list of columns that are neither the token nor
+      one of the label columns
+    - path: path of the file (or None)
+
+    """
+
+    def __init__(self, token_vocab, token_ids, label_vocab, label_ids,
+                 sent_starts, sent_lines, nb_lines, extra_fields=None, path=None):
+        self.token_vocab = token_vocab
+        self.token_ids = token_ids
+        self.label_vocab = label_vocab
+        self.label_ids = label_ids
+        self.sent_starts = sent_starts
+        self.sent_lines = sent_lines
+        self.nb_lines = nb_lines
+        self.extra_fields = extra_fields
+        self.uniform = extra_fields is None
+        self.path = path
+
+    @classmethod
+    def from_file(cls, path, byte_range=None):
+        """Parse a file in column text format, return Corpus.
+
+        If byte_range is provided, it must be a (start, stop) tuple of
+        byte offsets that fall on line boundaries (see get_shards), and
+        we only parse the lines in that range. Line numbers are then
+        relative to the start of the range.
+
+        """
+        if byte_range is None:
+            with open(path) as f:
+                return cls.from_lines(f, path=path)
+        return cls.from_lines(_read_byte_range(path, byte_range), path=path)
+
+    @classmethod
+    def from_lines(cls, lines, path=None):
+        """Parse lines in column text format, return Corpus."""
+        return cls.from_rows(map(str.split, lines), path=path)
+
+    @classmethod
+    def from_rows(cls, rows, path=None):
+        """Given an iterable containing the list of columns of each line
+        (an empty list for an empty line), return Corpus. Unlike
+        from_lines, the columns are used as is, so they can contain
+        whitespace.
+
+        """
+        token_to_id = {}
+        label_to_id = {}
+        token_ids = []
+        label_ids = []
+        widths = []
+        sent_starts = []
+        sent_lines = []
+        in_sent = False
+        nb_lines = 0
+        for elems in rows:
+            if len(elems):
+                if not in_sent:
+                    sent_starts.append(len(token_ids))
+                    sent_lines.append(nb_lines)
+                    in_sent = True
+                token = elems[0]
+                token_id = token_to_id.get(token)
+                if token_id is None:
+                    token_id = len(token_to_id)
+                    token_to_id[token] = token_id
+                token_ids.append(token_id)
+                for label in elems[1:]:
+                    label_id = label_to_id.get(label)
+                    if label_id is None:
+                        label_id = len(label_to_id)
+                        label_to_id[label] = label_id
+                    label_ids.append(label_id)
+                widths.append(len(elems) - 1)
+            else:
+                in_sent = False
+            nb_lines += 1
+        nb_tokens = len(token_ids)
+        sent_starts.append(nb_tokens)
+
+        # Align label columns on the right
+        label_vocab = _invert(label_to_id)
+        widths = np.asarray(widths, dtype=np.int64)
+        label_ids = np.asarray(label_ids, dtype=np.int32)
+        nb_label_cols = int(widths.min()) if nb_tokens else 0
+        extra_fields = None
+        if nb_tokens == 0 or widths.max() == nb_label_cols:
+            label_ids = label_ids.reshape(nb_tokens, nb_label_cols)
+        else:
+            row_ends = np.cumsum(widths)
+            row_starts = row_ends - widths
+            indices = row_ends[:,None] - nb_label_cols + np.arange(nb_label_cols)[None,:]
+            all_label_ids = label_ids.tolist()
+            extra_fields = []
+            for start, stop in zip(row_starts.tolist(), (row_ends - nb_label_cols).tolist()):
+                extra_fields.append([label_vocab[i] for i in all_label_ids[start:stop]])
+            label_ids = label_ids[indices]
+
+        return cls(_invert(token_to_id),
+                   np.asarray(token_ids, dtype=np.int32),
+                   label_vocab,
+                   label_ids,
+                   np.asarray(sent_starts, dtype=np.int64),
+                   np.asarray(sent_lines, dtype=np.int64),
+                   nb_lines,
+                   extra_fields=extra_fields,
+                   path=path)
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    @property
+    def nb_sents(self):
+        return len(self.sent_starts) - 1
+
+    @property
+    def nb_label_cols(self):
+        return self.label_ids.shape[1]
+
+    def _get_label_col(self, col):
+        """Map a column index (as in a list of the whitespace-separated
+        elements of a line) to a column index in label_ids, or None if
+        the column is the token column.
+
+        """
+        nb_cols = self.nb_label_cols + 1
+        if col < 0:
+            col += nb_cols
+            if col == 0 and not self.uniform:
+                msg = "negative column index {} can not be used to get tokens, ".format(col-nb_cols)
+                msg += "as the number of columns is not the same on all lines"
+                raise ValueError(msg)
+        elif col > 0 and not self.uniform:
+            msg = "positive column index {} can not be used, ".format(col)
+            msg += "as the number of columns is not the same on all lines"
+            raise ValueError(msg)
+        if col < 0 or col >= nb_cols:
+            msg = "column index out of range ({} columns)".format(nb_cols)
+            raise ValueError(msg)
+        if col == 0:
+            return None
+        return col - 1
+
+    def get_column_ids(self, col):
+        """Return array of ids of the values in a given column (token
+        ids if col is the first column, label ids otherwise).
+
+        """
+        if len(self) == 0:
+            return self.token_ids
+        label_col = self._get_label_col(col)
+        if label_col is None:
+            return self.token_ids
+        return self.label_ids[:,label_col]
+
+    def get_column_vocab(self, col):
+        """Return the vocab that maps the ids of a given column to strings
+        (token vocab or label vocab).
+
+        """
+        if len(self) == 0 or self._get_label_col(col) is None:
+            return self.token_vocab
+        return self.label_vocab
+
+    def get_column(self, col):
+        """Return list of the values in a given column."""
+        vocab = self.get_column_vocab(col)
+        return [vocab[i] for i in self.get_column_ids(col).tolist()]
+
+    def get_line_nums(self):
+        """Return array containing the line number (zero-indexed) of each
+        token.
+
+        """
+        sent_lengths = np.diff(self.sent_starts)
+        sent_offsets = np.repeat(self.sent_lines - self.sent_starts[:-1], sent_lengths)
+        return np.arange(len(self), dtype=np.int64) + sent_offsets
+
+    def get_sent_bounds(self):
+        """Return list of (start, stop) token offsets of the sentences."""
+        starts = self.sent_starts.tolist()
+        return list(zip(starts[:-1], starts[1:]))
+
+    def get_fields(self):
+        """Return list containing, for each token, the list of
+        whitespace-separated columns of its line.
+
+        """
+        tokens = self.get_column(0)
+        labels = [[self.label_vocab[i] for i in row] for row in self.label_ids.tolist()]
+        if self.uniform:
+            return [[token] + row for token, row in zip(tokens, labels)]
+        return [[token] + extra + row for token, extra, row in zip(tokens, self.extra_fields, labels)]
+
+    def iter_sents(self, sent_indices=None):
+        """Stream sentences (optionally, only those whose index is in
+        sent_indices, in that order). A sentence is a list containing,
+        for each token, the whitespace-separated columns joined by a
+        single space. This matches the lines of the file (minus leading
+        and trailing whitespace) if the columns are separated by single
+        spaces.
+
+        """
+        fields = self.get_fields()
+        bounds = self.get_sent_bounds()
+        if sent_indices is None:
+            sent_indices = range(len(bounds))
+        for sent_ix in sent_indices:
+            start, stop = bounds[sent_ix]
+            yield [" ".join(fields[i]) for i in range(start, stop)]
+
+    def iter_lines(self):
+        """Stream the lines of the file, as lists of whitespace-separated
+        columns (empty lists for empty lines), in the order in which
+        they appear in the file.
+
+        """
+        fields = self.get_fields()
+        line_num = 0
+        for (start, stop), sent_line in zip(self.get_sent_bounds(), self.sent_lines.tolist()):
+            while line_num < sent_line:
+                yield []
+                line_num += 1
+            for i in range(start, stop):
+                yield fields[i]
+            line_num += stop - start
+        while line_num < self.nb_lines:
+            yield []
+            line_num += 1
+
+    def save(self, path):
+        """Write corpus in binary format in a directory, which can then be
+        opened by Corpus.open with memory-mapped arrays.
+
+        The directory contains the token vocab and label vocab (one
+        item per line, which is fine as they do not contain
+        whitespace), the arrays in .npy format, and the other attributes
+        in a JSON file.
+
+        """
+        os.makedirs(path)
+        for name in ["token_vocab", "label_vocab"]:
+            with open(os.path.join(path, name + ".txt"), "w") as f:
+                f.write("\n".join(getattr(self, name)))
+        for name in ["token_ids", "label_ids", "sent_starts", "sent_lines"]:
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+        if not self.uniform:
+            with open(os.path.join(path, "extra_fields.txt"), "w") as f:
+                for extra in self.extra_fields:
+                    f.write(" ".join(extra) + "\n")
+        info = {"nb_lines": self.nb_lines, "uniform": self.uniform, "path": self.path}
+        with open(os.path.join(path, "info.json"), "w") as f:
+            json.dump(info, f)
+
+    @classmethod
+    def open(cls, path):
+        """Open corpus written by Corpus.save. Arrays are memory-mapped
+        (read-only), so opening is fast, and the pages are shared by
+        processes that open the same corpus.
+
+        """
+        vocabs = []
+        for name in ["token_vocab", "label_vocab"]:
+            with open(os.path.join(path, name + ".txt")) as f:
+                content = f.read()
+                vocabs.append(content.split("\n") if len(content) else [])
+        arrays = []
+        for name in ["token_ids", "label_ids", "sent_starts", "sent_lines"]:
+            array_path = os.path.join(path, name + ".npy")
+            try:
+                arrays.append(np.load(array_path, mmap_mode="r"))
+            except ValueError:
+                # Empty arrays can not be memory-mapped
+                arrays.append(np.load(array_path))
+        with open(os.path.join(path, "info.json")) as f:
+            info = json.load(f)
+        extra_fields = None
+        if not info["uniform"]:
+            with open(os.path.join(path, "extra_fields.txt")) as f:
+                extra_fields = [line.split() for line in f]
+        return cls(vocabs[0], arrays[0], vocabs[1], arrays[1], arrays[2], arrays[3],
+                   info["nb_lines"], extra_fields=extra_fields, path=info["path"])
+
+
+def _invert(item_to_id):
+    """Given a dict that maps items to consecutive ids, return list of
+    items ordered by id.
+
+    """
+    items = [None] * len(item_to_id)
+    for item, i in item_to_id.items():
+        items[i] = item
+    return items
+
+
+def _read_byte_range(path, byte_range):
+    """Stream the lines of a file that are in a given (start, stop)
+    range of byte offsets.
+
+    """
+    start, stop = byte_range
+    encoding = locale.getpreferredencoding(False)
+    with open(path, "rb") as f:
+        f.seek(start)
+        while f.tell() < stop:
+            line = f.readline()
+            if not len(line):
+                break
+            yield line.decode(encoding)
+
+
+def get_shards(path, nb_shards):
+    """Split a file in column text format into (at most) nb_shards
+    ranges of bytes of similar size, such that each range ends with an
+    empty line (or at the end of the file), so that no sentence is
+    split. The lines in a range can be parsed with Corpus.from_file.
+
+    Returns:
+    - list of (start, stop) byte offsets
+
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        for i in range(1, nb_shards):
+            pos = size * i // nb_shards
+            if pos <= bounds[-1]:
+                continue
+            # Skip to the end of the line that contains pos, then look
+            # for the next empty line
+            f.seek(pos - 1)
+            f.readline()
+            while True:
+                line = f.readline()
+                if not len(line) or not len(line.strip()):
+                    break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, stop) for (start, stop) in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def get_cache_path(path, dir_cache):
+    """Given the path of a file in column text format and the path of a
+    cache directory, return path of the cached corpus. The key depends
+    on the absolute path, modification time and size of the file, so
+    a modified file is never matched with a stale cache entry.
+
+    """
+    stat = os.stat(path)
+    key = "{}\t{}\t{}".format(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    return os.path.join(dir_cache, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+
+def load_corpus(path, dir_cache=None):
+    """Given the path of a file in column text format, return a
+    Corpus. If path is already a Corpus, return it as is, so that
+    functions can accept either a path or a Corpus.
+
+    If dir_cache is provided (or, by default, if the environment
+    variable NER_EVAL_CACHE_DIR is set), parsed files are cached in
+    binary format in that directory, and a file that was already
+    cached (and has not been modified since) is not parsed again, but
+    opened with memory-mapped arrays.
+
+    """
+    if isinstance(path, Corpus):
+        return path
+    if dir_cache is None:
+        dir_cache = os.environ.get(CACHE_DIR_VAR)
+    if not dir_cache:
+        return Corpus.from_file(path)
+    cache_path = get_cache_path(path, dir_cache)
+    if os.path.exists(cache_path):
+        return Corpus.open(cache_path)
+    corpus = Corpus.from_file(path)
+    # Write in a temporary directory first, then rename it, so that
+    # other processes never see a partially written cache entry.
+    os.makedirs(dir_cache, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=dir_cache)
+    corpus.save(os.path.join(tmp_dir, "corpus"))
+    try:
+        os.rename(os.path.join(tmp_dir, "corpus"), cache_path)
+    except OSError:
+        # Another process cached the same file in the meantime
+        pass
+    shutil.rmtree(tmp_dir)
+    return corpus
@@ -1,6 +1,6 @@
 import os, sys, argparse
 from collections import defaultdict
-from data_utils import get_mentions_from_BIO_file
+from data_utils import stream_mentions_from_BIO_file
 
 doc="""Check overlap of entity mentions between two NER datasets in
     column text format (tokens in the first column, BIO-2 labels in
@@ -16,27 +16,21 @@ args = parser.parse_args()
 train_path = os.path.abspath(args.train)
 test_path = os.path.abspath(args.test)
 
-# Extract (mention, type) tuples
-mentions_train = get_mentions_from_BIO_file(train_path)
-mentions_test = get_mentions_from_BIO_file(test_path)
-tuples_train = []
-tuples_test = []
-for (line, tokens, labels) in mentions_train:
+# Extract (mention, type) tuples from the training set, and map test
+# tuples to frequency. We stream the mentions, so only the unique
+# tuples are kept in memory.
+tuple_set_train = set()
+for (line, tokens, labels) in stream_mentions_from_BIO_file(train_path):
     mention = " ".join(tokens)
     etype = labels[0][2:]
-    tuples_train.append((mention, etype))
-for (line, tokens, labels) in mentions_test:
+    tuple_set_train.add((mention, etype))
+tuple2freq = defaultdict(int)
+for (line, tokens, labels) in stream_mentions_from_BIO_file(test_path):
     mention = " ".join(tokens)
     etype = labels[0][2:]
-    tuples_test.append((mention, etype))
-
-# Map test tuples to frequency
-tuple2freq = defaultdict(int)
-for t in tuples_test:
-    tuple2freq[t] += 1
+    tuple2freq[(mention, etype)] += 1
 
 # Split test tuples into seen and unseen subsets
-tuple_set_train = set(tuples_train)
 tuple2freq_seen = {}
 tuple2freq_unseen = {}
 for (t,f) in tuple2freq.items():
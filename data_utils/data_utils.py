@@ -1,3 +1,101 @@
+import itertools
+import numpy as np
+from corpus import Corpus, load_corpus
+
+# Integer codes of the BIO (and BILOU) prefixes
+PREFIX_INVALID = -1
+PREFIX_O = 0
+PREFIX_B = 1
+PREFIX_I = 2
+PREFIX_L = 3
+PREFIX_U = 4
+PREFIX_CODES = {"O": PREFIX_O, "B": PREFIX_B, "I": PREFIX_I, "L": PREFIX_L, "U": PREFIX_U}
+
+
+class LabelSet(object):
+    """Vocabulary of labels. Each label is assigned an int id once, and
+    the prefix code and entity type id of each label are stored in
+    arrays indexed by label id, so that sequences of labels can be
+    handled as arrays of small ints instead of slicing strings on
+    every token.
+
+    Labels that start with O have prefix code PREFIX_O and entity type
+    id -1. Other labels should be a B, I, L or U prefix followed by a
+    separator and a non-empty entity type. Labels that do not match
+    this pattern have prefix code PREFIX_INVALID and entity type id -1.
+
+    """
+
+    def __init__(self, labels=()):
+        """Init.
+
+        Args:
+        - labels: (optional) iterable of labels to add
+
+        """
+        self.labels = []
+        self.label_to_id = {}
+        self.etypes = []
+        self.etype_to_id = {}
+        self._prefix_ids = []
+        self._type_ids = []
+        self._arrays = None
+        for label in labels:
+            self.add(label)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def add(self, label):
+        """Add label if it is not already in the set. Return its id."""
+        label_id = self.label_to_id.get(label)
+        if label_id is not None:
+            return label_id
+        label_id = len(self.labels)
+        self.labels.append(label)
+        self.label_to_id[label] = label_id
+        prefix = PREFIX_CODES.get(label[:1], PREFIX_INVALID)
+        etype = label[2:]
+        type_id = -1
+        if prefix not in [PREFIX_O, PREFIX_INVALID]:
+            if len(etype):
+                type_id = self.etype_to_id.get(etype)
+                if type_id is None:
+                    type_id = len(self.etypes)
+                    self.etypes.append(etype)
+                    self.etype_to_id[etype] = type_id
+            else:
+                prefix = PREFIX_INVALID
+        self._prefix_ids.append(prefix)
+        self._type_ids.append(type_id)
+        self._arrays = None
+        return label_id
+
+    def encode(self, labels):
+        """Given a sequence of labels, return array of label ids (labels
+        not in the set are added)."""
+        return np.asarray([self.add(label) for label in labels], dtype=np.int64)
+
+    def decode(self, label_ids):
+        """Given a sequence of label ids, return list of labels."""
+        return [self.labels[i] for i in np.asarray(label_ids).tolist()]
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            self._arrays = (np.asarray(self._prefix_ids, dtype=np.int8),
+                            np.asarray(self._type_ids, dtype=np.int32))
+        return self._arrays
+
+    @property
+    def prefix_ids(self):
+        """Array containing the prefix code of each label."""
+        return self._get_arrays()[0]
+
+    @property
+    def type_ids(self):
+        """Array containing the entity type id of each label (-1 if none)."""
+        return self._get_arrays()[1]
+
 
 def stream_sents(path):
     """Given the path of a text file containing one token per line and
@@ -5,7 +103,14 @@ def stream_sents(path):
     list containing, for each line, the content of that line minus any
     trailing whitespace (including line break).
 
+    path can also be a Corpus, in which case we stream its sentences
+    without re-reading the file (see Corpus.iter_sents).
+
     """
+    if isinstance(path, Corpus):
+        for sent in path.iter_sents():
+            yield sent
+        return
     with open(path) as f:
         sent = []
         for line in f:
@@ -22,8 +127,9 @@ def stream_sents(path):
         yield sent
     
 def count_tokens_and_sents(path):
-    """Given the path of a text file containing one token per line and
-    empty lines between sentences, count tokens and sentences. Note:
+    """Given the path of a text file (or a Corpus) containing one token
+    per line and empty lines between sentences, count tokens and
+    sentences. Note:
     lines starting with the "-DOCSTART-" token are not counted as
     tokens or sentences.
 
@@ -52,7 +158,8 @@ def get_mentions_from_BIO_file(path, encoding="BIO-2",
     column text format (tokens in the first column, BIO-1 or BIO-2
     labels in the last column by default, empty lines between
     sentences), return list containing a (line_number, tokens, labels)
-    tuple for each entity mention.
+    tuple for each entity mention. path can also be a Corpus, in which
+    case the file is not read again.
 
     encoding specifies the label encoding (BIO-1 or BIO-2).
 
@@ -89,46 +196,435 @@ def get_mentions_from_BIO_file(path, encoding="BIO-2",
     """
 
     if encoding not in ["BIO-1", "BIO-2"]:
-        raise ValueError("unrecognized label encoding '{}'".format(label_encoding))
-
-    # Load data, create list of sentences. A sentence is a list of
-    # (line offset, token, label) tuples. If ignore_boundaries=True,
-    # then we just make one long sentence.
-    with open(path) as f:
-        sents = []
-        current_sent = []
-        line_count = 0
-        for line in f:
-            elems = line.strip().split()
-            if len(elems):
-                token = elems[0]
-                label = elems[label_col]
-                current_sent.append((line_count, token, label))
-            elif not ignore_boundaries:
-                if len(current_sent):
-                    sents.append(current_sent[:])
-                current_sent = []
-            line_count += 1
-        if len(current_sent):
-            sents.append(current_sent[:])
-
-    # Get entity mentions
+        raise ValueError("unrecognized label encoding '{}'".format(encoding))
+
+    # Load data
+    corpus = load_corpus(path)
+    label_ids = corpus.get_column_ids(label_col)
+    label_vocab = corpus.get_column_vocab(label_col)
+    if ignore_boundaries:
+        sent_starts = np.asarray([0, len(corpus)])
+    else:
+        sent_starts = corpus.sent_starts
+    line_nums = corpus.get_line_nums()
+
+    # Get entity mentions. If some labels are not of the form B-X, I-X
+    # or O, we fall back to the (slower) sentence-by-sentence
+    # extraction, which handles them the same way as before.
+    if _decompose_labels(label_vocab, label_ids) is None:
+        return _get_mentions_from_corpus(corpus, encoding, label_col, sent_starts,
+                                         allow_prefix_errors, allow_type_errors)
+    starts, ends = get_mention_spans(label_ids, label_vocab, sent_starts,
+                                     encoding=encoding,
+                                     allow_prefix_errors=allow_prefix_errors,
+                                     allow_type_errors=allow_type_errors,
+                                     line_nums=line_nums)
+
+    # The line offset of a mention is computed from the line of the
+    # token that follows it (or the line that follows the last token
+    # of the sentence), as it was when we looped over the tokens.
+    next_lines = line_nums + 1
+    if ignore_boundaries:
+        next_lines[:-1] = line_nums[1:]
+    lengths = ends - starts + 1
+    line_offsets = (next_lines[ends] - lengths).tolist()
+
+    # Gather the tokens and labels of all the mentions at once
+    indices = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    tokens = [corpus.token_vocab[i] for i in corpus.token_ids[indices].tolist()]
+    labels = [label_vocab[i] for i in label_ids[indices].tolist()]
     mentions = []
-    for sent in sents:
-        if encoding == "BIO-1":
-            mentions += _get_mentions_bio1(sent, allow_prefix_errors, allow_type_errors)
-        elif encoding == "BIO-2":
-            mentions += _get_mentions_bio2(sent, allow_prefix_errors, allow_type_errors)
+    beg = 0
+    for line_offset, length in zip(line_offsets, lengths.tolist()):
+        mentions.append((line_offset, tokens[beg:beg+length], labels[beg:beg+length]))
+        beg += length
     return mentions
 
 
-def _get_mentions_bio1(sent, allow_prefix_errors, allow_type_errors):
+def stream_mentions_from_BIO_file(path, encoding="BIO-2",
+                                  label_col=-1,
+                                  ignore_boundaries=False,
+                                  allow_prefix_errors=False,
+                                  allow_type_errors=False,
+                                  stats=None):
+    """Same as get_mentions_from_BIO_file, but read the file line by
+    line and yield the (line_number, tokens, labels) tuples one at a
+    time, so that memory usage is bounded by the length of the
+    longest mention rather than the size of the file. Use this for
+    files that do not fit in memory. path can also be a Corpus, in
+    which case the file is not read again.
+
+    If stats is provided, it must be a dict, in which we store the
+    number of tokens and sentences ("nb_tokens" and "nb_sents", counted
+    as in count_tokens_and_sents) in the same pass. These counts are
+    complete once all the mentions have been consumed.
+
+    """
+    if encoding not in ["BIO-1", "BIO-2"]:
+        raise ValueError("unrecognized label encoding '{}'".format(encoding))
+    if isinstance(path, Corpus):
+        rows = _corpus_rows(path, label_col, path.sent_starts)
+        for mention in _iter_rows_mentions(rows, encoding, ignore_boundaries, allow_prefix_errors,
+                                           allow_type_errors, stats):
+            yield mention
+        return
+    with open(path) as f:
+        rows = _stream_rows(f, label_col)
+        for mention in _iter_rows_mentions(rows, encoding, ignore_boundaries, allow_prefix_errors,
+                                           allow_type_errors, stats):
+            yield mention
+
+
+def _iter_rows_mentions(rows, encoding, ignore_boundaries, allow_prefix_errors,
+                        allow_type_errors, stats):
+    """Stream entity mentions from an iterable of (line offset, token,
+    label) tuples containing None at sentence boundaries, optionally
+    counting tokens and sentences in stats, then dropping the
+    boundaries if ignore_boundaries is True (see
+    stream_mentions_from_BIO_file).
+
+    """
+    if stats is not None:
+        rows = _count_rows(rows, stats)
+    if ignore_boundaries:
+        rows = (row for row in rows if row is not None)
+    return _iter_mentions(rows, encoding, allow_prefix_errors, allow_type_errors)
+
+
+def _stream_rows(lines, label_col):
+    """Given an iterable of lines in column text format, yield a (line
+    offset, token, label) tuple for each token, and None at each empty
+    line.
+
+    """
+    for line_count, line in enumerate(lines):
+        elems = line.strip().split()
+        if len(elems):
+            yield (line_count, elems[0], elems[label_col])
+        else:
+            yield None
+
+
+def _corpus_rows(corpus, label_col, sent_starts):
+    """Given a Corpus, yield a (line offset, token, label) tuple for
+    each token, and None at the end of each sentence. sent_starts
+    contains the offsets of the sentences, followed by the number of
+    tokens.
+
+    """
+    rows = list(zip(corpus.get_line_nums().tolist(),
+                    corpus.get_column(0),
+                    corpus.get_column(label_col)))
+    starts = sent_starts.tolist()
+    for (start, stop) in zip(starts[:-1], starts[1:]):
+        for row in rows[start:stop]:
+            yield row
+        yield None
+
+
+def _count_rows(rows, stats):
+    """Pass through an iterable of (line offset, token, label) tuples
+    containing None at sentence boundaries, and store the number of
+    tokens and sentences in stats, without counting sentences that
+    only contain a "-DOCSTART-" token (see count_tokens_and_sents).
+
+    """
+    stats["nb_tokens"] = 0
+    stats["nb_sents"] = 0
+    sent_length = 0
+    first_token = None
+    for row in rows:
+        if row is not None:
+            if not sent_length:
+                first_token = row[1]
+            sent_length += 1
+        elif sent_length:
+            _count_sent(stats, sent_length, first_token)
+            sent_length = 0
+        yield row
+    if sent_length:
+        _count_sent(stats, sent_length, first_token)
+
+
+def _count_sent(stats, sent_length, first_token):
+    if not sent_length == 1 or not first_token == "-DOCSTART-":
+        stats["nb_sents"] += 1
+        stats["nb_tokens"] += sent_length
+
+
+def _get_mentions_from_corpus(corpus, encoding, label_col, sent_starts,
+                              allow_prefix_errors, allow_type_errors):
+    """Extract entity mentions from a Corpus sentence by sentence (see
+    get_mentions_from_BIO_file). sent_starts contains the offsets of
+    the sentences, followed by the number of tokens.
+
+    """
+    rows = _corpus_rows(corpus, label_col, sent_starts)
+    return list(_iter_mentions(rows, encoding, allow_prefix_errors, allow_type_errors))
+
+
+def _iter_mentions(rows, encoding, allow_prefix_errors, allow_type_errors):
+    """Stream entity mentions from an iterable of (line offset, token,
+    label) tuples containing None at sentence boundaries (see
+    _iter_mentions_bio1 and _iter_mentions_bio2).
+
+    """
+    if encoding == "BIO-1":
+        return _iter_mentions_bio1(rows, allow_prefix_errors, allow_type_errors)
+    return _iter_mentions_bio2(rows, allow_prefix_errors, allow_type_errors)
+
+
+def _decompose_labels(label_vocab, label_ids):
+    """Given a list of labels and an array of label ids, return an array
+    containing the prefix code (PREFIX_O, PREFIX_B or PREFIX_I) of
+    each label, an array containing the entity type id of each label
+    (-1 if prefix is O), and the list of entity types (see
+    LabelSet). Return None if a label found in label_ids is neither O
+    (or any label starting with O) nor a B or I prefix followed by a
+    separator and a non-empty entity type. Labels not found in
+    label_ids (e.g. labels of other columns) are ignored.
+
+    """
+    label_set = LabelSet(label_vocab)
+    used = np.bincount(label_ids, minlength=len(label_vocab)) > 0
+    if not np.isin(label_set.prefix_ids[used], [PREFIX_O, PREFIX_B, PREFIX_I]).all():
+        return None
+    return label_set.prefix_ids, label_set.type_ids, label_set.etypes
+
+
+def get_mention_spans(label_ids, label_vocab, sent_starts, encoding="BIO-2",
+                      allow_prefix_errors=False, allow_type_errors=False,
+                      line_nums=None):
+    """Find the entity mentions in a sequence of labels, using
+    vectorized comparisons between the prefix and type of each label
+    and those of the previous label.
+
+    Args:
+    - label_ids: array of label ids
+    - label_vocab: list of labels, indexed by id
+    - sent_starts: array containing the offset of each sentence,
+      followed by the number of labels (mentions can not cross a
+      sentence boundary)
+    - encoding: BIO-1 or BIO-2
+    - allow_prefix_errors, allow_type_errors: see get_mentions_from_BIO_file
+    - line_nums: (optional) array containing the line number of each
+      label, used in error messages (index of the label by default)
+
+    Returns:
+    - array containing the offset of the first token of each mention
+    - array containing the offset of the last token of each mention
+
+    """
+    if encoding not in ["BIO-1", "BIO-2"]:
+        raise ValueError("unrecognized label encoding '{}'".format(encoding))
+    label_ids = np.asarray(label_ids)
+    decomposed = _decompose_labels(label_vocab, label_ids)
+    if decomposed is None:
+        raise ValueError("labels must be O or start with B- or I-")
+    prefix_table, type_table, etypes = decomposed
+    nb_labels = len(label_ids)
+    prefixes = prefix_table[label_ids]
+    types = type_table[label_ids]
+
+    # Get prefix and type of the previous label. At the start of a
+    # sentence, we act as if the previous label were an O.
+    is_first = np.zeros(nb_labels, dtype=bool)
+    is_first[np.asarray(sent_starts[:-1])[np.diff(sent_starts) > 0]] = True
+    prev_prefixes = np.empty_like(prefixes)
+    prev_prefixes[1:] = prefixes[:-1]
+    prev_prefixes[is_first] = PREFIX_O
+    prev_types = np.empty_like(types)
+    prev_types[1:] = types[:-1]
+    prev_types[is_first] = -1
+
+    # Find labeling inconsistencies, and the tokens where a mention
+    # starts (see _iter_mentions_bio1 and _iter_mentions_bio2).
+    if encoding == "BIO-1":
+        checked = prefixes == PREFIX_B
+        starts = checked | ((prefixes == PREFIX_I) & (types != prev_types))
+    else:
+        checked = prefixes == PREFIX_I
+        starts = (prefixes == PREFIX_B) | (checked & (prev_prefixes == PREFIX_O))
+    prefix_errors = checked & (prev_prefixes == PREFIX_O)
+    type_errors = checked & (types != prev_types)
+    errors = np.zeros(nb_labels, dtype=bool)
+    if not allow_prefix_errors:
+        errors |= prefix_errors
+    if not allow_type_errors:
+        errors |= type_errors
+    if errors.any():
+        i = int(np.argmax(errors))
+        line = i if line_nums is None else int(line_nums[i])
+        checked_prefix = "B" if encoding == "BIO-1" else "I"
+        if prefix_errors[i] and not allow_prefix_errors:
+            msg = "ERROR at line {}: {} found after an O".format(line, checked_prefix)
+        else:
+            prev_prefix = "O" if is_first[i] else label_vocab[label_ids[i-1]][0]
+            prev_etype = None if prev_types[i] == -1 else etypes[prev_types[i]]
+            msg = "ERROR at line {}: ".format(line)
+            msg += "{}-{} found after {}-{}".format(checked_prefix, etypes[types[i]], prev_prefix, prev_etype)
+        raise ValueError(msg)
+
+    # A mention ends on a token that is part of a mention if the next
+    # token is not part of the same mention.
+    in_mention = prefixes != PREFIX_O
+    continues = np.zeros(nb_labels, dtype=bool)
+    continues[:-1] = in_mention[1:] & ~starts[1:] & ~is_first[1:]
+    ends = in_mention & ~continues
+    return np.flatnonzero(starts), np.flatnonzero(ends)
+
+
+# Prefixes allowed in each label encoding
+ENCODING_PREFIXES = {"BIO-1": [PREFIX_O, PREFIX_B, PREFIX_I],
+                     "BIO-2": [PREFIX_O, PREFIX_B, PREFIX_I],
+                     "BILOU": [PREFIX_O, PREFIX_B, PREFIX_I, PREFIX_L, PREFIX_U],
+                     "IO": [PREFIX_O, PREFIX_I]}
+
+
+def validate_labels(label_ids, label_set, encoding="BIO-2", sent_starts=None,
+                    line_nums=None, max_errors=10):
+    """Check that a sequence of labels is consistent with a label
+    encoding, using vectorized comparisons between each label and the
+    previous one, and return all the errors at once.
+
+    The rules are the following. In BIO-2, an I-X must follow a B-X or
+    an I-X. In BIO-1, a B-X must follow a B-X or an I-X. In IO, any
+    sequence of I and O labels is valid. In BILOU, an I-X or L-X must
+    follow a B-X or I-X, and a B-X or I-X must be followed by an I-X
+    or L-X. In all encodings, labels must be O or a valid prefix
+    followed by a separator and a non-empty entity type (see
+    LabelSet).
+
+    Args:
+    - label_ids: array of label ids
+    - label_set: LabelSet
+    - encoding: BIO-1, BIO-2, BILOU or IO
+    - sent_starts: (optional) array containing the index of the first
+      label of each sentence, followed by the total nb of labels. If
+      not provided, the labels are considered a single sequence.
+    - line_nums: (optional) array containing the line number of each
+      label, used in the error messages (default: index of label)
+    - max_errors: max nb of error messages returned
+
+    Returns:
+    - total nb of errors
+    - list of (line number, message) tuples for the first max_errors errors
+
+    """
+    if encoding not in ENCODING_PREFIXES:
+        raise ValueError("unrecognized label encoding '{}'".format(encoding))
+    label_ids = np.asarray(label_ids, dtype=np.int64)
+    nb_labels = len(label_ids)
+    if sent_starts is None:
+        sent_starts = [0, nb_labels]
+    prefixes = label_set.prefix_ids[label_ids]
+    types = label_set.type_ids[label_ids]
+
+    # Get prefix and type of the previous label. At the start of a
+    # sentence, we act as if the previous label were an O. Also
+    # check if each label is the last of its sentence.
+    sent_starts = np.asarray(sent_starts)
+    is_first = np.zeros(nb_labels, dtype=bool)
+    is_first[sent_starts[:-1][np.diff(sent_starts) > 0]] = True
+    is_last = np.zeros(nb_labels, dtype=bool)
+    is_last[sent_starts[1:][np.diff(sent_starts) > 0] - 1] = True
+    prev_prefixes = np.empty_like(prefixes)
+    prev_prefixes[1:] = prefixes[:-1]
+    prev_prefixes[is_first] = PREFIX_O
+    prev_types = np.empty_like(types)
+    prev_types[1:] = types[:-1]
+    prev_types[is_first] = -1
+
+    invalid = ~np.isin(prefixes, ENCODING_PREFIXES[encoding])
+    continues = (np.isin(prev_prefixes, [PREFIX_B, PREFIX_I])) & (types == prev_types)
+    if encoding == "BIO-2":
+        bad_transitions = (prefixes == PREFIX_I) & ~continues
+    elif encoding == "BIO-1":
+        bad_transitions = (prefixes == PREFIX_B) & ~continues
+    elif encoding == "IO":
+        bad_transitions = np.zeros(nb_labels, dtype=bool)
+    else:
+        inside = np.isin(prefixes, [PREFIX_I, PREFIX_L])
+        prev_open = np.isin(prev_prefixes, [PREFIX_B, PREFIX_I])
+        bad_transitions = (inside & ~continues) | (prev_open & ~inside)
+    bad_transitions &= ~invalid
+    unclosed = np.zeros(nb_labels, dtype=bool)
+    if encoding == "BILOU":
+        unclosed = is_last & np.isin(prefixes, [PREFIX_B, PREFIX_I])
+
+    # Sort the errors by position, and write messages for the first
+    # ones only
+    positions = np.concatenate([np.flatnonzero(invalid), np.flatnonzero(bad_transitions), np.flatnonzero(unclosed)])
+    kinds = np.repeat([0, 1, 2], [invalid.sum(), bad_transitions.sum(), unclosed.sum()])
+    order = np.lexsort((kinds, positions))
+    errors = []
+    for i in order[:max_errors].tolist():
+        pos = int(positions[i])
+        label = label_set.labels[label_ids[pos]]
+        if kinds[i] == 0:
+            msg = "invalid {} label '{}'".format(encoding, label)
+        elif kinds[i] == 1:
+            prev = "start of sentence" if is_first[pos] else "'{}'".format(label_set.labels[label_ids[pos-1]])
+            msg = "'{}' follows {}".format(label, prev)
+        else:
+            msg = "'{}' at end of sentence".format(label)
+        line = pos if line_nums is None else int(line_nums[pos])
+        errors.append((line, msg))
+    return len(positions), errors
+
+
+def validate_corpus(corpus, encoding="BIO-2", label_col=-1, max_errors=10):
+    """Check that the labels in a column of a Corpus (or file) are
+    consistent with a label encoding (see validate_labels). Sentence
+    boundaries are taken into account, and errors are reported with
+    line numbers (starting at 0).
+
+    """
+    corpus = load_corpus(corpus)
+    label_ids = corpus.get_column_ids(label_col)
+    label_set = LabelSet(corpus.get_column_vocab(label_col))
+    return validate_labels(label_ids, label_set, encoding=encoding,
+                           sent_starts=corpus.sent_starts,
+                           line_nums=corpus.get_line_nums(),
+                           max_errors=max_errors)
+
+
+def enforce_valid_labeling(labels, encoding="BIO-2", max_errors=10):
+    """Given a list of labels, considered as a single sequence, raise a
+    ValueError listing the first max_errors errors if the labels are
+    not consistent with a label encoding (see validate_labels).
+
     """
-    Extract entity mentions from sentence (BIO-1 encoding).
+    label_set = LabelSet()
+    label_ids = label_set.encode(labels)
+    nb_errors, errors = validate_labels(label_ids, label_set, encoding=encoding, max_errors=max_errors)
+    raise_labeling_errors(nb_errors, errors, encoding=encoding)
+
+
+def raise_labeling_errors(nb_errors, errors, encoding="BIO-2"):
+    """Given the number of errors and the list of (index, error) tuples
+    returned by validate_labels, raise a ValueError listing these errors
+    (if there are any).
+
+    """
+    if nb_errors:
+        msg = "Invalid {} labeling ({} errors)".format(encoding, nb_errors)
+        for (index, error) in errors:
+            msg += "\n  at index {}: {}".format(index, error)
+        if nb_errors > len(errors):
+            msg += "\n  ..."
+        raise ValueError(msg)
+
+
+def _iter_mentions_bio1(rows, allow_prefix_errors, allow_type_errors):
+    """
+    Stream entity mentions from a sequence of tokens (BIO-1 encoding).
 
     Input:
 
-    - sent: list of (line offset, token, label) tuples
+    - rows: iterable of (line offset, token, label) tuples, containing
+      None at sentence boundaries. Only the tokens of the current
+      mention are kept in memory.
 
     - allow_prefix_errors: flag that indicates whether we allow a B to
       follow an O. If True, we consider that this token if the first
@@ -146,18 +642,26 @@ def _get_mentions_bio1(sent, allow_prefix_errors, allow_type_errors):
 
     Output:
 
-    - list containing a (line offset, tokens, labels) tuple for each mention
+    - generator of (line offset, tokens, labels) tuples, one for each mention
 
     """
-    mentions = []
     mention_tokens = []
     mention_labels = []
     prev_prefix = "O"
     prev_etype = None
-    # Add an O to the end of the sentence to catch sentence-ending mentions
-    padded_sent = sent[:]
-    padded_sent.append((padded_sent[-1][0]+1, None, "O"))
-    for (line, token, label) in padded_sent:
+    last_line = None
+    # We add a sentence boundary at the end to catch the last mention
+    for row in itertools.chain(rows, [None]):
+        if row is not None:
+            (line, token, label) = row
+        elif last_line is None:
+            # Empty sentence
+            continue
+        else:
+            # Add an O to the end of the sentence to catch
+            # sentence-ending mentions
+            (line, token, label) = (last_line+1, None, "O")
+
         # Split label into BIO prefix and entity type
         prefix = label[0]
         if prefix != "O":
@@ -201,7 +705,7 @@ def _get_mentions_bio1(sent, allow_prefix_errors, allow_type_errors):
         # mention. If so, output that mention, and initialize a new mention.
         if prev_etype and (prefix=="O" or mention_starts_here):
             line_offset = line-len(mention_tokens)
-            mentions.append((line_offset, mention_tokens, mention_labels))
+            yield (line_offset, mention_tokens, mention_labels)
             mention_tokens = []
             mention_labels = []
 
@@ -215,17 +719,26 @@ def _get_mentions_bio1(sent, allow_prefix_errors, allow_type_errors):
             mention_tokens.append(token)
             mention_labels.append(label)
 
-        # Prepare to move on to next token
-        prev_prefix = prefix
-        prev_etype = etype
-    return mentions
+        # Prepare to move on to next token, or to the next sentence
+        if row is None:
+            mention_tokens = []
+            mention_labels = []
+            prev_prefix = "O"
+            prev_etype = None
+            last_line = None
+        else:
+            prev_prefix = prefix
+            prev_etype = etype
+            last_line = line
 
-def _get_mentions_bio2(sent, allow_prefix_errors, allow_type_errors):
-    """Extract entity mentions from sentence (BIO-2 encoding).
+def _iter_mentions_bio2(rows, allow_prefix_errors, allow_type_errors):
+    """Stream entity mentions from a sequence of tokens (BIO-2 encoding).
 
     Input:
 
-    - sent: list of (line offset, token, label) tuples
+    - rows: iterable of (line offset, token, label) tuples, containing
+      None at sentence boundaries. Only the tokens of the current
+      mention are kept in memory.
 
     - allow_prefix_errors: flag that indicates whether we allow an I
       to follow an O. If True, we consider that this token if the
@@ -244,18 +757,26 @@ def _get_mentions_bio2(sent, allow_prefix_errors, allow_type_errors):
 
     Output:
 
-    - list containing a (line offset, tokens, labels) tuple for each mention
+    - generator of (line offset, tokens, labels) tuples, one for each mention
 
     """
-    mentions = []
     mention_tokens = []
     mention_labels = []
     prev_prefix = "O"
     prev_etype = None
-    # Add an O to the end of the sentence to catch sentence-ending mentions
-    padded_sent = sent[:]
-    padded_sent.append((padded_sent[-1][0]+1, None, "O"))
-    for (line, token, label) in padded_sent:
+    last_line = None
+    # We add a sentence boundary at the end to catch the last mention
+    for row in itertools.chain(rows, [None]):
+        if row is not None:
+            (line, token, label) = row
+        elif last_line is None:
+            # Empty sentence
+            continue
+        else:
+            # Add an O to the end of the sentence to catch
+            # sentence-ending mentions
+            (line, token, label) = (last_line+1, None, "O")
+
         # Split label into BIO prefix and entity type
         prefix = label[0]
         if prefix != "O":
@@ -299,7 +820,7 @@ def _get_mentions_bio2(sent, allow_prefix_errors, allow_type_errors):
         # mention. If so, output that mention, and initialize a new mention.
         if prev_etype and (prefix=="O" or mention_starts_here):
             line_offset = line-len(mention_tokens)
-            mentions.append((line_offset, mention_tokens, mention_labels))
+            yield (line_offset, mention_tokens, mention_labels)
             mention_tokens = []
             mention_labels = []
 
@@ -313,8 +834,15 @@ def _get_mentions_bio2(sent, allow_prefix_errors, allow_type_errors):
             mention_tokens.append(token)
             mention_labels.append(label)
 
-        # Prepare to move on to next token
-        prev_prefix = prefix
-        prev_etype = etype
-    return mentions
+        # Prepare to move on to next token, or to the next sentence
+        if row is None:
+            mention_tokens = []
+            mention_labels = []
+            prev_prefix = "O"
+            prev_etype = None
+            last_line = None
+        else:
+            prev_prefix = prefix
+            prev_etype = etype
+            last_line = line
 
@@ -1,5 +1,6 @@
 import sys, os, argparse
-from data_utils import get_mentions_from_BIO_file, count_tokens_and_sents
+from corpus import CACHE_DIR_VAR, load_corpus
+from data_utils import stream_mentions_from_BIO_file
 
 doc = """ Print some info on an NER dataset in column text format
     (tokens in the first column, BIO-1 or BIO-2 labels in the last
@@ -13,33 +14,30 @@ parser.add_argument("input", help="path of input file")
 args = parser.parse_args()
 args.input=os.path.abspath(args.input)
 
-# Get mentions
-if args.relax:
-    mentions = get_mentions_from_BIO_file(args.input, encoding=args.encoding, label_col=-1, ignore_boundaries=False, allow_prefix_errors=True, allow_type_errors=True)
-else:
-    try:
-        mentions = get_mentions_from_BIO_file(args.input, encoding=args.encoding, label_col=-1, ignore_boundaries=False, allow_prefix_errors=False, allow_type_errors=False)
-    except ValueError as err:
-        msg = "\nERROR: ValueError caught while extracting mentions. "
-        msg += "Fix errors in data or use relaxed mode.\n"
-        print(msg)
-        raise 
+# If a corpus cache is used, load the (cached) corpus, otherwise
+# stream the file, so that we never hold the whole dataset in memory
+data = load_corpus(args.input) if os.environ.get(CACHE_DIR_VAR) else args.input
 
-# Extract mentions and entity types from list of mentions
-mentions = [(" ".join(tokens), labels[0][2:]) for (_,tokens,labels) in mentions]
-
-# Get number of mentions and number of entity types
+# Stream mentions, and count mentions, entity types and sentences in
+# the same pass
+stats = {}
+mentions = stream_mentions_from_BIO_file(data, encoding=args.encoding, label_col=-1, ignore_boundaries=False, allow_prefix_errors=args.relax, allow_type_errors=args.relax, stats=stats)
+nb_mentions = 0
 etypes = set()
-for (mention, etype) in mentions:
-    etypes.add(etype)
-
-# Get number of sentences
-_, nb_sents = count_tokens_and_sents(args.input)
+try:
+    for (_,tokens,labels) in mentions:
+        nb_mentions += 1
+        etypes.add(labels[0][2:])
+except ValueError as err:
+    msg = "\nERROR: ValueError caught while extracting mentions. "
+    msg += "Fix errors in data or use relaxed mode.\n"
+    print(msg)
+    raise 
 
 # Print stats
 msg = "Stats on {} -> ".format(os.path.basename(args.input))
-msg += "nb sents: {}; ".format(nb_sents)
-msg += "nb mentions: {}; ".format(len(mentions))
+msg += "nb sents: {}; ".format(stats["nb_sents"])
+msg += "nb mentions: {}; ".format(nb_mentions)
 msg += "nb entity types: {}".format(len(etypes))
 sys.stdout.write(msg+"\n")
 sys.stdout.flush()
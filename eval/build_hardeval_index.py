@@ -0,0 +1,27 @@
+import os, argparse
+from hardeval import read_train_stats, save_train_stats
+
+doc = """ Compute the statistics on the training data that hardeval.py
+needs (vocab, IO prefix and entity type frequencies of each word),
+and write them in a compact .npz file. This file can then be passed to
+hardeval.py with --train-index instead of the training data, so that
+scoring the predictions of many systems against the same training
+data does not require reading the training data again. """
+
+
+def main():
+    parser = argparse.ArgumentParser(description=doc)
+    msg = ("Path of training data (text file containing whitespace-separate "
+           "columns, with tokens in the first column, and gold BIO-2 labels in the last "
+           "column).")
+    parser.add_argument("train", help=msg)
+    parser.add_argument("output", help="Path of output file (.npz)")
+    args = parser.parse_args()
+    train_stats = read_train_stats(args.train)
+    save_train_stats(train_stats, args.output)
+    print("Nb words in training set: {}".format(len(train_stats["io_counts"].words)))
+    print("Wrote {}".format(os.path.abspath(args.output)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import sys, os, argparse
+import numpy as np
+dir_data_utils = os.path.dirname(os.path.realpath(__file__))+"/../data_utils"
+sys.path.append(dir_data_utils)
+from corpus import load_corpus
+from eval_utils import get_column_from_file, SpanCounts, paired_bootstrap_test, approximate_randomization_test, get_f_scores
+
+doc = """ Test the significance of the differences between the f-scores
+(at the mention level) of 2 or more NER systems evaluated on the same
+data, using a paired bootstrap test and an approximate randomization
+test. Input files are text files containing whitespace-separated
+columns, with gold and predicted labels in the last 2 columns, and
+empty lines between sentences. All files must contain the same gold
+labels. """
+
+
+def get_per_sentence_counts(paths, scheme="conlleval"):
+    """Count the true positives, false positives and false negatives of
+    each system in each sentence.
+
+    Args:
+    - paths: paths of the prediction files (one per system)
+    - scheme: how mentions are extracted from the labels (see SpanCounts)
+
+    Returns:
+    - tp, fp, fn: arrays (nb sents, nb systems)
+
+    """
+    gold_sents = None
+    tp, fp, fn = [], [], []
+    for path in paths:
+        corpus = load_corpus(path)
+        sents = get_column_from_file(corpus, -2, split_on_empty=True)
+        pred_sents = get_column_from_file(corpus, -1, split_on_empty=True)
+        if gold_sents is None:
+            gold_sents = sents
+        elif sents != gold_sents:
+            msg = "Gold labels in '{}' do not match those in '{}'".format(path, paths[0])
+            raise ValueError(msg)
+        counts = SpanCounts(scheme=scheme)
+        nb_gold, nb_pred, nb_correct = np.asarray([counts.update(gold, pred) for (gold, pred) in zip(gold_sents, pred_sents)]).reshape(-1, 3).T
+        tp.append(nb_correct)
+        fp.append(nb_pred - nb_correct)
+        fn.append(nb_gold - nb_correct)
+    return np.stack(tp, axis=1), np.stack(fp, axis=1), np.stack(fn, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument("input", nargs="+", help="Paths of prediction files (one per system)")
+    parser.add_argument("-s", "--scheme", choices=["conlleval", "BIO-2"], default="conlleval",
+                        help="How mentions are extracted from the labels (conlleval: same as conlleval)")
+    parser.add_argument("-b", "--resamples", type=int, default=10000, help="Nb bootstrap resamples")
+    parser.add_argument("-r", "--permutations", type=int, default=10000, help="Nb random permutations")
+    parser.add_argument("-n", "--workers", type=int, default=1, help="Nb worker processes used for bootstrapping")
+    parser.add_argument("--seed", type=int, help="Random seed")
+    args = parser.parse_args()
+    if len(args.input) < 2:
+        parser.error("at least 2 prediction files are required")
+
+    tp, fp, fn = get_per_sentence_counts(args.input, scheme=args.scheme)
+    f = get_f_scores(tp.sum(0), fp.sum(0), fn.sum(0))
+    bootstrap_seed_seq, permutation_seed_seq = np.random.SeedSequence(args.seed).spawn(2)
+    p_bootstrap = paired_bootstrap_test(tp, fp, fn, n_resamples=args.resamples, workers=args.workers, seed=bootstrap_seed_seq)
+    p_permutation = approximate_randomization_test(tp, fp, fn, n_permutations=args.permutations, rng=np.random.default_rng(permutation_seed_seq))
+
+    print("Nb sents: {}".format(tp.shape[0]))
+    print("Nb gold mentions: {}".format(tp[:,0].sum() + fn[:,0].sum()))
+    print("\nF-scores:")
+    for i, path in enumerate(args.input):
+        print("[{}] {:.4f} {}".format(i, f[i], path))
+    print("\nSystem A\tSystem B\tF(A)-F(B)\tp (bootstrap)\tp (approx. randomization)")
+    for a in range(len(args.input)):
+        for b in range(a+1, len(args.input)):
+            print("{}\t{}\t{:.4f}\t{:.4f}\t{:.4f}".format(a, b, f[a]-f[b], p_bootstrap[a,b], p_permutation[a,b]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import sys, os, argparse, re, tempfile
+import numpy as np
+from glob import glob
+dir_data_utils = os.path.dirname(os.path.realpath(__file__))+"/../data_utils"
+sys.path.append(dir_data_utils)
+from corpus import load_corpus
+from eval_utils import get_column_from_file, get_bio2_mentions, SpanCounts
+
+doc = """ Compile the predictions of an NER system on the dev set at each
+epoch of training into a compact .npz file containing the number of
+gold, predicted and correct predicted mentions in each sentence at
+each epoch, as well as the spans of the gold mentions. If the file
+already exists, only the epochs whose prediction files were added or
+modified since it was written are processed again. """
+
+# Default name of the compiled file in the prediction directory
+CACHE_NAME = "epoch_counts.npz"
+
+
+def get_epoch(path):
+    """ Get epoch from the name of a file matching <epoch>_valid.txt. """
+    basename = os.path.basename(path)
+    match = re.search(r"^(\d{3,})_", basename)
+    if not match:
+        msg = "Filename {} does not match pattern <epoch>_valid.txt".format(basename)
+        raise ValueError(msg)
+    return int(match.group(1))
+
+
+def get_file_stamp(path):
+    """ Get modification time and size of a file. """
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _read_epoch(path):
+    """ Read predictions on the dev set at one epoch. Return array (nb
+    sents, 3) containing the nb of gold, predicted and correct predicted
+    mentions in each sentence, and list of gold mentions (sentence
+    index, start, end, entity type). """
+    corpus = load_corpus(path)
+    gold_sents = get_column_from_file(corpus, -2, split_on_empty=True)
+    pred_sents = get_column_from_file(corpus, -1, split_on_empty=True)
+    counts = SpanCounts()
+    nb = np.asarray([counts.update(gold, pred) for (gold, pred) in zip(gold_sents, pred_sents)], dtype=np.int64).reshape(-1, 3)
+    spans = []
+    for sent_ix, labels in enumerate(gold_sents):
+        spans += [(sent_ix, beg, end, etype) for (beg, end, etype) in get_bio2_mentions(labels)]
+    return nb, spans
+
+
+def compile_epoch_counts(pred_dir, path_cache=None):
+    """ Get the counts of gold, predicted and correct predicted mentions
+    in each sentence of the dev set at each epoch, from a directory
+    containing files matching the pattern <epoch>_valid.txt (see
+    analyze_dev_samples.py). The counts are stored in a .npz file,
+    along with the modification time and size of each file, and only
+    the files that were added or modified since are read again. The
+    gold labels must be the same in all the files.
+
+    Args:
+    - pred_dir: path of directory containing the predictions
+    - path_cache: (optional) path of .npz file. Default: CACHE_NAME in pred_dir.
+
+    Returns:
+    - dict containing:
+      - epochs: array (nb epochs) of epochs, sorted
+      - stamps: array (nb epochs, 2) of modification times and sizes of the files
+      - nb_gold: array (nb sents) of nb gold mentions in each sentence
+      - nb_pred: array (nb sents, nb epochs) of nb predicted mentions
+      - nb_correct: array (nb sents, nb epochs) of nb correct predicted mentions
+      - gold_spans: array (nb gold mentions, 3) containing the sentence
+        index, start and end (inclusive) of each gold mention
+      - gold_span_types: array (nb gold mentions) of entity type ids
+      - etypes: array of entity types
+
+    """
+    if path_cache is None:
+        path_cache = os.path.join(pred_dir, CACHE_NAME)
+    paths = {get_epoch(path): path for path in glob(os.path.join(pred_dir, "*_valid.txt"))}
+    if not len(paths):
+        msg = "No files matching <epoch>_valid.txt in {}".format(pred_dir)
+        raise ValueError(msg)
+    epochs = sorted(paths)
+    stamps = np.asarray([get_file_stamp(paths[epoch]) for epoch in epochs], dtype=np.int64)
+
+    # Load cached counts of the epochs whose file has not changed
+    cached = {}
+    data = None
+    if os.path.exists(path_cache):
+        with np.load(path_cache) as f:
+            data = {k: f[k] for k in f.files}
+        for i, epoch in enumerate(data["epochs"].tolist()):
+            if epoch in paths and tuple(data["stamps"][i]) == tuple(stamps[epochs.index(epoch)]):
+                cached[epoch] = i
+        if len(cached) == len(epochs) == len(data["epochs"]):
+            return data
+        if not len(cached):
+            data = None
+
+    # Read the other files. If the gold labels do not match the cached
+    # ones, start over.
+    nb_pred = {}
+    nb_correct = {}
+    gold = None if data is None else (data["nb_gold"], data["gold_spans"], data["gold_span_types"], data["etypes"])
+    for epoch in epochs:
+        if epoch in cached:
+            continue
+        nb, spans = _read_epoch(paths[epoch])
+        etypes = sorted(set(etype for (_, _, _, etype) in spans))
+        etype_to_id = {etype: i for i, etype in enumerate(etypes)}
+        epoch_gold = (nb[:,0],
+                      np.asarray([span[:3] for span in spans], dtype=np.int64).reshape(-1, 3),
+                      np.asarray([etype_to_id[span[3]] for span in spans], dtype=np.int64),
+                      np.asarray(etypes, dtype=str))
+        if gold is None:
+            gold = epoch_gold
+        elif any(x.shape != y.shape or (x != y).any() for (x, y) in zip(gold, epoch_gold)):
+            if len(cached):
+                # The cached counts are stale, process all files again
+                os.remove(path_cache)
+                return compile_epoch_counts(pred_dir, path_cache=path_cache)
+            msg = "Gold labels in {} do not match those in {}".format(paths[epoch], paths[epochs[0]])
+            raise ValueError(msg)
+        nb_pred[epoch] = nb[:,1]
+        nb_correct[epoch] = nb[:,2]
+    for epoch, i in cached.items():
+        nb_pred[epoch] = data["nb_pred"][:,i]
+        nb_correct[epoch] = data["nb_correct"][:,i]
+
+    data = {"epochs": np.asarray(epochs, dtype=np.int64),
+            "stamps": stamps,
+            "nb_gold": gold[0],
+            "nb_pred": np.stack([nb_pred[epoch] for epoch in epochs], axis=1),
+            "nb_correct": np.stack([nb_correct[epoch] for epoch in epochs], axis=1),
+            "gold_spans": gold[1],
+            "gold_span_types": gold[2],
+            "etypes": gold[3]}
+
+    # Write in a temporary file first, then rename it, so that other
+    # processes never see a partially written file.
+    fd, tmp_path = tempfile.mkstemp(suffix=".npz", dir=os.path.dirname(os.path.abspath(path_cache)))
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f, **data)
+    os.replace(tmp_path, path_cache)
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=doc)
+    msg = ("Path of directory containing files matching the pattern "
+           "<epoch>_valid.txt for each epoch (see analyze_dev_samples.py)")
+    parser.add_argument("pred_dir", help=msg)
+    parser.add_argument("-o", "--output", help="Path of .npz file (default: {} in pred_dir)".format(CACHE_NAME))
+    args = parser.parse_args()
+    data = compile_epoch_counts(args.pred_dir, path_cache=args.output)
+    print("Nb epochs: {}".format(len(data["epochs"])))
+    print("Nb sents: {}".format(len(data["nb_gold"])))
+    print("Nb gold mentions: {}".format(len(data["gold_spans"])))
+
+
+if __name__ == "__main__":
+    main()
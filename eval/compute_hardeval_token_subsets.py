@@ -1,136 +1,128 @@
 #!/usr/bin/env python
-import os, argparse
-from collections import defaultdict
-from utils_hardeval import enforce_valid_bio2_labeling, convert_bio2_to_bilou, get_word_label_count_dict, get_diff_indices, write_table
+import os, sys, argparse, tempfile, shutil
+from multiprocessing import Pool
+import numpy as np
+dir_data_utils = os.path.dirname(os.path.realpath(__file__))+"/../data_utils"
+sys.path.append(dir_data_utils)
+from corpus import load_corpus
+from eval_utils import convert_bio2_ids_to_bilou
+from data_utils import LabelSet, enforce_valid_labeling, PREFIX_O
+from utils_hardeval import WordLabelCounts, get_word_label_count_matrix, write_table
 
 doc="""Given NER training data, and optionally a test file, compute the
 various subsets of tokens used in HardEval. If no test file is
-provided, we use 10-fold cross-validation over the training data.
+provided, we use k-fold cross-validation over the training data
+(k=10 by default).
 
 WARNING: labels must be in BIO-2 format.
 """
 
 def load_labeled_data(path):
+    """Given the path of a labeled file (or a Corpus), return list of
+    tokens (first column) and list of labels (last column).
+
+    """
     word_col_ix = 0
     label_col_ix = -1
-    tokens = []
-    labels = []
-    with open(path) as f:
-        for line in f:
-            elems = line.strip().split()
-            if len(elems):
-                tokens.append(elems[word_col_ix])
-                labels.append(elems[label_col_ix])
+    corpus = load_corpus(path)
+    tokens = corpus.get_column(word_col_ix)
+    labels = corpus.get_column(label_col_ix)
     if len(tokens) == 0:
         msg = "Error: 0 tokens read"
         raise ValueError(msg)                
     return (tokens, labels)
 
 
-def get_test_token_subsets(train_examples, test_examples, dir_output, strict=False):
-    # Extract data, convert labels to BILOU
-    train_tokens, train_labels = zip(*train_examples)
-    test_tokens, test_labels = zip(*test_examples)
-    print("    Checking train labels")    
-    enforce_valid_bio2_labeling(train_labels)
-    print("    Checking test labels")        
-    enforce_valid_bio2_labeling(test_labels)
-    train_vocab = set(train_tokens)
-    test_vocab = set(test_tokens)
-    train_labels_bilou = convert_bio2_to_bilou(train_labels)
-    test_labels_bilou = convert_bio2_to_bilou(test_labels)
-    
-    # Map words to their BILOU labels    
-    train_word_to_labels = defaultdict(list)
-    for i in range(len(train_examples)):
-        word = train_tokens[i]
-        label = train_labels_bilou[i]
-        train_word_to_labels[word].append(label)
-    test_word_to_labels = defaultdict(list)
-    for i in range(len(test_examples)):
-        word = test_tokens[i]
-        label = test_labels_bilou[i]
-        test_word_to_labels[word].append(label)
-    
-    # Convert labels to IO
-    train_labels_io = ["O" if y == "O" else "I" for y in train_labels_bilou]
-    test_labels_io = ["O" if y == "O" else "I" for y in test_labels_bilou]
+def encode_labeled_data(tokens, labels, token_to_id, label_set):
+    """Check that labels are valid BIO-2 labels, convert them to BILOU,
+    and encode tokens and labels as arrays.
 
-    # Compute unseen tokens
-    nb_test_tokens = len(test_examples)    
+    Args:
+    - tokens: list of tokens
+    - labels: list of BIO-2 labels
+    - token_to_id: dict that maps tokens to ids (new tokens are added)
+    - label_set: LabelSet of BILOU labels (new labels are added)
+
+    Returns:
+    - array of token ids
+    - boolean array indicating which tokens are part of a mention (I in IO encoding)
+    - array of entity type ids (see label_set.etypes), -1 if token is not part of a mention
+
+    """
+    enforce_valid_labeling(labels)
+    token_ids = np.asarray([token_to_id.setdefault(token, len(token_to_id)) for token in tokens], dtype=np.int64)
+    bio_label_set = LabelSet()
+    bio_label_ids = bio_label_set.encode(labels)
+    bilou_ids, bilou_labels = convert_bio2_ids_to_bilou(bio_label_ids, bio_label_set.labels)
+    bilou_ids = label_set.encode(bilou_labels)[bilou_ids]
+    return token_ids, label_set.prefix_ids[bilou_ids] != PREFIX_O, label_set.type_ids[bilou_ids]
+
+
+# IO labels, indexed by label id in the IO counts
+IO_LABELS = ["I", "O"]
+
+
+def get_train_counts(token_ids, is_I, etype_ids, words, etypes):
+    """Given training data encoded by encode_labeled_data, count the IO
+    labels (see IO_LABELS) of each word, and the entity types of each
+    word when it is part of a mention.
+
+    Args:
+    - token_ids, is_I, etype_ids: arrays returned by encode_labeled_data
+    - words: list of words, indexed by token id
+    - etypes: list of entity types, indexed by entity type id
+
+    Returns:
+    - WordLabelCounts of IO labels
+    - WordLabelCounts of entity types
+
+    """
+    io_counts = WordLabelCounts.from_ids(token_ids, ~is_I, words, IO_LABELS)
+    etype_counts = WordLabelCounts.from_ids(token_ids[is_I], etype_ids[is_I], words, etypes)
+    return io_counts, etype_counts
+
+
+def get_token_subsets(io_counts, etype_counts, test_token_ids, test_is_I, test_etype_ids, strict=False):
+    """Compute the subsets of test tokens used in HardEval, given the
+    label counts of the training data (see get_train_counts) and the
+    test data encoded by encode_labeled_data.
+
+    Returns:
+    - dict that maps the name of each subset to the list of indices of
+      the test tokens in that subset
+
+    """
     test_subsets = {}
-    unseen = test_vocab.difference(train_vocab)
-    keep_unseen = [i for i in range(nb_test_tokens) if test_tokens[i] in unseen]
-    keep_unseen_I = []
-    keep_unseen_O = []
-    for i in keep_unseen:
-        if test_labels_io[i] == "I":
-            keep_unseen_I.append(i)
-        else:
-            keep_unseen_O.append(i)
-    test_subsets["unseen-I"] = keep_unseen_I
-    test_subsets["unseen-O"] = keep_unseen_O    
+
+    # Compute unseen tokens
+    unseen = ~io_counts.seen(test_token_ids)
+    test_subsets["unseen-I"] = np.flatnonzero(unseen & test_is_I).tolist()
+    test_subsets["unseen-O"] = np.flatnonzero(unseen & ~test_is_I).tolist()
 
     # Compute diff-I and diff-O tokens, i.e. O tokens that were
     # usually or exclusively I in training, and vice-versa
-    word_io_count = get_word_label_count_dict(train_tokens, train_labels_io)
-    test_indices_I = []
-    test_indices_O = []
-    for i,label in enumerate(test_labels_io):
-        if label == "I":
-            test_indices_I.append(i)
-        else:
-            test_indices_O.append(i)
-    test_tokens_I = [test_tokens[i] for i in test_indices_I]
-    test_labels_I = ["I" for _ in test_indices_I]
-    indices = get_diff_indices(word_io_count, test_tokens_I, test_labels_I, strict=strict)
-    test_subsets["diff-I"] = [test_indices_I[i] for i in indices]
-    test_tokens_O = [test_tokens[i] for i in test_indices_O]
-    test_labels_O = ["O" for _ in test_indices_O]
-    indices = get_diff_indices(word_io_count, test_tokens_O, test_labels_O, strict=strict)
-    test_subsets["diff-O"] = [test_indices_O[i] for i in indices]
+    diff_io = io_counts.diff(test_token_ids, ~test_is_I, strict=strict)
+    test_subsets["diff-I"] = np.flatnonzero(diff_io & test_is_I).tolist()
+    test_subsets["diff-O"] = np.flatnonzero(diff_io & ~test_is_I).tolist()
 
     # I-X tokens that were usually I, but whose entity type was usually
     # (or exclusively) not X.
-    train_indices_I = []
-    for i,label in enumerate(train_labels_io):
-        if label == "I":
-            train_indices_I.append(i)
-    train_tokens_I = [train_tokens[i] for i in train_indices_I]
-    train_etypes_I = [train_labels_bilou[i][2:] for i in train_indices_I]
-    word_etype_count = get_word_label_count_dict(train_tokens_I, train_etypes_I)
-    usually_I = set()
-    for word, io_fd in word_io_count.items():
-        i_count = 0
-        o_count = 0
-        if "I" in io_fd:
-            i_count = io_fd["I"]
-        if "O" in io_fd:
-            o_count = io_fd["O"]
-        if i_count >= o_count:
-            usually_I.add(word)
-    test_indices_UI = [i for i in test_indices_I if test_tokens[i] in usually_I]
-    test_tokens_UI = [test_tokens[i] for i in test_indices_UI]
-    test_etypes_UI = [test_labels_bilou[i][2:] for i in test_indices_UI]
-    indices = get_diff_indices(word_etype_count, test_tokens_UI, test_etypes_UI, strict=strict)
-    test_subsets["diff-etype"] = [test_indices_UI[i] for i in indices]
+    usually_I = io_counts.argmax(test_token_ids) == 0
+    diff_etype = etype_counts.diff(test_token_ids, test_etype_ids, strict=strict)
+    test_subsets["diff-etype"] = np.flatnonzero(test_is_I & usually_I & diff_etype).tolist()
     return test_subsets
 
 
-def write_label_freq_data(examples, dir_output):
+def write_label_freq_data(io_counts, etype_counts, dir_output):
+    """Write IO prefix and entity type frequencies of each word in the
+    training set (see get_train_counts).
+
+    """
     # Write IO prefix frequencies in training set
-    tokens, labels = zip(*examples)
-    enforce_valid_bio2_labeling(labels)    
-    labels_bilou = convert_bio2_to_bilou(labels)    
-    labels_io = ["O" if y == "O" else "I" for y in labels_bilou]    
-    word_io_count = get_word_label_count_dict(tokens, labels_io)    
-    keys = ["I", "O"]
-    io_data = []
-    for word in set(tokens):
-        io_fd = {}
-        if word in word_io_count:
-            io_fd = word_io_count[word]
-        io_data.append([word] + [str(io_fd[k]) if k in io_fd else "0" for k in keys])
+    words = io_counts.words
+    word_ids = np.flatnonzero(io_counts.seen()).tolist()
+    keys = io_counts.labels
+    io_data = [[words[i]] + [str(c) for c in row] for i, row in zip(word_ids, io_counts.counts[word_ids].tolist())]
     io_data = sorted(io_data, key=lambda x:x[0])
     path = "{}/io_freqs.tsv".format(dir_output)
     header = ["Word"] + keys
@@ -138,18 +130,11 @@ def write_label_freq_data(examples, dir_output):
     
     # Write entity type frequencies in training set for seen test
     # words (excluding "O")
-    indices_I = []
-    for i,label in enumerate(labels_io):
-        if label == "I":
-            indices_I.append(i)            
-    tokens_I = [tokens[i] for i in indices_I]
-    etypes_I = [labels_bilou[i][2:] for i in indices_I]
-    word_etype_count = get_word_label_count_dict(tokens_I, etypes_I)    
-    keys = list(set(etypes_I))
-    etype_data = []
-    for word in word_etype_count.keys():
-        etype_fd = word_etype_count[word]
-        etype_data.append([word] + [str(etype_fd[k]) if k in etype_fd else "0" for k in keys])
+    word_ids = np.flatnonzero(etype_counts.seen()).tolist()
+    etype_ids = np.flatnonzero(etype_counts.counts.sum(0)).tolist()
+    keys = list(set(etype_counts.labels[j] for j in etype_ids))
+    counts = etype_counts.counts[np.ix_(word_ids, etype_counts.encode_labels(keys))]
+    etype_data = [[words[i]] + [str(c) for c in row] for i, row in zip(word_ids, counts.tolist())]
     etype_data = sorted(etype_data, key=lambda x:x[0])
     path = "{}/etype_freqs.tsv".format(dir_output)
     header = ["Word"] + keys
@@ -157,64 +142,110 @@ def write_label_freq_data(examples, dir_output):
     return
 
 
+def write_annotated_data(tokens, labels, subsets, path):
+    """Write tokens and labels, with the name of the subset of each token
+    (if any) in an extra column."""
+    line_num_to_tag = {}
+    for subset_name, indices in subsets.items():
+        for i in indices:
+            line_num_to_tag[i] = subset_name
+    print("Writing annotated dataset in %s..." % path)    
+    with open(path, 'w') as f:
+        for i, (word, label) in enumerate(zip(tokens, labels)):
+            msg = "%s\t%s" % (word, label)
+            if i in line_num_to_tag:
+                msg += "\t%s" % line_num_to_tag[i]
+            f.write(msg + "\n")
+
+
+def write_token_subsets(tokens, labels, subsets, dir_output):
+    """Write the tokens in each subset."""
+    header = ["Line", "Token", "Label"]
+    for subset_name, indices in subsets.items():
+        data = [[str(i), tokens[i], labels[i]] for i in indices]
+        path = os.path.join(dir_output, 'tokens_%s.tsv' % subset_name)
+        write_table(data, path, header=header, delim="\t")
+
+
 def main_with_test_set(args):
     # Read train data
     print("\nReading training data from {}...".format(os.path.abspath(args.path_train)))
     train_tokens, train_labels = load_labeled_data(args.path_train)
-    train_examples = list(zip(train_tokens, train_labels))
-    print("Nb tokens in training set: {}".format(len(train_examples)))    
+    print("Nb tokens in training set: {}".format(len(train_tokens)))    
         
     # Read test data
     print("\nReading test data from {}...".format(os.path.abspath(args.path_test)))
     test_tokens, test_labels = load_labeled_data(args.path_test)
-    test_examples = list(zip(test_tokens, test_labels))
-    print("Nb tokens in test set: {}".format(len(test_examples)))        
+    print("Nb tokens in test set: {}".format(len(test_tokens)))        
 
     # Write token subsets in test set
     print("\nComputing token subsets in the test set by comparing to the training set...")        
-    test_subsets = get_test_token_subsets(train_examples, test_examples, args.strict)
-    header = ["Line", "Token", "Label"]
-    for subset_name, indices in test_subsets.items():
-        data = [[str(i), test_tokens[i], test_labels[i]] for i in indices]
-        path = os.path.join(args.dir_output, 'tokens_%s.tsv' % subset_name)
-        write_table(data, path, header=header, delim="\t")
+    token_to_id = {}
+    label_set = LabelSet()
+    print("    Checking train labels")    
+    train_data = encode_labeled_data(train_tokens, train_labels, token_to_id, label_set)
+    print("    Checking test labels")        
+    test_data = encode_labeled_data(test_tokens, test_labels, token_to_id, label_set)
+    train_counts = get_train_counts(*train_data, list(token_to_id), label_set.etypes)
+    test_subsets = get_token_subsets(*train_counts, *test_data, strict=args.strict)
+    write_token_subsets(test_tokens, test_labels, test_subsets, args.dir_output)
 
     # Write training data frequency info
     print("Computing label frequencies in the training data...")
     subdir = os.path.join(args.dir_output, "train_freqs")
     os.makedirs(subdir)
-    write_label_freq_data(train_examples, subdir)
+    write_label_freq_data(*train_counts, subdir)
 
     # Write annotated dataset with added DIFF tags
-    line_num_to_tag = {}
-    for subset_name, indices in test_subsets.items():
-        for i in indices:
-            line_num_to_tag[i] = subset_name
     path = os.path.join(args.dir_output, 'annotated.tsv')
-    print("Writing annotated dataset in %s..." % path)    
-    with open(path, 'w') as f:
-        for i, (word, label) in enumerate(test_examples):
-            msg = "%s\t%s" % (word, label)
-            if i in line_num_to_tag:
-                msg += "\t%s" % line_num_to_tag[i]
-            f.write(msg + "\n")
+    write_annotated_data(test_tokens, test_labels, test_subsets, path)
     print("Done.\n")    
     return
 
 
+# Arrays (token ids, IO flags, entity type ids) of the training data,
+# and label counts over the whole training data, shared by the workers
+# that process the cross-validation folds
+_fold_data = None
+
+
+def _init_fold_worker(paths):
+    """Open the memory-mapped arrays of the training data."""
+    global _fold_data
+    _fold_data = [np.load(path, mmap_mode="r") for path in paths]
+
+
+def _get_fold_subsets(task):
+    """Compute token subsets in one fold, using the other folds as
+    training data. The label counts of the other folds are obtained by
+    subtracting the counts of this fold from the total counts. Return
+    indices relative to the start of the fold."""
+    start, stop, strict = task
+    token_ids, is_I, etype_ids, total_io_counts, total_etype_counts = _fold_data
+    test_data = [np.asarray(x[start:stop]) for x in (token_ids, is_I, etype_ids)]
+    fold_token_ids, fold_is_I, fold_etype_ids = test_data
+    fold_io_counts = get_word_label_count_matrix(fold_token_ids, ~fold_is_I, *total_io_counts.shape)
+    fold_etype_counts = get_word_label_count_matrix(fold_token_ids[fold_is_I], fold_etype_ids[fold_is_I],
+                                                    *total_etype_counts.shape)
+    return get_token_subsets(WordLabelCounts(total_io_counts - fold_io_counts),
+                             WordLabelCounts(total_etype_counts - fold_etype_counts),
+                             *test_data, strict=strict)
+
+
 def main_with_cv(args):
     # Read train data
     print("\nReading training data from {}...".format(os.path.abspath(args.path_train)))
     all_train_tokens, all_train_labels = load_labeled_data(args.path_train)
     print("Nb tokens in training set: {}".format(len(all_train_tokens)))
     
-    # Do 10-fold cross-validation over the training set, and
+    # Do k-fold cross-validation over the training set, and
     # accumulate the token subsets for each test fold
-    print("\nComputing token subsets by running 10-fold CV over the training data...")
-    step = len(all_train_tokens) / 10
-    fold_boundaries = [round(step*i) for i in range(11)]
+    k = args.folds
+    print("\nComputing token subsets by running {}-fold CV over the training data...".format(k))
+    step = len(all_train_tokens) / k
+    fold_boundaries = [round(step*i) for i in range(k+1)]
     # Adjust fold boundaries. Make sure a fold never starts in the middle of a named entity.
-    for i in range(1, 10):
+    for i in range(1, k):
         b = fold_boundaries[i]
         while all_train_labels[b][0] == 'I':
             b -= 1
@@ -222,16 +253,38 @@ def main_with_cv(args):
             print("  WARNING: Boundary %d changed to %d to avoid splitting a named entity." % (fold_boundaries[i], b))
             fold_boundaries[i] = b
     fold_boundaries = list(zip(fold_boundaries[:-1], fold_boundaries[1:]))
+
+    # Check the labels and convert them once. Since no fold starts in
+    # the middle of a named entity, the labels of each fold are the
+    # same as if they had been converted separately. Also count the
+    # labels of each word once over the whole training set: the counts
+    # of the training folds are then the total counts minus the counts
+    # of the test fold. Store the arrays in files that the workers can
+    # memory-map, so that each worker only receives the boundaries of
+    # its fold.
+    print("    Checking train labels")    
+    token_to_id = {}
+    label_set = LabelSet()
+    train_data = encode_labeled_data(all_train_tokens, all_train_labels, token_to_id, label_set)
+    total_counts = get_train_counts(*train_data, list(token_to_id), label_set.etypes)
+    fold_data = list(train_data) + [c.counts for c in total_counts]
+    tasks = [(start, stop, args.strict) for (start, stop) in fold_boundaries]
+    if args.workers > 1:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(tmp_dir, "{}.npy".format(i)) for i in range(len(fold_data))]
+            for path, x in zip(paths, fold_data):
+                np.save(path, x)
+            with Pool(args.workers, initializer=_init_fold_worker, initargs=(paths,)) as pool:
+                fold_subsets = pool.map(_get_fold_subsets, tasks)
+        finally:
+            shutil.rmtree(tmp_dir)
+    else:
+        global _fold_data
+        _fold_data = fold_data
+        fold_subsets = [_get_fold_subsets(task) for task in tasks]
     train_subsets = {}
-    for fold_ix in range(10):
-        start, stop = fold_boundaries[fold_ix]
-        test_tokens = all_train_tokens[start:stop]
-        test_labels = all_train_labels[start:stop]
-        test_examples = list(zip(test_tokens, test_labels))
-        train_tokens = all_train_tokens[:start] + all_train_tokens[stop:]
-        train_labels = all_train_labels[:start] + all_train_labels[stop:]
-        train_examples = list(zip(train_tokens, train_labels))
-        test_subsets = get_test_token_subsets(train_examples, test_examples, args.strict)
+    for fold_ix, ((start, stop), test_subsets) in enumerate(zip(fold_boundaries, fold_subsets)):
         for subset_name, indices in test_subsets.items():
             indices_corr = [x+start for x in indices]
             if subset_name not in train_subsets:
@@ -240,32 +293,17 @@ def main_with_cv(args):
         print("  Fold %d. Test fold line nums: %d-%d" % (fold_ix+1, start, stop))
 
     # Write token subsets
-    header = ["Line", "Token", "Label"]
-    for subset_name, indices in train_subsets.items():
-        data = [[str(i), all_train_tokens[i], all_train_labels[i]] for i in indices]
-        path = os.path.join(args.dir_output, 'tokens_%s.tsv' % subset_name)
-        write_table(data, path, header=header, delim="\t")
+    write_token_subsets(all_train_tokens, all_train_labels, train_subsets, args.dir_output)
             
     # Write training data frequency info
     print("Computing label frequencies in the training data...")
     subdir = os.path.join(args.dir_output, "train_freqs")
-    train_examples = list(zip(all_train_tokens, all_train_labels))
     os.makedirs(subdir)
-    write_label_freq_data(train_examples, subdir)
+    write_label_freq_data(*total_counts, subdir)
 
     # Write annotated dataset with added DIFF tags
-    line_num_to_tag = {}
-    for subset_name, indices in train_subsets.items():
-        for i in indices:
-            line_num_to_tag[i] = subset_name
     path = os.path.join(args.dir_output, 'annotated.tsv')
-    print("Writing annotated dataset in %s..." % path)    
-    with open(path, 'w') as f:
-        for i, (word, label) in enumerate(train_examples):
-            msg = "%s\t%s" % (word, label)
-            if i in line_num_to_tag:
-                msg += "\t%s" % line_num_to_tag[i]
-            f.write(msg + "\n")
+    write_annotated_data(all_train_tokens, all_train_labels, train_subsets, path)
     print("Done.\n")
     return
 
@@ -286,6 +324,14 @@ def main():
     parser.add_argument("--dir_output",
                         type=str,
                         help="Path of output directory (required).")    
+    parser.add_argument("-n", "--workers",
+                        type=int,
+                        default=1,
+                        help="Number of worker processes used to process the cross-validation folds")
+    parser.add_argument("-k", "--folds",
+                        type=int,
+                        default=10,
+                        help="Number of cross-validation folds (if no test file is provided)")
     args = parser.parse_args()
 
     assert args.path_train is not None
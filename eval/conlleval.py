@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, unicode_literals
+import sys, io, re, json, argparse, itertools
+from collections import Counter
+
+doc = """Python port of the conlleval evaluation script (eval/conlleval).
+Evaluate the predictions of a NER system and write the same report as
+the Perl script, or compute the scores as a dict in-process (see
+evaluate). Input is read from stdin. It must contain lines with items
+separated by a delimiter (default: single space), the last 2 items
+being the gold and predicted labels (in that order), and sentences
+must be separated by empty lines or lines whose first item is -X-."""
+
+# Sentence boundary (value of the first item of boundary lines)
+BOUNDARY = "-X-"
+
+
+def read_labels(lines, delimiter=" "):
+    """Read gold and predicted labels from lines in conlleval input
+    format.
+
+    Args:
+    - lines: iterable of lines (with or without the line break)
+    - delimiter: regex that matches the field delimiter, as in conlleval
+
+    Returns:
+    - list of gold labels, containing None at sentence boundaries
+    - list of predicted labels, containing None at sentence boundaries
+
+    """
+    gold_labels = []
+    pred_labels = []
+    nb_features = -1
+    for line in lines:
+        if line.endswith("\n"):
+            line = line[:-1]
+        # Perl's split drops trailing empty fields
+        features = re.split(delimiter, line)
+        while len(features) and features[-1] == "":
+            features.pop()
+        if nb_features < 0:
+            nb_features = len(features) - 1
+        elif nb_features != len(features) - 1 and len(features) != 0:
+            msg = "unexpected number of features: {} ({})".format(len(features), nb_features+1)
+            raise ValueError(msg)
+        if len(features) == 0 or features[0] == BOUNDARY:
+            gold_labels.append(None)
+            pred_labels.append(None)
+            continue
+        if len(features) < 2:
+            msg = "conlleval: unexpected number of features in line {}".format(line)
+            raise ValueError(msg)
+        gold_labels.append(features[-2])
+        pred_labels.append(features[-1])
+    return gold_labels, pred_labels
+
+
+def _split_label(label):
+    """Split label into chunk tag and type. Hyphens are allowed in the
+    type. As in conlleval, a type equal to "0" is treated as an empty
+    type.
+
+    """
+    if "-" in label:
+        tag, etype = label.split("-", 1)
+    else:
+        tag, etype = label, ""
+    if etype == "0":
+        etype = ""
+    return tag, etype
+
+
+def _end_of_chunk(prev_tag, tag, prev_type, etype):
+    """Check if a chunk ended between the previous and current word."""
+    if prev_tag in ("B", "I") and tag in ("B", "O"):
+        return True
+    if prev_tag == "E" and tag in ("E", "I", "O"):
+        return True
+    if prev_tag != "O" and prev_tag != "." and prev_type != etype:
+        return True
+    # These chunks are assumed to have length 1
+    if prev_tag in ("[", "]"):
+        return True
+    return False
+
+
+def _start_of_chunk(prev_tag, tag, prev_type, etype):
+    """Check if a chunk started between the previous and current word."""
+    if prev_tag in ("B", "I", "O") and tag == "B":
+        return True
+    if prev_tag == "O" and tag in ("I", "E"):
+        return True
+    if prev_tag == "E" and tag in ("E", "I"):
+        return True
+    if tag != "O" and tag != "." and prev_type != etype:
+        return True
+    # These chunks are assumed to have length 1
+    if tag in ("[", "]"):
+        return True
+    return False
+
+
+def get_chunks(labels):
+    """Find the chunks in a sentence, following the rules of conlleval
+    (e.g. an I that follows an O starts a chunk).
+
+    Args:
+    - labels: list of labels of the tokens in a sentence
+
+    Returns:
+    - list containing a (start offset, end offset, type) tuple for each
+      chunk (the end offset is inclusive)
+
+    """
+    chunks = []
+    beg = 0
+    prev_tag, prev_type = "O", ""
+    # Add an O at the end to catch the last chunk
+    for i, label in enumerate(itertools.chain(labels, ["O"])):
+        tag, etype = _split_label(label)
+        if _end_of_chunk(prev_tag, tag, prev_type, etype):
+            chunks.append((beg, i-1, prev_type))
+        if _start_of_chunk(prev_tag, tag, prev_type, etype):
+            beg = i
+        prev_tag, prev_type = tag, etype
+    return chunks
+
+
+def count_chunks(gold_labels, pred_labels, raw=False, o_tag="O"):
+    """Count gold, predicted and correct chunks, following the rules of
+    conlleval.
+
+    Args:
+    - gold_labels: sequence of gold labels, containing None at sentence boundaries
+    - pred_labels: sequence of predicted labels, containing None at sentence boundaries
+    - raw: if True, labels are raw types, without B- or I- prefix (one word per chunk)
+    - o_tag: outside tag (only used if raw is True)
+
+    Returns:
+    - dict containing the counts (nb_tokens, nb_correct_tags, nb_gold,
+      nb_pred and nb_correct), as well as the number of gold,
+      predicted and correct chunks per type (gold_per_type,
+      pred_per_type and correct_per_type)
+
+    """
+    nb_tokens = 0
+    nb_correct_tags = 0
+    gold_per_type = Counter()
+    pred_per_type = Counter()
+    correct_per_type = Counter()
+    split_cache = {}
+    in_correct = False
+    last_correct, last_correct_type = "O", ""
+    last_guessed, last_guessed_type = "O", ""
+    for gold, pred in zip(gold_labels, pred_labels):
+        is_boundary = gold is None or pred is None
+        if is_boundary:
+            # Sentence breaks are always counted as out of chunk
+            gold = pred = "O"
+        elif raw:
+            gold = "O" if gold == o_tag else gold
+            pred = "O" if pred == o_tag else pred
+            gold = gold if gold == "O" else "B-" + gold
+            pred = pred if pred == "O" else "B-" + pred
+        if gold not in split_cache:
+            split_cache[gold] = _split_label(gold)
+        if pred not in split_cache:
+            split_cache[pred] = _split_label(pred)
+        correct, correct_type = split_cache[gold]
+        guessed, guessed_type = split_cache[pred]
+
+        gold_ends = _end_of_chunk(last_correct, correct, last_correct_type, correct_type)
+        pred_ends = _end_of_chunk(last_guessed, guessed, last_guessed_type, guessed_type)
+        if in_correct:
+            if gold_ends and pred_ends and last_guessed_type == last_correct_type:
+                in_correct = False
+                correct_per_type[last_correct_type] += 1
+            elif gold_ends != pred_ends or guessed_type != correct_type:
+                in_correct = False
+
+        gold_starts = _start_of_chunk(last_correct, correct, last_correct_type, correct_type)
+        pred_starts = _start_of_chunk(last_guessed, guessed, last_guessed_type, guessed_type)
+        if gold_starts and pred_starts and guessed_type == correct_type:
+            in_correct = True
+        if gold_starts:
+            gold_per_type[correct_type] += 1
+        if pred_starts:
+            pred_per_type[guessed_type] += 1
+        if not is_boundary:
+            if correct == guessed and guessed_type == correct_type:
+                nb_correct_tags += 1
+            nb_tokens += 1
+
+        last_correct, last_correct_type = correct, correct_type
+        last_guessed, last_guessed_type = guessed, guessed_type
+    if in_correct:
+        correct_per_type[last_correct_type] += 1
+
+    counts = {"nb_tokens": nb_tokens,
+              "nb_correct_tags": nb_correct_tags,
+              "nb_gold": sum(gold_per_type.values()),
+              "nb_pred": sum(pred_per_type.values()),
+              "nb_correct": sum(correct_per_type.values()),
+              "gold_per_type": gold_per_type,
+              "pred_per_type": pred_per_type,
+              "correct_per_type": correct_per_type}
+    return counts
+
+
+def _compute_prf(nb_gold, nb_pred, nb_correct):
+    """Compute precision, recall and FB1 (as percentages) from chunk
+    counts, the same way conlleval does.
+
+    """
+    precision = 100*nb_correct/nb_pred if nb_pred > 0 else 0.0
+    recall = 100*nb_correct/nb_gold if nb_gold > 0 else 0.0
+    if precision + recall > 0:
+        fb1 = 2*precision*recall/(precision+recall)
+    else:
+        fb1 = 0.0
+    return precision, recall, fb1
+
+
+def get_scores(counts):
+    """Compute scores from the output of count_chunks.
+
+    Args:
+    - counts: dict returned by count_chunks
+
+    Returns:
+    - dict containing the overall counts and scores (accuracy,
+      precision, recall and FB1, as percentages; accuracy is None if
+      there are no tokens), and a dict (types) that maps each chunk
+      type to its counts and scores. This dict is JSON-serializable.
+
+    """
+    p, r, f = _compute_prf(counts["nb_gold"], counts["nb_pred"], counts["nb_correct"])
+    if counts["nb_tokens"] > 0:
+        accuracy = 100*counts["nb_correct_tags"]/counts["nb_tokens"]
+    else:
+        accuracy = None
+    scores = {"nb_tokens": counts["nb_tokens"],
+              "nb_correct_tags": counts["nb_correct_tags"],
+              "nb_gold": counts["nb_gold"],
+              "nb_pred": counts["nb_pred"],
+              "nb_correct": counts["nb_correct"],
+              "accuracy": accuracy,
+              "precision": p,
+              "recall": r,
+              "FB1": f,
+              "types": {}}
+    for etype in sorted(set(counts["gold_per_type"]) | set(counts["pred_per_type"])):
+        nb_gold = counts["gold_per_type"][etype]
+        nb_pred = counts["pred_per_type"][etype]
+        nb_correct = counts["correct_per_type"][etype]
+        p, r, f = _compute_prf(nb_gold, nb_pred, nb_correct)
+        scores["types"][etype] = {"nb_gold": nb_gold,
+                                  "nb_pred": nb_pred,
+                                  "nb_correct": nb_correct,
+                                  "precision": p,
+                                  "recall": r,
+                                  "FB1": f}
+    return scores
+
+
+def evaluate(gold_labels, pred_labels, raw=False, o_tag="O"):
+    """Evaluate predicted labels against gold labels as conlleval
+    does. See count_chunks for the args and get_scores for the
+    output.
+
+    """
+    return get_scores(count_chunks(gold_labels, pred_labels, raw=raw, o_tag=o_tag))
+
+
+def _pad(string, width, left=False):
+    """Pad string with spaces to width, counting bytes (as Perl does)
+    rather than characters.
+
+    """
+    padding = " " * max(0, width - len(string.encode("utf-8", "surrogateescape")))
+    return string + padding if left else padding + string
+
+
+def _byte_key(string):
+    """Sort key that orders strings by their bytes, as Perl does."""
+    return string.encode("utf-8", "surrogateescape")
+
+
+def format_report(scores, latex=False):
+    """Format the scores returned by get_scores the same way conlleval
+    does, or as LaTeX table rows if latex is True.
+
+    """
+    etypes = sorted(scores["types"], key=_byte_key)
+    # conlleval fails to remove the duplicate of the empty type when
+    # it is found in both the gold and predicted chunks
+    if "" in scores["types"] and scores["types"][""]["nb_gold"] and scores["types"][""]["nb_pred"]:
+        etypes.insert(0, "")
+    lines = []
+    if not latex:
+        lines.append("processed {} tokens with {} phrases; ".format(scores["nb_tokens"], scores["nb_gold"]))
+        lines.append("found: {} phrases; correct: {}.\n".format(scores["nb_pred"], scores["nb_correct"]))
+        if scores["nb_tokens"] > 0:
+            lines.append("accuracy: %6.2f%%; " % scores["accuracy"])
+            lines.append("precision: %6.2f%%; " % scores["precision"])
+            lines.append("recall: %6.2f%%; " % scores["recall"])
+            lines.append("FB1: %6.2f\n" % scores["FB1"])
+        for etype in etypes:
+            type_scores = scores["types"][etype]
+            lines.append("{}: ".format(_pad(etype, 17)))
+            lines.append("precision: %6.2f%%; " % type_scores["precision"])
+            lines.append("recall: %6.2f%%; " % type_scores["recall"])
+            lines.append("FB1: %6.2f  %d\n" % (type_scores["FB1"], type_scores["nb_pred"]))
+    else:
+        lines.append("        & Precision &  Recall  & F$_{\\beta=1} \\\\\\hline")
+        for etype in etypes:
+            type_scores = scores["types"][etype]
+            lines.append("\n{} &  %6.2f\\%% & %6.2f\\%% & %6.2f \\\\".format(_pad(etype, 7, left=True))
+                         % (type_scores["precision"], type_scores["recall"], type_scores["FB1"]))
+        lines.append("\\hline\n")
+        lines.append("Overall &  %6.2f\\%% & %6.2f\\%% & %6.2f \\\\\\hline\n"
+                     % (scores["precision"], scores["recall"], scores["FB1"]))
+    return "".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument("-l", "--latex", action="store_true",
+                        help="generate LaTeX output for tables")
+    parser.add_argument("-r", "--raw", action="store_true",
+                        help="accept raw result tags (without B- and I- prefix; assumes one word per chunk)")
+    parser.add_argument("-d", "--delimiter", default=" ",
+                        help="alternative delimiter tag (regex, default is single space)")
+    parser.add_argument("-o", "--otag", default="O",
+                        help="alternative outside tag (default is O)")
+    parser.add_argument("-j", "--json", required=False,
+                        help="(optional) path of a JSON file in which we also write the scores")
+    args = parser.parse_args()
+
+    # Like the Perl script, we process bytes, so we decode the input
+    # without failing on invalid UTF-8 and encode the output the same way
+    stdin = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", errors="surrogateescape", newline="\n")
+    try:
+        gold_labels, pred_labels = read_labels(stdin, delimiter=args.delimiter)
+    except ValueError as err:
+        sys.stderr.write("{}\n".format(err))
+        sys.exit(1)
+    scores = evaluate(gold_labels, pred_labels, raw=args.raw, o_tag=args.otag)
+    sys.stdout.buffer.write(format_report(scores, latex=args.latex).encode("utf-8", "surrogateescape"))
+    sys.stdout.flush()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(scores, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
-import sys, os, argparse
+import sys, os, re, argparse, json
+from collections import namedtuple
+from multiprocessing import Pool
+import numpy as np
 dir_data_utils = os.path.dirname(os.path.realpath(__file__))+"/../data_utils"
 sys.path.append(dir_data_utils)
 from data_utils import get_mentions_from_BIO_file
+from corpus import Corpus, load_corpus, get_shards
 
 doc = """ Analyze errors made by a NER system and write analysis to
 stdout. Input is a text file containing whitespace-separate columns,
@@ -9,292 +13,545 @@ with tokens in the first column, and gold and predicted labels in the
 last 2 columns, and empty lines between sentences. Label encoding can
 be BIO-1 or BIO-2."""
 
-parser = argparse.ArgumentParser(description=doc)
-msg = """Path of input text file (containing whitespace-separate columns, 
-with tokens in the first column, and gold and predicted labels in 
-the last 2 columns). Label encoding can be BIO-1 or BIO-2."""
-parser.add_argument("input", help=msg)
-parser.add_argument("-e", "--encoding", choices=["BIO-1", "BIO-2"], default="BIO-2")
-args = parser.parse_args()
-
-# Load data. We allow labeling inconsistencies in the predicted
-# mentions, but not in the gold mentions.
-gold_mentions = get_mentions_from_BIO_file(args.input, encoding=args.encoding, label_col=-2, ignore_boundaries=False, allow_prefix_errors=False, allow_type_errors=False)
-sys.stdout.write("Nb gold mentions: {}\n".format(len(gold_mentions)))
-pred_mentions = get_mentions_from_BIO_file(args.input, encoding=args.encoding, label_col=-1, ignore_boundaries=False, allow_prefix_errors=True, allow_type_errors=True)
-sys.stdout.write("Nb pred mentions: {}\n".format(len(pred_mentions)))
-
-
-# Remove predicted mentions whose initial label is invalid: if
-# encoding is BIO-1, a mention can only start with a B if it
-# immediately follows another mention; if encoding is BIO-2, a mention
-# must start with a B. Predicted mentions that break these rules are
-# considered invalid. They will not considered false positives, nor
-# partial matches, and we won't check if their type is correct -- they
-# are simply considered invalid mentions.
-if args.encoding == "BIO-1":
-    # Store end offset of all mentions (in case the mentions are not
-    # sorted in the order in which they appear in the dataset for some
-    # reason).
-    end_offsets = set()
-    for (offset, tokens, labels) in pred_mentions:
-        end_offsets.add(offset + len(tokens) - 1)
-
-    # Look for mentions that start with a B but do not immediately
-    # follow another mention.
-    tmp = []
-    prefix_errors = []
-    for (offset, tokens, labels) in pred_mentions:
-        if labels[0][0] == "B" and offset-1 not in end_offsets:
-            prefix_errors.append((offset, tokens, labels))
+# Record of a predicted or gold mention in the analysis. line is the
+# line number of the first token of the mention in the input (starting
+# at 0), and the mentions and types are None if they do not apply to
+# the category (e.g. there is no predicted mention for a false
+# negative). The type of a predicted mention is a list of types if its
+# types are inconsistent.
+ErrorRecord = namedtuple("ErrorRecord", ["category", "line", "gold_mention", "gold_type", "pred_mention", "pred_type"])
+
+CATEGORIES = ["prefix_error", "false_positive", "false_negative", "partial_match",
+              "misclassification", "type_inconsistency", "true_positive"]
+
+
+def _get_overlap_ranges(starts, ends, sorted_starts, sorted_ends):
+    """Given spans (start and end offsets, inclusive) and a list of
+    non-overlapping spans sorted by start offset, find the range of
+    sorted spans that overlap each span.
+
+    Args:
+    - starts: array of start offsets
+    - ends: array of end offsets
+    - sorted_starts: sorted array of start offsets of non-overlapping spans
+    - sorted_ends: array of corresponding end offsets
+
+    Returns:
+    - lo, hi: arrays such that the sorted spans that overlap span i are
+      those in range(lo[i], hi[i]) (empty if hi[i] <= lo[i])
+
+    """
+    lo = np.searchsorted(sorted_ends, starts, side="left")
+    hi = np.searchsorted(sorted_starts, ends, side="right")
+    return lo, hi
+
+
+def analyze_corpus(corpus, encoding):
+    """Analyze errors in a Corpus (or file) containing gold and
+    predicted labels in the last 2 columns.
+
+    Args:
+    - corpus: Corpus or path
+    - encoding: BIO-1 or BIO-2
+
+    Returns:
+    - dict containing the gold and predicted mentions, the invalid
+      predicted mentions (prefix_errors), and the lists of errors,
+      which contain indices in the lists of mentions
+
+    """
+    # Load data. We allow labeling inconsistencies in the predicted
+    # mentions, but not in the gold mentions.
+    corpus = load_corpus(corpus)
+    gold_mentions = get_mentions_from_BIO_file(corpus, encoding=encoding, label_col=-2, ignore_boundaries=False, allow_prefix_errors=False, allow_type_errors=False)
+    pred_mentions = get_mentions_from_BIO_file(corpus, encoding=encoding, label_col=-1, ignore_boundaries=False, allow_prefix_errors=True, allow_type_errors=True)
+    nb_pred_found = len(pred_mentions)
+
+    # Remove predicted mentions whose initial label is invalid: if
+    # encoding is BIO-1, a mention can only start with a B if it
+    # immediately follows another mention; if encoding is BIO-2, a mention
+    # must start with a B. Predicted mentions that break these rules are
+    # considered invalid. They will not considered false positives, nor
+    # partial matches, and we won't check if their type is correct -- they
+    # are simply considered invalid mentions.
+    if encoding == "BIO-1":
+        # Store end offset of all mentions (in case the mentions are not
+        # sorted in the order in which they appear in the dataset for some
+        # reason).
+        end_offsets = set()
+        for (offset, tokens, labels) in pred_mentions:
+            end_offsets.add(offset + len(tokens) - 1)
+
+        # Look for mentions that start with a B but do not immediately
+        # follow another mention.
+        tmp = []
+        prefix_errors = []
+        for (offset, tokens, labels) in pred_mentions:
+            if labels[0][0] == "B" and offset-1 not in end_offsets:
+                prefix_errors.append((offset, tokens, labels))
+            else:
+                tmp.append((offset, tokens, labels))
+        pred_mentions = tmp
+    elif encoding == "BIO-2":
+        # Look for mentions that don't start with a B
+        tmp = []
+        prefix_errors = []
+        for (offset, tokens, labels) in pred_mentions:
+            if labels[0][0] != "B":
+                prefix_errors.append((offset, tokens, labels))
+            else:
+                tmp.append((offset, tokens, labels))
+        pred_mentions = tmp
+
+    # Process gold mentions : join tokens, replace labels with a unique
+    # entity type. Keep the span of each mention (start and end
+    # offsets, inclusive) in arrays, so that we can match gold and
+    # predicted mentions without splitting the joined tokens again.
+    gold_starts = np.zeros(len(gold_mentions), dtype=np.int64)
+    gold_ends = np.zeros(len(gold_mentions), dtype=np.int64)
+    for i in range(len(gold_mentions)):
+        (offset, tokens, labels) = gold_mentions[i]
+        gold_starts[i] = offset
+        gold_ends[i] = offset + len(tokens) - 1
+        mention = " ".join(tokens)
+        etype = labels[0][2:]
+        gold_mentions[i] = (offset, mention, etype)
+
+    # Process predicted mentions: join tokens, replace labels with a
+    # unique entity type. If types are inconsistent, leave list of types
+    # instead of a unique type. Given the way the function
+    # get_mentions_from_BIO_file works, this should only happen if the
+    # encoding is BIO-2 -- see function documentation.
+    pred_starts = np.zeros(len(pred_mentions), dtype=np.int64)
+    pred_ends = np.zeros(len(pred_mentions), dtype=np.int64)
+    for i in range(len(pred_mentions)):
+        (offset, tokens, labels) = pred_mentions[i]
+        pred_starts[i] = offset
+        pred_ends[i] = offset + len(tokens) - 1
+        mention = " ".join(tokens)
+        etypes = [label[2:] for label in labels]
+        if len(set(etypes)) == 1:
+            pred_mentions[i] = (offset, mention, etypes[0])
         else:
-            tmp.append((offset, tokens, labels))
-    pred_mentions = tmp
-elif args.encoding == "BIO-2":
-    # Look for mentions that don't start with a B
-    tmp = []
-    prefix_errors = []
-    for (offset, tokens, labels) in pred_mentions:
-        if labels[0][0] != "B":
-            prefix_errors.append((offset, tokens, labels))
+            if encoding == "BIO-1":
+                msg = "Inconsistent types should only happen if encoding is BIO-2. Check code."
+                raise ValueError(msg)
+            pred_mentions[i] = (offset, mention, etypes)
+
+    # Find the range of predicted mentions that overlap each gold
+    # mention, and vice versa. The mentions in each list do not overlap
+    # one another, so once sorted by start offset, their end offsets
+    # are sorted too, and the mentions overlapping a given span form a
+    # contiguous range, which we find by binary search.
+    pred_order = np.argsort(pred_starts, kind="stable")
+    gold_order = np.argsort(gold_starts, kind="stable")
+    gold_hit_lo, gold_hit_hi = _get_overlap_ranges(gold_starts, gold_ends, pred_starts[pred_order], pred_ends[pred_order])
+    pred_hit_lo, pred_hit_hi = _get_overlap_ranges(pred_starts, pred_ends, gold_starts[gold_order], gold_ends[gold_order])
+
+    # Go through gold mentions and look for the following:
+    # - true positives (correct span and type)
+    # - misclassifications (correct span but incorrect type)
+    # - partial matches (partially overlapping spans)
+    # - false negatives (no predicted mention in span)
+    true_positives = []
+    misclassifications = []
+    partial_matches = []
+    false_negatives = []
+    for gold_ix in range(len(gold_mentions)):
+        # Sort hits so that the order of the partial matches does not
+        # depend on the order of the spans
+        hits = sorted(pred_order[gold_hit_lo[gold_ix]:gold_hit_hi[gold_ix]].tolist())
+        if len(hits) == 0:
+            # We have a false negative
+            false_negatives.append(gold_ix)
+        elif len(hits) > 1:
+            # We have multiple partial matches (multiple predicted
+            # mentions whose span partially overlap that of this gold
+            # mention).
+            for pred_ix in hits:
+                partial_matches.append((gold_ix, pred_ix))
         else:
-            tmp.append((offset, tokens, labels))
-    pred_mentions = tmp
-
-# Process gold mentions : join tokens, replace labels with a unique
-# entity type
-for i in range(len(gold_mentions)):
-    (offset, tokens, labels) = gold_mentions[i]
-    mention = " ".join(tokens)
-    etype = labels[0][2:]
-    gold_mentions[i] = (offset, mention, etype)
-
-# Process predicted mentions: join tokens, replace labels with a
-# unique entity type. If types are inconsistent, leave list of types
-# instead of a unique type. Given the way the function
-# get_mentions_from_BIO_file works, this should only happen if the
-# encoding is BIO-2 -- see function documentation.
-for i in range(len(pred_mentions)):
-    (offset, tokens, labels) = pred_mentions[i]
-    mention = " ".join(tokens)
-    etypes = [label[2:] for label in labels]
-    if len(set(etypes)) == 1:
-        pred_mentions[i] = (offset, mention, etypes[0])
-    else:
-        if args.encoding == "BIO-1":
-            msg = "Inconsistent types should only happen if encoding is BIO-2. Check code."
-            raise ValueError(msg)
-        pred_mentions[i] = (offset, mention, etypes)
-
-# Map offsets of predicted mentions to index in list of predicted mentions
-offset_to_pred_mention_ix = {}
-for i in range(len(pred_mentions)):
-    (offset, mention, etype) = pred_mentions[i]
-    mention_size = len(mention.split())
-    for j in range(mention_size):
-        offset_to_pred_mention_ix[offset+j] = i
-
-# Do same with gold mentions
-offset_to_gold_mention_ix = {}
-for i in range(len(gold_mentions)):
-    (offset, mention, etype) = gold_mentions[i]
-    mention_size = len(mention.split())
-    for j in range(mention_size):
-        offset_to_gold_mention_ix[offset+j] = i
-
-# Go through gold mentions and look for the following:
-# - true positives (correct span and type)
-# - misclassifications (correct span but incorrect type)
-# - partial matches (partially overlapping spans)
-# - false negatives (no predicted mention in span)
-true_positives = []
-misclassifications = []
-partial_matches = []
-false_negatives = []
-for gold_ix in range(len(gold_mentions)):
-    (offset, mention, etype) = gold_mentions[gold_ix]
-    mention_size = len(mention.split())
-    hits = set()
-    for i in range(mention_size):
-        if offset+i in offset_to_pred_mention_ix:
-            hits.add(offset_to_pred_mention_ix[offset+i])
-    if len(hits) == 0:
-        # We have a false negative
-        false_negatives.append(gold_ix)
-    elif len(hits) > 1:
-        # We have multiple partial matches (multiple predicted
-        # mentions whose span partially overlap that of this gold
-        # mention).
-        for pred_ix in hits:
-            partial_matches.append((gold_ix, pred_ix))
-    else:
-        # We have one match, either partial or exact
-        pred_ix = list(hits)[0]
-        pred_offset, pred_mention, pred_etype = pred_mentions[pred_ix]
-        pred_mention_size = len(pred_mention.split())
-        if pred_offset == offset and pred_mention_size == mention_size:
-            # We have an exact match. Check type.
-            if etype == pred_etype:
-                true_positives.append((gold_ix, pred_ix))
+            # We have one match, either partial or exact
+            pred_ix = hits[0]
+            if pred_starts[pred_ix] == gold_starts[gold_ix] and pred_ends[pred_ix] == gold_ends[gold_ix]:
+                # We have an exact match. Check type.
+                etype = gold_mentions[gold_ix][2]
+                pred_etype = pred_mentions[pred_ix][2]
+                if etype == pred_etype:
+                    true_positives.append((gold_ix, pred_ix))
+                else:
+                    misclassifications.append((gold_ix, pred_ix))
             else:
-                misclassifications.append((gold_ix, pred_ix))                    
-        else:
-            # We have a partial match
-            partial_matches.append((gold_ix, pred_ix))
-
-# Count partially matching predicted mentions and partially matched
-# gold mentions (these numbers can be different).
-nb_partial_gold = len(set(g for g,p in partial_matches))
-nb_partial_pred = len(set(p for g,p in partial_matches))
-
-# Now go through predicted mentions and look for: 
-# - false positives (no gold mention in span of a predicted mention)
-# - type inconsistencies (more than one entity type within a predicted
-# mention). Given the way the function get_mentions_from_BIO_file
-# works, this should only happen if the encoding is BIO-2 -- see
-# function documentation. If the encoding is BIO-1, we already
-# enforced that there are no type inconsistencies above. Note that if
-# we find type inconsistencies, some of them may have already been
-# identified as misclassifications (if their span matched that of a
-# gold mention), but we want to show all the cases where a predicted
-# mention has inconsistent entity types.
-false_positives = []
-type_inconsistencies = []
-for pred_ix in range(len(pred_mentions)):
-    (offset, mention, etype) = pred_mentions[pred_ix]
-    if type(etype) == list:
-        # We have a type inconsistency
-        type_inconsistencies.append(pred_ix)
-    mention_size = len(mention.split())
-    match_found = False
-    for i in range(mention_size):
-        if offset+i in offset_to_gold_mention_ix:
-            match_found = True
-            break
-    if not match_found:
-        # We have a false positive
-        false_positives.append(pred_ix)
-
-# Check if the numbers add up
-nb_gold_mentions = len(gold_mentions)
-nb_gold_classified = len(true_positives) + len(misclassifications)
-nb_gold_classified += nb_partial_gold + len(false_negatives)
-if nb_gold_mentions != nb_gold_classified:
-    msg = "ERROR: numbers do not add up. Check the code."
-    raise ValueError(msg)
-nb_pred_mentions = len(pred_mentions)
-# Add the invalid predicted mentions
-nb_pred_mentions += len(prefix_errors)
-nb_pred_classified = len(prefix_errors) + len(true_positives) + len(misclassifications)
-nb_pred_classified += nb_partial_pred + len(false_positives)
-if nb_pred_mentions != nb_pred_classified:
-    msg = "ERROR: numbers do not add up. Check the code."
-    raise ValueError(msg)
-        
-
-################### Print all errors ##########################
-
-m = "INVALID PREDICTED MENTIONS (mentions with invalid initial prefix):"
-sys.stdout.write("\n" + m + "\n")
-if len(prefix_errors):
-    for (offset, tokens, labels) in prefix_errors:
-        sys.stdout.write("Line {}: '{}' --> {}\n".format(offset, " ".join(tokens), labels))
-else:
-    sys.stdout.write("[NONE]\n")
-
-m = "FALSE POSITIVES (predicted mentions that do not overlap a gold mention):"
-sys.stdout.write("\n" + m + "\n")
-if len(false_positives):
-    for ix in false_positives:
+                # We have a partial match
+                partial_matches.append((gold_ix, pred_ix))
+
+    # Count partially matching predicted mentions and partially matched
+    # gold mentions (these numbers can be different).
+    nb_partial_gold = len(set(g for g,p in partial_matches))
+    nb_partial_pred = len(set(p for g,p in partial_matches))
+
+    # Now go through predicted mentions and look for: 
+    # - false positives (no gold mention in span of a predicted mention)
+    # - type inconsistencies (more than one entity type within a predicted
+    # mention). Given the way the function get_mentions_from_BIO_file
+    # works, this should only happen if the encoding is BIO-2 -- see
+    # function documentation. If the encoding is BIO-1, we already
+    # enforced that there are no type inconsistencies above. Note that if
+    # we find type inconsistencies, some of them may have already been
+    # identified as misclassifications (if their span matched that of a
+    # gold mention), but we want to show all the cases where a predicted
+    # mention has inconsistent entity types.
+    false_positives = np.flatnonzero(pred_hit_hi <= pred_hit_lo).tolist()
+    type_inconsistencies = [pred_ix for pred_ix in range(len(pred_mentions)) if type(pred_mentions[pred_ix][2]) == list]
+
+    # Check if the numbers add up
+    nb_gold_mentions = len(gold_mentions)
+    nb_gold_classified = len(true_positives) + len(misclassifications)
+    nb_gold_classified += nb_partial_gold + len(false_negatives)
+    if nb_gold_mentions != nb_gold_classified:
+        msg = "ERROR: numbers do not add up. Check the code."
+        raise ValueError(msg)
+    nb_pred_mentions = len(pred_mentions)
+    # Add the invalid predicted mentions
+    nb_pred_mentions += len(prefix_errors)
+    nb_pred_classified = len(prefix_errors) + len(true_positives) + len(misclassifications)
+    nb_pred_classified += nb_partial_pred + len(false_positives)
+    if nb_pred_mentions != nb_pred_classified:
+        msg = "ERROR: numbers do not add up. Check the code."
+        raise ValueError(msg)
+
+    results = {"gold_mentions": gold_mentions,
+               "pred_mentions": pred_mentions,
+               "nb_pred_found": nb_pred_found,
+               "prefix_errors": prefix_errors,
+               "true_positives": true_positives,
+               "misclassifications": misclassifications,
+               "partial_matches": partial_matches,
+               "false_negatives": false_negatives,
+               "false_positives": false_positives,
+               "type_inconsistencies": type_inconsistencies}
+    return results
+
+
+def _analyze_shard(task):
+    """Analyze errors in a range of bytes of a file (see get_shards).
+    Return results (with line numbers relative to the start of the
+    range), number of lines in the range, and the message of the
+    ValueError raised while analyzing the range (None if there was no
+    error, otherwise the results are None).
+
+    """
+    path, byte_range, encoding = task
+    corpus = Corpus.from_file(path, byte_range=byte_range)
+    try:
+        return analyze_corpus(corpus, encoding), corpus.nb_lines, None
+    except ValueError as err:
+        return None, corpus.nb_lines, str(err)
+
+
+def merge_results(shard_results):
+    """Merge the results of analyze_corpus on consecutive shards of a
+    file. Line numbers and indices of mentions are shifted so that the
+    merged results are the same as if the whole file had been analyzed
+    at once. If the analysis of a shard raised an error, we raise the
+    error of the first such shard, with line numbers shifted the same
+    way.
+
+    Args:
+    - shard_results: list of (results, nb lines in shard, error
+      message) tuples (see _analyze_shard), in the order in which the
+      shards appear in the file
+
+    Returns:
+    - merged results
+
+    """
+    merged = {"nb_pred_found": 0}
+    for key in ["gold_mentions", "pred_mentions", "prefix_errors", "true_positives",
+                "misclassifications", "partial_matches", "false_negatives",
+                "false_positives", "type_inconsistencies"]:
+        merged[key] = []
+    line_shift = 0
+    for results, nb_lines, error in shard_results:
+        if error is not None:
+            msg = re.sub(r"at line (\d+)", lambda m: "at line {}".format(int(m.group(1))+line_shift), error)
+            raise ValueError(msg)
+        gold_shift = len(merged["gold_mentions"])
+        pred_shift = len(merged["pred_mentions"])
+        for key in ["gold_mentions", "pred_mentions", "prefix_errors"]:
+            merged[key] += [(offset+line_shift, x, y) for (offset, x, y) in results[key]]
+        for key in ["true_positives", "misclassifications", "partial_matches"]:
+            merged[key] += [(g+gold_shift, p+pred_shift) for (g, p) in results[key]]
+        merged["false_negatives"] += [g+gold_shift for g in results["false_negatives"]]
+        for key in ["false_positives", "type_inconsistencies"]:
+            merged[key] += [p+pred_shift for p in results[key]]
+        merged["nb_pred_found"] += results["nb_pred_found"]
+        line_shift += nb_lines
+    return merged
+
+
+def get_error_records(results):
+    """Get records of the errors (and true positives) in the results
+    returned by analyze_corpus.
+
+    Args:
+    - results: dict returned by analyze_corpus (or merge_results)
+
+    Returns:
+    - list of ErrorRecord, grouped by category, in the order of
+      CATEGORIES
+
+    """
+    gold_mentions = results["gold_mentions"]
+    pred_mentions = results["pred_mentions"]
+    records = []
+    for (offset, tokens, labels) in results["prefix_errors"]:
+        etypes = [label[2:] for label in labels]
+        etype = etypes[0] if len(set(etypes)) == 1 else etypes
+        records.append(ErrorRecord("prefix_error", offset, None, None, " ".join(tokens), etype))
+    for ix in results["false_positives"]:
         offset, mention, etype = pred_mentions[ix]
-        sys.stdout.write("Line {}: '{}' ({})\n".format(offset, mention, etype))
-else:
-    sys.stdout.write("[NONE]\n")
-
-m = "FALSE NEGATIVES (gold mentions that do not overlap a predicted mention):"    
-sys.stdout.write("\n" + m + "\n")
-if len(false_negatives):
-    for ix in false_negatives:
+        records.append(ErrorRecord("false_positive", offset, None, None, mention, etype))
+    for ix in results["false_negatives"]:
         offset, mention, etype = gold_mentions[ix]
-        sys.stdout.write("Line {}: '{}' ({})\n".format(offset, mention, etype))
-else:
-    sys.stdout.write("[NONE]\n")
-
-m = "PARTIAL MATCHES (partial overlap between gold and predicted mentions):"
-sys.stdout.write("\n" + m + "\n")
-if len(partial_matches):
-    for (gold_ix, pred_ix) in partial_matches:
-        gold_offset, gold_mention, gold_etype = gold_mentions[gold_ix]
-        pred_offset, pred_mention, pred_etype = pred_mentions[pred_ix]
-        msg = "Line {}: ".format(gold_offset)
-        msg += "Gold mention '{}' ({}) --> ".format(gold_mention, gold_etype)
-        msg += "'{}' ({})".format(pred_mention, pred_etype)
-        sys.stdout.write(msg+ "\n")
-else:
-    sys.stdout.write("[NONE]\n")
-   
-m = "MISCLASSIFICATIONS (correct span, but incorrect type):"
-sys.stdout.write("\n" + m + "\n")
-if len(misclassifications):
-    for (gold_ix, pred_ix) in misclassifications:
+        records.append(ErrorRecord("false_negative", offset, mention, etype, None, None))
+    for category, key in [("partial_match", "partial_matches"),
+                          ("misclassification", "misclassifications")]:
+        for (gold_ix, pred_ix) in results[key]:
+            gold_offset, gold_mention, gold_etype = gold_mentions[gold_ix]
+            pred_offset, pred_mention, pred_etype = pred_mentions[pred_ix]
+            records.append(ErrorRecord(category, gold_offset, gold_mention, gold_etype, pred_mention, pred_etype))
+    for ix in results["type_inconsistencies"]:
+        offset, mention, etype = pred_mentions[ix]
+        records.append(ErrorRecord("type_inconsistency", offset, None, None, mention, etype))
+    for (gold_ix, pred_ix) in results["true_positives"]:
         gold_offset, gold_mention, gold_etype = gold_mentions[gold_ix]
         pred_offset, pred_mention, pred_etype = pred_mentions[pred_ix]
-        # Check if misclassification is due to inconsistent entity
-        # types in the predicted mention
-        if type(pred_etype) == list:
-            msg = "Line {}: ".format(pred_offset)
-            msg += "Predicted mention '{}' ".format(pred_mention)
-            msg += "has correct span, but inconsistent types {}".format(pred_etype)
-        else:
+        records.append(ErrorRecord("true_positive", gold_offset, gold_mention, gold_etype, pred_mention, pred_etype))
+    return records
+
+
+def get_error_counts(results):
+    """Count errors in the results returned by analyze_corpus.
+
+    Args:
+    - results: dict returned by analyze_corpus (or merge_results)
+
+    Returns:
+    - dict mapping names of counts to ints. Partial matches are counted
+      both on the gold side (partially matched gold mentions) and on
+      the predicted side (partially matching predicted mentions).
+
+    """
+    partial_matches = results["partial_matches"]
+    counts = {"gold_mentions": len(results["gold_mentions"]),
+              "pred_mentions": len(results["pred_mentions"]) + len(results["prefix_errors"]),
+              "true_positives": len(results["true_positives"]),
+              "misclassifications": len(results["misclassifications"]),
+              "partially_matched_gold": len(set(g for g,p in partial_matches)),
+              "partially_matching_pred": len(set(p for g,p in partial_matches)),
+              "false_negatives": len(results["false_negatives"]),
+              "false_positives": len(results["false_positives"]),
+              "prefix_errors": len(results["prefix_errors"]),
+              "type_inconsistencies": len(results["type_inconsistencies"])}
+    return counts
+
+
+def analyze_errors(gold_labels, pred_labels, encoding="BIO-2", tokens=None):
+    """Analyze errors made by a NER system.
+
+    Args:
+    - gold_labels: list of sentences, each a list of gold labels
+    - pred_labels: list of sentences, each a list of predicted labels
+    - encoding: BIO-1 or BIO-2
+    - tokens: (optional) list of sentences, each a list of tokens,
+      used for the text of the mentions
+
+    Returns:
+    - list of ErrorRecord (see get_error_records). Line numbers are
+      those the mentions would have in a file containing one token
+      per line and an empty line after each sentence.
+    - dict of counts (see get_error_counts)
+
+    """
+    if len(gold_labels) != len(pred_labels):
+        msg = "Nb gold sentences ({}) != nb predicted sentences ({})".format(len(gold_labels), len(pred_labels))
+        raise ValueError(msg)
+    rows = []
+    for i in range(len(gold_labels)):
+        gold = gold_labels[i]
+        pred = pred_labels[i]
+        sent_tokens = tokens[i] if tokens is not None else ["_"] * len(gold)
+        if len(gold) != len(pred) or len(gold) != len(sent_tokens):
+            msg = "Lengths of sentence {} do not match".format(i)
+            raise ValueError(msg)
+        rows += [[token, g, p] for (token, g, p) in zip(sent_tokens, gold, pred)]
+        rows.append([])
+    results = analyze_corpus(Corpus.from_rows(rows), encoding)
+    return get_error_records(results), get_error_counts(results)
+
+
+def write_jsonl(results, f):
+    """Write error records returned by analyze_corpus to a file object in
+    JSON Lines format: one object per ErrorRecord, followed by an
+    object containing the counts (under the key "counts").
+
+    """
+    for record in get_error_records(results):
+        f.write(json.dumps(record._asdict()) + "\n")
+    f.write(json.dumps({"counts": get_error_counts(results)}) + "\n")
+
+
+def write_analysis(results, encoding):
+    """Write analysis of errors returned by analyze_corpus to stdout."""
+    gold_mentions = results["gold_mentions"]
+    pred_mentions = results["pred_mentions"]
+    prefix_errors = results["prefix_errors"]
+    true_positives = results["true_positives"]
+    misclassifications = results["misclassifications"]
+    partial_matches = results["partial_matches"]
+    false_negatives = results["false_negatives"]
+    false_positives = results["false_positives"]
+    type_inconsistencies = results["type_inconsistencies"]
+    nb_partial_gold = len(set(g for g,p in partial_matches))
+    nb_partial_pred = len(set(p for g,p in partial_matches))
+    nb_gold_mentions = len(gold_mentions)
+    nb_pred_mentions = len(pred_mentions) + len(prefix_errors)
+    sys.stdout.write("Nb gold mentions: {}\n".format(nb_gold_mentions))
+    sys.stdout.write("Nb pred mentions: {}\n".format(results["nb_pred_found"]))
+
+    ################### Print all errors ##########################
+
+    m = "INVALID PREDICTED MENTIONS (mentions with invalid initial prefix):"
+    sys.stdout.write("\n" + m + "\n")
+    if len(prefix_errors):
+        for (offset, tokens, labels) in prefix_errors:
+            sys.stdout.write("Line {}: '{}' --> {}\n".format(offset, " ".join(tokens), labels))
+    else:
+        sys.stdout.write("[NONE]\n")
+
+    m = "FALSE POSITIVES (predicted mentions that do not overlap a gold mention):"
+    sys.stdout.write("\n" + m + "\n")
+    if len(false_positives):
+        for ix in false_positives:
+            offset, mention, etype = pred_mentions[ix]
+            sys.stdout.write("Line {}: '{}' ({})\n".format(offset, mention, etype))
+    else:
+        sys.stdout.write("[NONE]\n")
+
+    m = "FALSE NEGATIVES (gold mentions that do not overlap a predicted mention):"    
+    sys.stdout.write("\n" + m + "\n")
+    if len(false_negatives):
+        for ix in false_negatives:
+            offset, mention, etype = gold_mentions[ix]
+            sys.stdout.write("Line {}: '{}' ({})\n".format(offset, mention, etype))
+    else:
+        sys.stdout.write("[NONE]\n")
+
+    m = "PARTIAL MATCHES (partial overlap between gold and predicted mentions):"
+    sys.stdout.write("\n" + m + "\n")
+    if len(partial_matches):
+        for (gold_ix, pred_ix) in partial_matches:
+            gold_offset, gold_mention, gold_etype = gold_mentions[gold_ix]
+            pred_offset, pred_mention, pred_etype = pred_mentions[pred_ix]
             msg = "Line {}: ".format(gold_offset)
-            msg += "Gold mention '{}' is a {} ".format(gold_mention, gold_etype)
-            msg += "not a {}".format(pred_etype)
-        sys.stdout.write(msg+"\n")
-else:
-    sys.stdout.write("[NONE]\n")
-
-if args.encoding == "BIO-2":
-    m = "TYPE INCONSISTENCIES (predicted mentions with inconsistent "
-    m += "entity types, ignoring span):"
+            msg += "Gold mention '{}' ({}) --> ".format(gold_mention, gold_etype)
+            msg += "'{}' ({})".format(pred_mention, pred_etype)
+            sys.stdout.write(msg+ "\n")
+    else:
+        sys.stdout.write("[NONE]\n")
+
+    m = "MISCLASSIFICATIONS (correct span, but incorrect type):"
     sys.stdout.write("\n" + m + "\n")
-    if len(type_inconsistencies):
-        for (pred_ix) in type_inconsistencies:
+    if len(misclassifications):
+        for (gold_ix, pred_ix) in misclassifications:
+            gold_offset, gold_mention, gold_etype = gold_mentions[gold_ix]
             pred_offset, pred_mention, pred_etype = pred_mentions[pred_ix]
-            msg = "Line {}: ".format(pred_offset)
-            msg += "Predicted mention '{}' has types {}".format(pred_mention, pred_etype)
+            # Check if misclassification is due to inconsistent entity
+            # types in the predicted mention
+            if type(pred_etype) == list:
+                msg = "Line {}: ".format(pred_offset)
+                msg += "Predicted mention '{}' ".format(pred_mention)
+                msg += "has correct span, but inconsistent types {}".format(pred_etype)
+            else:
+                msg = "Line {}: ".format(gold_offset)
+                msg += "Gold mention '{}' is a {} ".format(gold_mention, gold_etype)
+                msg += "not a {}".format(pred_etype)
             sys.stdout.write(msg+"\n")
     else:
         sys.stdout.write("[NONE]\n")
 
-    
-################# Print summary of errors ######################
-
-sys.stdout.write("\n------------------\n-----SUMMARY------\n------------------\n")
-sys.stdout.write("Gold mentions\n")
-sys.stdout.write("------------------\n")
-width = len(str(nb_gold_mentions))
-sys.stdout.write("  {: >{}} true positives\n".format(len(true_positives), width))
-msg = "+ {: >{}} misclassifications".format(len(misclassifications), width)
-if args.encoding == "BIO-2":
-    msg += " (includes type inconsistencies assuming span is correct)"
-sys.stdout.write(msg+"\n")
-sys.stdout.write("+ {: >{}} partially matched\n".format(nb_partial_gold, width))
-sys.stdout.write("+ {: >{}} false negatives\n".format(len(false_negatives), width))
-sys.stdout.write("= {: >{}} total gold mentions\n".format(len(gold_mentions), width))
-sys.stdout.write("------------------\n")
-sys.stdout.write("Predicted mentions\n")
-sys.stdout.write("------------------\n")
-width = len(str(nb_pred_mentions))
-sys.stdout.write("  {: >{}} true positives\n".format(len(true_positives), width))
-msg = "+ {: >{}} misclassifications".format(len(misclassifications), width)
-if args.encoding == "BIO-2":
-    msg += " (includes type inconsistencies assuming span is correct)"
-sys.stdout.write(msg+"\n")
-sys.stdout.write("+ {: >{}} partially matching\n".format(nb_partial_pred, width))
-sys.stdout.write("+ {: >{}} false positives\n".format(len(false_positives), width))
-sys.stdout.write("+ {: >{}} invalid mentions (prefix errors)\n".format(len(prefix_errors), width))
-msg = "= {: >{}} total predicted mentions".format(nb_pred_mentions, width)
-sys.stdout.write(msg+"\n")
-sys.stdout.write("------------------\n")      
-
-            
+    if encoding == "BIO-2":
+        m = "TYPE INCONSISTENCIES (predicted mentions with inconsistent "
+        m += "entity types, ignoring span):"
+        sys.stdout.write("\n" + m + "\n")
+        if len(type_inconsistencies):
+            for (pred_ix) in type_inconsistencies:
+                pred_offset, pred_mention, pred_etype = pred_mentions[pred_ix]
+                msg = "Line {}: ".format(pred_offset)
+                msg += "Predicted mention '{}' has types {}".format(pred_mention, pred_etype)
+                sys.stdout.write(msg+"\n")
+        else:
+            sys.stdout.write("[NONE]\n")
+
+
+    ################# Print summary of errors ######################
+
+    sys.stdout.write("\n------------------\n-----SUMMARY------\n------------------\n")
+    sys.stdout.write("Gold mentions\n")
+    sys.stdout.write("------------------\n")
+    width = len(str(nb_gold_mentions))
+    sys.stdout.write("  {: >{}} true positives\n".format(len(true_positives), width))
+    msg = "+ {: >{}} misclassifications".format(len(misclassifications), width)
+    if encoding == "BIO-2":
+        msg += " (includes type inconsistencies assuming span is correct)"
+    sys.stdout.write(msg+"\n")
+    sys.stdout.write("+ {: >{}} partially matched\n".format(nb_partial_gold, width))
+    sys.stdout.write("+ {: >{}} false negatives\n".format(len(false_negatives), width))
+    sys.stdout.write("= {: >{}} total gold mentions\n".format(len(gold_mentions), width))
+    sys.stdout.write("------------------\n")
+    sys.stdout.write("Predicted mentions\n")
+    sys.stdout.write("------------------\n")
+    width = len(str(nb_pred_mentions))
+    sys.stdout.write("  {: >{}} true positives\n".format(len(true_positives), width))
+    msg = "+ {: >{}} misclassifications".format(len(misclassifications), width)
+    if encoding == "BIO-2":
+        msg += " (includes type inconsistencies assuming span is correct)"
+    sys.stdout.write(msg+"\n")
+    sys.stdout.write("+ {: >{}} partially matching\n".format(nb_partial_pred, width))
+    sys.stdout.write("+ {: >{}} false positives\n".format(len(false_positives), width))
+    sys.stdout.write("+ {: >{}} invalid mentions (prefix errors)\n".format(len(prefix_errors), width))
+    msg = "= {: >{}} total predicted mentions".format(nb_pred_mentions, width)
+    sys.stdout.write(msg+"\n")
+    sys.stdout.write("------------------\n")      
+
+
+def main():
+    parser = argparse.ArgumentParser(description=doc)
+    msg = """Path of input text file (containing whitespace-separate columns, 
+    with tokens in the first column, and gold and predicted labels in 
+    the last 2 columns). Label encoding can be BIO-1 or BIO-2."""
+    parser.add_argument("input", help=msg)
+    parser.add_argument("-e", "--encoding", choices=["BIO-1", "BIO-2"], default="BIO-2")
+    msg = ("Number of worker processes. If greater than 1, the input file is "
+           "split into shards (on sentence boundaries), which are analyzed in parallel.")
+    parser.add_argument("-n", "--workers", type=int, default=1, help=msg)
+    msg = ("Output format: a report in plain text, or JSON Lines (one object per "
+           "error or true positive, then an object containing the counts)")
+    parser.add_argument("-f", "--format", choices=["text", "jsonl"], default="text", help=msg)
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        tasks = [(args.input, byte_range, args.encoding) for byte_range in get_shards(args.input, args.workers)]
+        with Pool(args.workers) as pool:
+            results = merge_results(pool.map(_analyze_shard, tasks))
+    else:
+        results = analyze_corpus(args.input, args.encoding)
+    if args.format == "jsonl":
+        write_jsonl(results, sys.stdout)
+    else:
+        write_analysis(results, args.encoding)
+
+
+if __name__ == "__main__":
+    main()
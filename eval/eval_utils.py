@@ -1,5 +1,11 @@
+import os, sys
 import numpy as np
+from multiprocessing import Pool
 from math import log
+dir_data_utils = os.path.dirname(os.path.realpath(__file__))+"/../data_utils"
+sys.path.append(dir_data_utils)
+from corpus import Corpus
+from conlleval import get_chunks
 
 def get_column_from_file(path, col_ix, split_on_empty=False):
     """Given the path of a text file containing whitespace-separated
@@ -9,7 +15,18 @@ def get_column_from_file(path, col_ix, split_on_empty=False):
     If split_on_empty is True, then split on empty lines and return a
     list of the sub-lists found between empty lines.
 
+    path can also be a Corpus, in which case the file is not read
+    again.
+
     """
+    if isinstance(path, Corpus):
+        column = path.get_column(col_ix)
+        if split_on_empty:
+            return [column[start:stop] for (start, stop) in path.get_sent_bounds()]
+        values = [None] * path.nb_lines
+        for line_num, value in zip(path.get_line_nums().tolist(), column):
+            values[line_num] = value
+        return values
     values = []
     with open(path) as f:
         for line in f:
@@ -86,22 +103,57 @@ def get_bilou_mention_offsets(labels):
     return offsets
 
 
+def get_bio2_to_bilou_table(labels):
+    """ Given a list of distinct BIO-2 labels (indexed by id), return the
+    list of BILOU labels (indexed by id), and a lookup table (nb
+    labels, 4) that maps the id of the first label of a mention and
+    the position of a token in the mention (0: B, 1: I, 2: L, 3: U) to
+    the id of the BILOU label of that token. The id of O is 0. As in
+    get_bio2_mention_offsets, the prefix of a label is its first
+    character, and its entity type is what follows the separator, so a
+    label such as "B-" starts a mention whose entity type is empty. """
+    etype_to_id = {}
+    table = np.zeros((len(labels), 4), dtype=np.int64)
+    for label_id, label in enumerate(labels):
+        if label[:1] == "B":
+            type_id = etype_to_id.setdefault(label[2:], len(etype_to_id))
+            table[label_id] = 1 + 4 * type_id + np.arange(4)
+    bilou_labels = ["O"] + ["{}-{}".format(prefix, etype) for etype in etype_to_id for prefix in "BILU"]
+    return bilou_labels, table
+
+
+def convert_bio2_ids_to_bilou(label_ids, labels):
+    """ Given an array of ids of BIO-2 labels and the list of distinct
+    labels (indexed by id), return array of ids of the corresponding
+    BILOU labels, and the list of BILOU labels (indexed by id).
+    Mentions are found as in get_bio2_mention_offsets (so an I that
+    does not follow a B or an I is mapped to O), and all the tokens of
+    a mention get the entity type of its first label. """
+    label_ids = np.asarray(label_ids, dtype=np.int64)
+    bilou_labels, table = get_bio2_to_bilou_table(labels)
+    prefixes = np.asarray([label[:1] for label in labels], dtype=object)
+    is_B = (prefixes == "B")[label_ids]
+    is_I = (prefixes == "I")[label_ids]
+    # Find the start of the mention that contains each token, i.e. the
+    # last token at or before it that is not an I
+    positions = np.arange(len(label_ids))
+    starts = np.maximum.accumulate(np.where(is_I, -1, positions))
+    in_mention = is_B[np.maximum(starts, 0)] & (starts >= 0)
+    is_end = in_mention & ~np.append(is_I[1:], False)
+    position_in_mention = np.where(is_B, np.where(is_end, 3, 0), np.where(is_end, 2, 1))
+    bilou_ids = np.where(in_mention, table[label_ids[np.maximum(starts, 0)], position_in_mention], 0)
+    return bilou_ids, bilou_labels
+
+
 def convert_bio2_to_bilou(labels):
-    """ Given a list of BIO-2 labels, return list of corresponding BILOU labels. """
-    offsets = get_bio2_mention_offsets(labels)
-    bilou_labels = ["O" for _ in range(len(labels))]
-    for (beg, end) in offsets:
-        etype = labels[beg][2:]
-        length = 1  + end - beg 
-        if length > 1:
-            bilou_labels[beg] = "B-{}".format(etype)
-            bilou_labels[end] = "L-{}".format(etype)
-            for ins in range(beg+1,end):
-                bilou_labels[ins] = "I-{}".format(etype)
-        else:
-            bilou_labels[beg] = "U-{}".format(etype)
-    return bilou_labels
-    
+    """ Given a list of BIO-2 labels, return list of corresponding BILOU
+    labels (see convert_bio2_ids_to_bilou). """
+    label_to_id = {}
+    label_ids = [label_to_id.setdefault(label, len(label_to_id)) for label in labels]
+    bilou_ids, bilou_labels = convert_bio2_ids_to_bilou(label_ids, list(label_to_id))
+    return [bilou_labels[i] for i in bilou_ids.tolist()]
+
+
 def get_entropy(counts, base=2):
     """ Compute Shannon's entropy on a list (or array) of class (or event) frequencies.  """
     nb_classes = len(counts)
@@ -115,3 +167,387 @@ def get_entropy(counts, base=2):
         if p > 0.0:
             entropy -= p * log(p, base)
     return entropy
+
+
+def get_bio2_mentions(labels):
+    """ Given a list of BIO-2 labels, return a (start offset, end offset,
+    entity type) tuple for each mention (end offset is inclusive). """
+    return [(beg, end, labels[beg][2:]) for (beg, end) in get_bio2_mention_offsets(labels)]
+
+
+class SpanCounts(object):
+    """Accumulator of the number of true positives, false positives and
+    false negatives (per entity type) at the mention level. A
+    predicted mention is correct if a gold mention has the same span
+    and entity type.
+
+    Counts are updated one sentence at a time (see update), and the
+    counts of different shards of a dataset can be merged exactly
+    (see merge), so the shards can be scored independently.
+
+    """
+
+    def __init__(self, scheme="BIO-2"):
+        """Init.
+
+        Args:
+        - scheme: how mentions are extracted from the labels. If
+          BIO-2, a mention starts with a B (see
+          get_bio2_mention_offsets). If conlleval, chunks are found
+          using the rules of conlleval (see conlleval.get_chunks), so
+          that e.g. an I that follows an O also starts a mention.
+
+        """
+        if scheme == "BIO-2":
+            self.get_mentions = get_bio2_mentions
+        elif scheme == "conlleval":
+            self.get_mentions = get_chunks
+        else:
+            raise ValueError("unrecognized scheme '{}'".format(scheme))
+        self.scheme = scheme
+        self.etypes = []
+        self.etype_to_id = {}
+        self.tp = np.zeros(0, dtype=np.int64)
+        self.fp = np.zeros(0, dtype=np.int64)
+        self.fn = np.zeros(0, dtype=np.int64)
+
+    def _get_etype_id(self, etype):
+        """Get the id of an entity type, adding it if it is new."""
+        if etype not in self.etype_to_id:
+            self.etype_to_id[etype] = len(self.etypes)
+            self.etypes.append(etype)
+            self.tp = np.append(self.tp, 0)
+            self.fp = np.append(self.fp, 0)
+            self.fn = np.append(self.fn, 0)
+        return self.etype_to_id[etype]
+
+    def update(self, gold_labels, pred_labels):
+        """Add the counts of a sentence.
+
+        Args:
+        - gold_labels: list of gold labels of the tokens in the sentence
+        - pred_labels: list of predicted labels of the tokens in the sentence
+
+        Returns:
+        - (nb gold mentions, nb predicted mentions, nb correct mentions)
+          in this sentence
+
+        """
+        gold_mentions = set(self.get_mentions(gold_labels))
+        pred_mentions = set(self.get_mentions(pred_labels))
+        for (beg, end, etype) in gold_mentions:
+            etype_id = self._get_etype_id(etype)
+            if (beg, end, etype) in pred_mentions:
+                self.tp[etype_id] += 1
+            else:
+                self.fn[etype_id] += 1
+        for (beg, end, etype) in pred_mentions:
+            if (beg, end, etype) not in gold_mentions:
+                etype_id = self._get_etype_id(etype)
+                self.fp[etype_id] += 1
+        nb_correct = len(gold_mentions & pred_mentions)
+        return len(gold_mentions), len(pred_mentions), nb_correct
+
+    def merge(self, other):
+        """Add the counts of another SpanCounts to these counts. Return
+        self.
+
+        """
+        if other.scheme != self.scheme:
+            msg = "can not merge counts of schemes '{}' and '{}'".format(self.scheme, other.scheme)
+            raise ValueError(msg)
+        ids = np.asarray([self._get_etype_id(etype) for etype in other.etypes], dtype=np.int64)
+        np.add.at(self.tp, ids, other.tp)
+        np.add.at(self.fp, ids, other.fp)
+        np.add.at(self.fn, ids, other.fn)
+        return self
+
+    def finalize(self):
+        """Compute scores from the counts.
+
+        Returns:
+        - dict containing the overall counts (tp, fp, fn) and scores
+          (precision, recall and f1, which are 0 if undefined), and a
+          dict (types) that maps each entity type to its counts and
+          scores
+
+        """
+        scores = _get_prf(int(self.tp.sum()), int(self.fp.sum()), int(self.fn.sum()))
+        scores["types"] = {}
+        for etype_id, etype in enumerate(self.etypes):
+            scores["types"][etype] = _get_prf(int(self.tp[etype_id]),
+                                              int(self.fp[etype_id]),
+                                              int(self.fn[etype_id]))
+        return scores
+
+
+def _get_prf(tp, fp, fn):
+    """ Compute precision, recall and f1 from counts of true positives,
+    false positives and false negatives. """
+    precision = tp / (tp + fp) if tp + fp > 0 else 0.
+    recall = tp / (tp + fn) if tp + fn > 0 else 0.
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.
+    return {"tp": tp, "fp": fp, "fn": fn, "precision": precision, "recall": recall, "f1": f1}
+
+
+def get_f_scores(tp, fp, fn):
+    """ Compute f-scores from arrays of counts of true positives, false
+    positives and false negatives (see _get_prf). """
+    tp, fp, fn = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (tp, fp, fn)])
+    p = np.divide(tp, tp + fp, out=np.zeros_like(tp), where=(tp + fp) > 0)
+    r = np.divide(tp, tp + fn, out=np.zeros_like(tp), where=(tp + fn) > 0)
+    return np.divide(2 * p * r, p + r, out=np.zeros_like(p), where=(p + r) > 0)
+
+
+def bootstrap_f_scores(nb_gold, nb_pred, nb_correct, sample_size, nb_resamples, rng=None, max_block_size=2**22):
+    """ Compute f-scores of one or more systems (e.g. a model at
+    different epochs of training) on bootstrap resamples of the
+    sentences of a dataset. Resamples that contain no gold mentions
+    are rejected, and replaced by new resamples.
+
+    Resamples are drawn in blocks: for each block, the sentence indices
+    are drawn as a matrix, converted to a matrix of the number of times
+    each sentence was drawn in each resample, which is multiplied by
+    the matrix of per-sentence counts to get the counts on all the
+    resamples of the block, for all systems at once.
+
+    Args:
+    - nb_gold: array (nb sents) containing the nb of gold mentions in each sentence
+    - nb_pred: array (nb sents, nb systems) containing the nb of predicted mentions
+    - nb_correct: array (nb sents, nb systems) containing the nb of correct predicted mentions
+    - sample_size: nb sentences in each resample
+    - nb_resamples: nb resamples
+    - rng: (optional) numpy Generator
+    - max_block_size: max nb elements of the matrices drawn for each block
+
+    Returns:
+    - array (nb_resamples, nb systems) of f-scores
+
+    """
+    nb_gold = np.asarray(nb_gold).reshape(-1)
+    nb_sents = len(nb_gold)
+    if sample_size < 1:
+        msg = "sample_size must be at least 1"
+        raise ValueError(msg)
+    if not nb_gold.any():
+        msg = "There must be at least one gold mention"
+        raise ValueError(msg)
+    if rng is None:
+        rng = np.random.default_rng()
+    nb_pred = np.asarray(nb_pred).reshape(nb_sents, -1)
+    nb_correct = np.asarray(nb_correct).reshape(nb_sents, -1)
+    nb_systems = nb_pred.shape[1]
+    counts = np.hstack([nb_gold.reshape(-1, 1), nb_pred, nb_correct]).astype(float)
+    block_size = max(1, min(nb_resamples, max_block_size // max(nb_sents, sample_size)))
+    offsets = (np.arange(block_size) * nb_sents).reshape(-1, 1)
+    blocks = []
+    nb_kept = 0
+    while nb_kept < nb_resamples:
+        sample = rng.integers(0, nb_sents, size=(block_size, sample_size)) + offsets
+        nb_draws = np.bincount(sample.ravel(), minlength=block_size*nb_sents)
+        sums = nb_draws.reshape(block_size, nb_sents).astype(float).dot(counts)
+        # Reject resamples containing no gold mentions
+        sums = sums[sums[:,0] > 0]
+        blocks.append(sums[:nb_resamples-nb_kept])
+        nb_kept += len(blocks[-1])
+    sums = np.vstack(blocks)
+    sample_nb_gold = sums[:,:1]
+    sample_nb_pred = sums[:,1:1+nb_systems]
+    sample_nb_correct = sums[:,1+nb_systems:]
+    return get_f_scores(sample_nb_correct, sample_nb_pred - sample_nb_correct, sample_nb_gold - sample_nb_correct)
+
+
+# Nb resamples drawn from each random stream by bootstrap_f_score_samples
+BOOTSTRAP_CHUNK_SIZE = 1000
+
+
+def _bootstrap_chunk(task):
+    """ Compute f-scores on a chunk of bootstrap resamples (see
+    bootstrap_f_score_samples). """
+    (nb_gold, nb_pred, nb_correct), sample_size, nb_resamples, seed_seq = task
+    return bootstrap_f_scores(nb_gold, nb_pred, nb_correct, sample_size, nb_resamples, rng=np.random.default_rng(seed_seq))
+
+
+def bootstrap_f_score_samples(per_sentence_counts, n_resamples, sizes, workers=1, seed=None):
+    """ Compute f-scores of one or more systems on bootstrap resamples
+    of various sizes (see bootstrap_f_scores). The resamples are split
+    into chunks, each drawn from an independent random stream spawned
+    from the seed, and the chunks are processed by a pool of workers.
+    The results only depend on the seed, not on the nb of workers.
+
+    Args:
+    - per_sentence_counts: tuple (nb_gold, nb_pred, nb_correct) of
+      arrays containing the counts in each sentence (see
+      bootstrap_f_scores)
+    - n_resamples: nb resamples of each size
+    - sizes: list of resample sizes (nb sentences)
+    - workers: nb worker processes
+    - seed: (optional) seed (int or SeedSequence)
+
+    Returns:
+    - dict mapping each size to an array (n_resamples, nb systems) of f-scores
+
+    """
+    seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    nb_chunks = (n_resamples + BOOTSTRAP_CHUNK_SIZE - 1) // BOOTSTRAP_CHUNK_SIZE
+    tasks = []
+    for size, size_seed_seq in zip(sizes, seed_seq.spawn(len(sizes))):
+        for chunk_ix, chunk_seed_seq in enumerate(size_seed_seq.spawn(nb_chunks)):
+            nb = min(BOOTSTRAP_CHUNK_SIZE, n_resamples - chunk_ix * BOOTSTRAP_CHUNK_SIZE)
+            tasks.append((per_sentence_counts, size, nb, chunk_seed_seq))
+    if workers > 1:
+        with Pool(workers) as pool:
+            chunks = pool.map(_bootstrap_chunk, tasks)
+    else:
+        chunks = [_bootstrap_chunk(task) for task in tasks]
+    samples = {}
+    for i, size in enumerate(sizes):
+        samples[size] = np.vstack(chunks[i*nb_chunks:(i+1)*nb_chunks])
+    return samples
+
+
+def get_percentile_ci(values, level, axis=0):
+    """ Compute percentile confidence interval (using the midpoint of
+    the two nearest values when the percentile falls between them).
+
+    Args:
+    - values: array of values (e.g. f-scores on bootstrap resamples)
+    - level: confidence level (in [0, 100])
+    - axis: axis along which the percentiles are computed
+
+    Returns:
+    - lower and upper limits of interval
+
+    """
+    low = np.percentile(values, (100-level)/2, axis=axis, method="midpoint")
+    up = np.percentile(values, 100-(100-level)/2, axis=axis, method="midpoint")
+    return low, up
+
+
+def bootstrap_f1_ci(per_sentence_counts, n_resamples=20000, sizes=None, levels=(80, 90, 95), workers=1, seed=None):
+    """ Compute bootstrap percentile confidence intervals of the f-scores
+    of one or more systems.
+
+    Args:
+    - per_sentence_counts: tuple (nb_gold, nb_pred, nb_correct) of
+      arrays containing the counts in each sentence. nb_pred and
+      nb_correct can have shape (nb sents) for a single system, or (nb
+      sents, nb systems).
+    - n_resamples: nb resamples of each size
+    - sizes: (optional) list of resample sizes (nb sentences). Default:
+      size of the dataset.
+    - levels: list of confidence levels (in [0, 100])
+    - workers: nb worker processes
+    - seed: (optional) seed (int or SeedSequence)
+
+    Returns:
+    - dict mapping each size to a dict mapping each level to a (low,
+      up) tuple, containing floats if there is a single system, arrays
+      (nb systems) otherwise
+
+    """
+    nb_gold, nb_pred, nb_correct = per_sentence_counts
+    if sizes is None:
+        sizes = [len(nb_gold)]
+    single = np.ndim(nb_pred) == 1
+    samples = bootstrap_f_score_samples(per_sentence_counts, n_resamples, sizes, workers=workers, seed=seed)
+    cis = {}
+    for size in sizes:
+        cis[size] = {}
+        for level in levels:
+            low, up = get_percentile_ci(samples[size], level)
+            cis[size][level] = (float(low[0]), float(up[0])) if single else (low, up)
+    return cis
+
+
+def paired_bootstrap_test(tp, fp, fn, n_resamples=10000, workers=1, seed=None):
+    """ Paired bootstrap test of the difference between the f-scores of
+    each pair of systems evaluated on the same sentences. The p-value
+    is the fraction of resamples on which the difference between the
+    f-scores deviates from the observed difference at least as much as
+    the observed difference deviates from 0.
+
+    Args:
+    - tp, fp, fn: arrays (nb sents, nb systems) containing the nb of
+      true positives, false positives and false negatives of each
+      system in each sentence
+    - n_resamples: nb resamples
+    - workers: nb worker processes
+    - seed: (optional) seed (int or SeedSequence)
+
+    Returns:
+    - array (nb systems, nb systems) of p-values
+
+    """
+    tp, fp, fn = [np.asarray(x) for x in (tp, fp, fn)]
+    nb_sents, nb_systems = tp.shape
+    nb_gold = tp[:,0] + fn[:,0]
+    per_sentence_counts = (nb_gold, tp + fp, tp)
+    f = get_f_scores(tp.sum(0), fp.sum(0), fn.sum(0))
+    samples = bootstrap_f_score_samples(per_sentence_counts, n_resamples, [nb_sents], workers=workers, seed=seed)[nb_sents]
+    pvals = np.ones((nb_systems, nb_systems))
+    for a in range(nb_systems):
+        for b in range(a+1, nb_systems):
+            delta = f[a] - f[b]
+            deltas = samples[:,a] - samples[:,b]
+            nb_extreme = np.count_nonzero(np.abs(deltas - delta) >= abs(delta) - 1e-12)
+            pvals[a,b] = pvals[b,a] = (nb_extreme + 1) / (n_resamples + 1)
+    return pvals
+
+
+def approximate_randomization_test(tp, fp, fn, n_permutations=10000, rng=None, max_block_size=2**22):
+    """ Approximate randomization test of the difference between the
+    f-scores of each pair of systems evaluated on the same sentences:
+    for each random permutation, the outputs of the 2 systems are
+    swapped on each sentence with probability 1/2, and the p-value is
+    the fraction of permutations on which the absolute difference
+    between the f-scores is at least as large as the observed
+    difference.
+
+    Permutations are drawn in blocks: the swaps are drawn as a binary
+    matrix (nb permutations, nb sents), which is multiplied by the
+    per-sentence differences between the counts of each pair of
+    systems to get the counts of all pairs on all permutations of the
+    block at once.
+
+    Args:
+    - tp, fp, fn: arrays (nb sents, nb systems) containing the nb of
+      true positives, false positives and false negatives of each
+      system in each sentence
+    - n_permutations: nb permutations
+    - rng: (optional) numpy Generator
+    - max_block_size: max nb elements of the matrix of swaps drawn for each block
+
+    Returns:
+    - array (nb systems, nb systems) of p-values
+
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    counts = np.stack([np.asarray(x) for x in (tp, fp, fn)]).astype(float)
+    nb_sents, nb_systems = counts.shape[1:]
+    pairs = [(a, b) for a in range(nb_systems) for b in range(a+1, nb_systems)]
+    a_ix = [a for (a, b) in pairs]
+    b_ix = [b for (a, b) in pairs]
+    totals = counts.sum(1)
+    f = get_f_scores(*totals)
+    delta = np.abs(f[a_ix] - f[b_ix])
+    # Swapping sentence i between systems a and b adds the difference
+    # of their counts on that sentence to the counts of a, and
+    # subtracts it from the counts of b.
+    diffs = (counts[:,:,b_ix] - counts[:,:,a_ix]).transpose(1, 0, 2).reshape(nb_sents, -1)
+    block_size = max(1, min(n_permutations, max_block_size // max(nb_sents, 1)))
+    nb_extreme = np.zeros(len(pairs), dtype=np.int64)
+    nb_done = 0
+    while nb_done < n_permutations:
+        size = min(block_size, n_permutations - nb_done)
+        swaps = rng.integers(0, 2, size=(size, nb_sents)).astype(float)
+        shifts = swaps.dot(diffs).reshape(size, 3, len(pairs))
+        f_a = get_f_scores(*[totals[k,a_ix] + shifts[:,k] for k in range(3)])
+        f_b = get_f_scores(*[totals[k,b_ix] - shifts[:,k] for k in range(3)])
+        nb_extreme += np.count_nonzero(np.abs(f_a - f_b) >= delta - 1e-12, axis=0)
+        nb_done += size
+    pvals = np.ones((nb_systems, nb_systems))
+    for i, (a, b) in enumerate(pairs):
+        pvals[a,b] = pvals[b,a] = (nb_extreme[i] + 1) / (n_permutations + 1)
+    return pvals
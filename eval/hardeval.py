@@ -1,9 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import division, print_function, unicode_literals
-import os, argparse
-from collections import defaultdict, Counter
-from utils_hardeval import enforce_valid_bio2_labeling, convert_bio2_to_bilou, compute_TER, get_word_label_count_dict, get_diff_indices, write_table
+import os, sys, re, argparse
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from collections import Counter
+import numpy as np
+dir_data_utils = os.path.dirname(os.path.realpath(__file__))+"/../data_utils"
+sys.path.append(dir_data_utils)
+from corpus import Corpus, load_corpus, get_shards
+from eval_utils import convert_bio2_to_bilou, convert_bio2_ids_to_bilou
+from data_utils import LabelSet, enforce_valid_labeling, validate_labels, raise_labeling_errors, PREFIX_O
+from utils_hardeval import WordLabelCounts, eval_subset_expression, open_output, write_table, WRITE_CHUNK_SIZE, COMPRESSION_EXTENSIONS
 
 doc="""Given NER predictions and training data, compute token error rate
 on various subsets of tokens. 
@@ -12,6 +21,409 @@ WARNING: labels must be in BIO-2 format.
 """
 
 
+# Names of the subsets of test tokens, in the order in which they are evaluated
+EVAL_NAMES = ["all", "unseen-I", "unseen-O", "unseen-all", "diff-I", "diff-O",
+              "diff-etype", "diff-all", "all-unseen+diff"]
+
+
+# Max nb of errors listed when the gold test labels are not valid
+MAX_LABELING_ERRORS = 10
+
+
+# IO labels, indexed by label id in the IO counts
+IO_LABELS = ["I", "O"]
+
+
+def encode_bio2_labels(labels):
+    """Convert a list of BIO-2 labels to BILOU, and extract the IO
+    prefix and entity type of each label.
+
+    Returns:
+    - list of BILOU labels
+    - boolean array indicating which tokens are part of a mention (I in IO encoding)
+    - list of entity types (None if token is not part of a mention)
+
+    """
+    label_set = LabelSet()
+    bilou_ids, bilou_labels = convert_bio2_ids_to_bilou(label_set.encode(labels), label_set.labels)
+    bilou_set = LabelSet(bilou_labels)
+    is_I = (bilou_set.prefix_ids != PREFIX_O)[bilou_ids]
+    etypes = [bilou_set.etypes[i] if i >= 0 else None for i in bilou_set.type_ids.tolist()]
+    return bilou_set.decode(bilou_ids), is_I, [etypes[i] for i in bilou_ids.tolist()]
+
+
+def get_train_stats(train_tokens, train_gold_bio):
+    """Compute the statistics on the training data that we need to
+    compute the subsets of test tokens.
+
+    Args:
+    - train_tokens: list of training tokens
+    - train_gold_bio: list of training labels (BIO-2)
+
+    Returns:
+    - dict containing the IO prefix frequencies of each word
+      (io_counts), the entity type frequencies of each word within
+      mentions (etype_counts), both as WordLabelCounts over the
+      training vocab, and the list of entity types (etypes)
+
+    """
+    # Enforce valid BIO-2 labeling
+    enforce_valid_labeling(train_gold_bio)
+
+    # Convert label encoding from BIO-2 to BILOU, and extract IO
+    # prefix and entity type from BILOU labels
+    _, train_is_I, train_etypes = encode_bio2_labels(train_gold_bio)
+    token_to_id = {}
+    token_ids = np.asarray([token_to_id.setdefault(w, len(token_to_id)) for w in train_tokens], dtype=np.int64)
+    words = list(token_to_id)
+    io_counts = WordLabelCounts.from_ids(token_ids, ~train_is_I, words, IO_LABELS)
+
+    # Get entity type frequencies of words within mentions
+    train_etypes_I = [train_etypes[i] for i in np.flatnonzero(train_is_I).tolist()]
+    etypes = list(set(train_etypes_I))
+    etype_to_id = {etype: i for i, etype in enumerate(etypes)}
+    etype_ids = np.asarray([etype_to_id[etype] for etype in train_etypes_I], dtype=np.int64)
+    etype_counts = WordLabelCounts.from_ids(token_ids[train_is_I], etype_ids, words, etypes)
+    return {"io_counts": io_counts,
+            "etype_counts": etype_counts}
+
+
+def read_train_stats(path):
+    """Read training data (tokens in the first column, gold BIO-2 labels
+    in the last column), and compute the statistics returned by
+    get_train_stats.
+
+    """
+    print("\nReading training data from {}...".format(os.path.abspath(path)))
+    word_col_ix = 0
+    gold_col_ix = -1
+    train_corpus = load_corpus(path)
+    train_tokens = train_corpus.get_column(word_col_ix)
+    train_gold_bio = train_corpus.get_column(gold_col_ix)
+    if len(train_tokens) == 0:
+        msg = "Error: 0 tokens read"
+        raise ValueError(msg)
+    print("Nb tokens in training set: {}".format(len(train_tokens)))
+    return get_train_stats(train_tokens, train_gold_bio)
+
+
+def save_train_stats(train_stats, path):
+    """Write the statistics returned by get_train_stats in a .npz file,
+    which can be read by load_train_stats instead of computing the
+    statistics again from the training data.
+
+    """
+    io_counts = train_stats["io_counts"]
+    etype_counts = train_stats["etype_counts"]
+    # Tokens never contain whitespace, so the vocab is stored as a
+    # single string
+    with open(path, "wb") as f:
+        np.savez(f,
+                 words=np.asarray("\n".join(io_counts.words)),
+                 io_counts=io_counts.counts,
+                 etypes=np.asarray(etype_counts.labels, dtype=str),
+                 etype_counts=etype_counts.counts)
+
+
+def load_train_stats(path):
+    """Read the statistics written by save_train_stats. Return dict in
+    the same format as get_train_stats.
+
+    """
+    with np.load(path) as f:
+        words = str(f["words"]).split("\n")
+        etypes = f["etypes"].tolist()
+        return {"io_counts": WordLabelCounts(f["io_counts"], words=words, labels=IO_LABELS),
+                "etype_counts": WordLabelCounts(f["etype_counts"], words=words, labels=etypes)}
+
+
+def evaluate_subsets(test_tokens, test_gold_bio, test_pred_bio, train_stats, strict=False, keep_rows=False,
+                     custom_subsets=None):
+    """Compute subsets of test tokens, then count errors on those tokens.
+
+    Args:
+    - test_tokens: list of test tokens
+    - test_gold_bio: list of gold test labels (BIO-2)
+    - test_pred_bio: list of predicted test labels (BIO-2)
+    - train_stats: dict returned by get_train_stats
+    - strict: use strict mode for the diff subsets
+    - keep_rows: if True, keep the indices of the tokens in each
+      subset, and the test tokens and BILOU labels, so that they can
+      be written (see write_eval_rows)
+    - custom_subsets: (optional) list of (name, expression) tuples
+      defining additional subsets (see get_test_subsets)
+
+    Returns:
+    - dict that maps the name of each subset to a dict containing the
+      number of tokens (nb_tokens), the frequency of each word
+      (word_counts), the number of errors (nb_errors) and the array of
+      indices of the tokens (rows, None if keep_rows is False)
+    - test vocab
+    - None if keep_rows is False, otherwise tuple containing object
+      arrays of the test tokens, gold and predicted BILOU labels
+
+    """
+    # Enforce valid BIO-2 labeling
+    enforce_valid_labeling(test_gold_bio, max_errors=MAX_LABELING_ERRORS)
+    #enforce_valid_labeling(test_pred_bio)
+
+    # Convert label encoding from BIO-2 to BILOU, and extract IO
+    # prefix and entity type from BILOU labels
+    test_gold_bilou, test_is_I, test_etypes = encode_bio2_labels(test_gold_bio)
+    test_pred_bilou = convert_bio2_to_bilou(test_pred_bio)
+    label_to_id = {}
+    gold_ids = np.asarray([label_to_id.setdefault(label, len(label_to_id)) for label in test_gold_bilou], dtype=np.int64)
+    pred_ids = np.asarray([label_to_id.setdefault(label, len(label_to_id)) for label in test_pred_bilou], dtype=np.int64)
+    errors = pred_ids != gold_ids
+    token_to_id = {}
+    token_ids = np.asarray([token_to_id.setdefault(token, len(token_to_id)) for token in test_tokens], dtype=np.int64)
+    test_vocab = list(token_to_id)
+
+    # Compute subsets of test tokens, then compute evaluation metrics on
+    # those tokens
+    to_eval = get_test_subsets(test_tokens, test_is_I, test_etypes, train_stats, strict=strict,
+                               custom_subsets=custom_subsets)
+    results = {}
+    for mask, eval_name in to_eval:
+        keep = np.flatnonzero(mask)
+        # Count words in order of first occurrence in the subset
+        word_ids, first, counts = np.unique(token_ids[keep], return_index=True, return_counts=True)
+        order = np.argsort(first, kind="stable")
+        word_counts = Counter(dict(zip([test_vocab[i] for i in word_ids[order].tolist()], counts[order].tolist())))
+        results[eval_name] = {"nb_tokens": len(keep),
+                              "word_counts": word_counts,
+                              "nb_errors": int(errors[keep].sum()),
+                              "rows": keep if keep_rows else None}
+    columns = None
+    if keep_rows:
+        columns = tuple(np.asarray(x, dtype=object) for x in (test_tokens, test_gold_bilou, test_pred_bilou))
+    return results, set(test_vocab), columns
+
+
+def parse_custom_subsets(definitions):
+    """Given a list of definitions of custom subsets of test tokens, in
+    the format NAME=EXPRESSION (see eval_subset_expression), return list
+    of (name, expression) tuples.
+
+    """
+    custom_subsets = []
+    names = set(EVAL_NAMES)
+    for definition in definitions:
+        name, sep, expr = definition.partition("=")
+        name = name.strip()
+        if not sep or not re.match(r"^[\w.+-]+$", name) or name == "etype":
+            msg = "Invalid subset definition '{}' (expected NAME=EXPRESSION, where NAME contains only letters, digits, '_', '.', '+' or '-')".format(definition)
+            raise ValueError(msg)
+        if name in names:
+            msg = "Subset '{}' is defined more than once".format(name)
+            raise ValueError(msg)
+        names.add(name)
+        custom_subsets.append((name, expr))
+    return custom_subsets
+
+
+def get_test_subsets(test_tokens, test_is_I, test_etypes, train_stats, strict=False, custom_subsets=None):
+    """Compute the subsets of test tokens, as boolean masks over the test
+    tokens.
+
+    Args:
+    - test_tokens: list of test tokens
+    - test_is_I: boolean array indicating which test tokens are part
+      of a gold mention (see encode_bio2_labels)
+    - test_etypes: list of gold entity types of the test tokens (see
+      encode_bio2_labels)
+    - train_stats: dict returned by get_train_stats
+    - strict: use strict mode for the diff subsets
+    - custom_subsets: (optional) list of (name, expression) tuples
+      defining additional subsets in terms of the standard subsets
+      and the previous custom subsets (see eval_subset_expression)
+
+    Returns:
+    - list of (mask, subset name) tuples, in the order of EVAL_NAMES,
+      followed by the custom subsets
+
+    """
+    io_counts = train_stats["io_counts"]
+    etype_counts = train_stats["etype_counts"]
+    subsets = {}
+
+    # All test tokens
+    subsets["all"] = np.ones(len(test_tokens), dtype=bool)
+
+    # Unseen words
+    test_token_ids = io_counts.encode_words(test_tokens)
+    unseen = ~io_counts.seen(test_token_ids)
+    subsets["unseen-I"] = unseen & test_is_I
+    subsets["unseen-O"] = unseen & ~test_is_I
+    subsets["unseen-all"] = unseen
+
+    # O tokens that were usually or exclusively I in training, and vice-versa
+    diff_io = io_counts.diff(test_token_ids, ~test_is_I, strict=strict)
+    subsets["diff-I"] = diff_io & test_is_I
+    subsets["diff-O"] = diff_io & ~test_is_I
+
+    # I-X tokens that were usually I, but whose entity type was usually
+    # (or exclusively) not X.
+    usually_I = io_counts.argmax(test_token_ids) == 0
+    diff_etype = etype_counts.diff(test_token_ids, etype_counts.encode_labels(test_etypes), strict=strict)
+    subsets["diff-etype"] = test_is_I & usually_I & diff_etype
+
+    # Combine the diff subsets
+    subsets["diff-all"] = subsets["diff-I"] | subsets["diff-O"] | subsets["diff-etype"]
+
+    # Combine the unseen and diff subsets
+    subsets["all-unseen+diff"] = subsets["diff-all"] | subsets["unseen-I"] | subsets["unseen-O"]
+
+    # Custom subsets
+    if custom_subsets:
+        etypes = np.asarray(["" if etype is None else etype for etype in test_etypes], dtype=str)
+        for name, expr in custom_subsets:
+            subsets[name] = eval_subset_expression(expr, subsets, etypes)
+    return [(mask, name) for name, mask in subsets.items()]
+
+
+def _evaluate_shard(task):
+    """Evaluate the subsets of test tokens in a range of bytes of the
+    predictions file (see get_shards). Return the results of
+    evaluate_subsets, the number of tokens in the range, and a
+    (number of errors, list of errors, first label, last label) tuple
+    describing the validation of the gold labels (see
+    validate_labels), with indices relative to the start of the range.
+    If the gold labels are not valid, the results of evaluate_subsets
+    are None.
+
+    """
+    path, byte_range, train_stats, strict, keep_rows, custom_subsets = task
+    corpus = Corpus.from_file(path, byte_range=byte_range)
+    test_tokens = corpus.get_column(0)
+    test_gold_bio = corpus.get_column(-2)
+    label_set = LabelSet()
+    # The first label may be valid given the last label of the previous
+    # shard, in which case its error is dropped (see
+    # merge_labeling_errors), so we keep one more error than needed
+    nb_errors, errors = validate_labels(label_set.encode(test_gold_bio), label_set, max_errors=MAX_LABELING_ERRORS+1)
+    bounds = (test_gold_bio[0], test_gold_bio[-1]) if len(test_gold_bio) else (None, None)
+    labeling = (nb_errors, errors) + bounds
+    if nb_errors:
+        return None, None, None, len(test_tokens), labeling
+    results, test_vocab, columns = evaluate_subsets(test_tokens, test_gold_bio, corpus.get_column(-1),
+                                                    train_stats, strict=strict, keep_rows=keep_rows,
+                                                    custom_subsets=custom_subsets)
+    return results, test_vocab, columns, len(test_tokens), labeling
+
+
+def merge_labeling_errors(shard_results):
+    """Merge the errors found when validating the gold labels of
+    consecutive shards of the test set (see _evaluate_shard), and raise
+    the same ValueError as if the whole test set had been validated at
+    once (see enforce_valid_labeling), if there are any errors. If
+    the labels are valid, but a mention continues across the boundary
+    between 2 shards, which could not be evaluated separately, we raise
+    a ValueError as well.
+
+    """
+    nb_errors = 0
+    errors = []
+    nb_tokens = 0
+    prev_label = None
+    crossings = []
+    for _, _, _, shard_nb_tokens, labeling in shard_results:
+        shard_nb_errors, shard_errors, first_label, last_label = labeling
+        if prev_label is not None and first_label is not None:
+            # Check the first label of the shard given the last label
+            # of the previous shard, rather than at the start of the
+            # sequence
+            label_set = LabelSet()
+            _, pair_errors = validate_labels(label_set.encode([prev_label, first_label]), label_set)
+            first_errors = [(0, error) for (index, error) in pair_errors if index == 1]
+            if len(shard_errors) and shard_errors[0][0] == 0:
+                shard_nb_errors -= 1
+                shard_errors = shard_errors[1:]
+                if not len(first_errors):
+                    crossings.append(nb_tokens)
+            shard_nb_errors += len(first_errors)
+            shard_errors = first_errors + shard_errors
+        nb_errors += shard_nb_errors
+        errors += [(index+nb_tokens, error) for (index, error) in shard_errors]
+        nb_tokens += shard_nb_tokens
+        if last_label is not None:
+            prev_label = last_label
+    raise_labeling_errors(nb_errors, errors[:MAX_LABELING_ERRORS])
+    if len(crossings):
+        msg = "Error: a mention continues across the boundary between 2 shards (at index {}). ".format(crossings[0])
+        msg += "Use a single worker."
+        raise ValueError(msg)
+
+
+def write_eval_rows(path, rows, tokens, gold, pred, compression=None):
+    """Write the tokens of a subset with their gold and predicted labels.
+    The rows are rendered in chunks straight from the arrays.
+
+    Args:
+    - path: path of output file
+    - rows: array of indices of the tokens in the subset
+    - tokens: object array of test tokens
+    - gold: object array of gold BILOU labels
+    - pred: object array of predicted BILOU labels
+    - compression: (optional) compression method (see open_output)
+
+    """
+    with open_output(path, compression=compression) as f:
+        f.write("\t".join(["Index", "Token", "Gold", "Predicted", "Correct?"]) + "\n")
+        for start in range(0, len(rows), WRITE_CHUNK_SIZE):
+            chunk = rows[start:start+WRITE_CHUNK_SIZE]
+            g = gold[chunk]
+            p = pred[chunk]
+            correct = np.where(g == p, "CORRECT", "WRONG")
+            f.write("".join("{}\t{}\t{}\t{}\t{}\n".format(*row) for row in zip(chunk.tolist(), tokens[chunk].tolist(),
+                                                                               g.tolist(), p.tolist(), correct.tolist())))
+
+
+def merge_subset_results(shard_results):
+    """Merge the results of evaluate_subsets on consecutive shards of
+    the test set. Token indices are shifted so that the merged results
+    are the same as if the whole test set had been evaluated at once.
+
+    Args:
+    - shard_results: list of (results, test vocab, columns, nb tokens,
+      labeling errors) tuples (see _evaluate_shard), in the order in
+      which the shards appear in the file
+
+    Returns:
+    - merged results
+    - test vocab
+    - merged columns
+    - nb tokens
+
+    """
+    merge_labeling_errors(shard_results)
+    merged = {}
+    eval_names = list(shard_results[0][0])
+    for eval_name in eval_names:
+        merged[eval_name] = {"nb_tokens": 0, "word_counts": Counter(), "nb_errors": 0, "rows": None}
+    test_vocab = set()
+    nb_tokens = 0
+    for results, shard_vocab, _, shard_nb_tokens, _ in shard_results:
+        for eval_name in eval_names:
+            res = results[eval_name]
+            merged_res = merged[eval_name]
+            merged_res["nb_tokens"] += res["nb_tokens"]
+            merged_res["word_counts"].update(res["word_counts"])
+            merged_res["nb_errors"] += res["nb_errors"]
+            if res["rows"] is not None:
+                if merged_res["rows"] is None:
+                    merged_res["rows"] = []
+                merged_res["rows"].append(res["rows"] + nb_tokens)
+        test_vocab.update(shard_vocab)
+        nb_tokens += shard_nb_tokens
+    columns = None
+    if shard_results[0][2] is not None:
+        for merged_res in merged.values():
+            merged_res["rows"] = np.concatenate(merged_res["rows"])
+        columns = tuple(np.concatenate(x) for x in zip(*[shard[2] for shard in shard_results]))
+    return merged, test_vocab, columns, nb_tokens
+
+
 def main():
     parser = argparse.ArgumentParser(description=doc)
     msg = ("Use strict mode for evaluation of tokens with surprising labels "
@@ -20,15 +432,39 @@ def main():
     msg = ("(optional) path of directory in which we write a vocab file and "
            "evaluation file for each subset of tokens")
     parser.add_argument("-w", "--write-dir", required=False, help=msg)
+    msg = "Compress the files written in the write dir (zstd requires the zstandard package)"
+    parser.add_argument("-z", "--compress", choices=["gzip", "zstd"], help=msg)
+    msg = "Number of threads used to write the files in the write dir"
+    parser.add_argument("--write-threads", type=int, default=4, help=msg)
+    msg = ("Number of worker processes. If greater than 1, the predictions are "
+           "split into shards (on sentence boundaries), which are evaluated in parallel.")
+    parser.add_argument("-n", "--workers", type=int, default=1, help=msg)
+    msg = ("Define an additional subset of test tokens, in the format "
+           "NAME=EXPRESSION, where EXPRESSION combines the names of subsets "
+           "(including previously defined ones) and conditions on the gold "
+           "entity type (etype==X or etype!=X) using the operators & "
+           "(intersection), | (union), ~ (complement) and parentheses, "
+           "e.g. 'unseen-I-ORG=unseen-I & etype==ORG'. Can be repeated.")
+    parser.add_argument("-u", "--subset", action="append", default=[], help=msg)
+    group = parser.add_mutually_exclusive_group(required=True)
+    msg = ("Path of an index of the training data written by "
+           "build_hardeval_index.py, used instead of the training data")
+    group.add_argument("-i", "--train-index", help=msg)
     msg = ("Path of training data (text file containing whitespace-separate "
            "columns, with tokens in the first column, and gold BIO-2 labels in the last "
-           "column).")
-    parser.add_argument("train", help=msg)
+           "column). Omitted if --train-index is provided.")
+    group.add_argument("train", nargs="?", help=msg)
     msg = ("Path of predictions (text file containing whitespace-separate "
            "columns, with tokens in the first column, and gold and predicted "
            "BIO-2 labels in the last 2 columns).")
     parser.add_argument("pred", help=msg)
     args = parser.parse_args()
+    custom_subsets = parse_custom_subsets(args.subset)
+    if args.compress == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            parser.error("zstd compression requires the zstandard package (pip install zstandard)")
 
     if args.write_dir:
         if os.path.exists(args.write_dir):
@@ -40,221 +476,101 @@ def main():
     word_col_ix = 0
     gold_col_ix = -2
     pred_col_ix = -1
-    test_tokens = []
-    test_gold_bio = []
-    test_pred_bio = []
-    with open(args.pred) as f:
-        for line in f:
-            elems = line.strip().split()
-            if len(elems):
-                test_tokens.append(elems[word_col_ix])
-                test_gold_bio.append(elems[gold_col_ix])
-                test_pred_bio.append(elems[pred_col_ix])
-    if not len(test_tokens):
-        msg = "Error: 0 tokens read"
-        raise ValueError(msg)
-    print("Nb tokens in test set: {}".format(len(test_tokens)))
-
-    print("\nReading training data from {}...".format(os.path.abspath(args.train)))
-    train_tokens = []
-    train_gold_bio = []
-    word_col_ix = 0
-    gold_col_ix = -1
-    with open(args.train) as f:
-        for line in f:
-            elems = line.strip().split()
-            if len(elems):
-                train_tokens.append(elems[word_col_ix])
-                train_gold_bio.append(elems[gold_col_ix])
-    if len(train_tokens) == 0:
-        msg = "Error: 0 tokens read"
-        raise ValueError(msg)
-    print("Nb tokens in training set: {}".format(len(train_tokens)))
-
-    # Store vocabs
-    train_vocab = set(train_tokens)
-    test_vocab = set(test_tokens)
-
-    # Enforce valid BIO-2 labeling
-    enforce_valid_bio2_labeling(train_gold_bio)
-    enforce_valid_bio2_labeling(test_gold_bio)
-    #enforce_valid_bio2_labeling(test_pred_bio)
-
-    # Convert label encoding from BIO-2 to BILOU
-    train_gold_bilou = convert_bio2_to_bilou(train_gold_bio)
-    test_gold_bilou = convert_bio2_to_bilou(test_gold_bio)
-    test_pred_bilou = convert_bio2_to_bilou(test_pred_bio)
-
-    # Map words to their labels in the training and test sets
-    train_word_to_labels = defaultdict(list)
-    for word, label in zip(train_tokens, train_gold_bilou):
-        train_word_to_labels[word].append(label)
-    test_word_to_labels = defaultdict(list)
-    for word, label in zip(test_tokens, test_gold_bilou):
-        test_word_to_labels[word].append(label)
-
-    # Extract IO prefix and entity type from BILOU labels
-    train_gold_io = ["O" if lab == "O" else "I" for lab in train_gold_bilou]
-    test_gold_io = ["O" if lab == "O" else "I" for lab in test_gold_bilou]
-    test_pred_io = ["O" if lab == "O" else "I" for lab in test_pred_bilou]
+    if args.workers <= 1:
+        test_corpus = load_corpus(args.pred)
+        test_tokens = test_corpus.get_column(word_col_ix)
+        test_gold_bio = test_corpus.get_column(gold_col_ix)
+        test_pred_bio = test_corpus.get_column(pred_col_ix)
+        if not len(test_tokens):
+            msg = "Error: 0 tokens read"
+            raise ValueError(msg)
+        print("Nb tokens in test set: {}".format(len(test_tokens)))
 
-    ####################################################################
-    # Compute subsets of test tokens, then compute evaluation metrics on
-    # those tokens
-    ####################################################################
-    to_eval = []
+    if args.train_index:
+        print("\nReading training index from {}...".format(os.path.abspath(args.train_index)))
+        train_stats = load_train_stats(args.train_index)
+        print("Nb words in training set: {}".format(len(train_stats["io_counts"].words)))
+    else:
+        train_stats = read_train_stats(args.train)
+    io_counts = train_stats["io_counts"]
+    etype_counts = train_stats["etype_counts"]
 
-    # All test tokens
-    keep_all = range(len(test_tokens))
-    eval_name = "all"
-    to_eval.append((keep_all, eval_name))
-
-    #keep_all_in_mention = [i for i in keep_all if test_gold_io[i] == "I" or test_pred_io[i] == "I"]
-    #eval_name = "all-in-mention"
-    #to_eval.append((keep_all_in_mention, eval_name))
-    
-    # Unseen words
-    unseen = test_vocab.difference(train_vocab)
-    keep_unseen = [i for i in keep_all if test_tokens[i] in unseen]
-    keep_unseen_I = []
-    keep_unseen_O = []
-    for i in keep_unseen:
-        if test_gold_io[i] == "I":
-            keep_unseen_I.append(i)
-        else:
-            keep_unseen_O.append(i)
-    eval_name = "unseen-I"
-    to_eval.append((keep_unseen_I, eval_name))
-    eval_name = "unseen-O"
-    to_eval.append((keep_unseen_O, eval_name))
-    eval_name = "unseen-all"
-    to_eval.append((keep_unseen, eval_name))
+    # Compute subsets of test tokens and count errors, either on the
+    # whole test set, or on shards of the test set in parallel
+    keep_rows = args.write_dir is not None
+    if args.workers <= 1:
+        results, test_vocab, columns = evaluate_subsets(test_tokens, test_gold_bio, test_pred_bio, train_stats,
+                                                        strict=args.strict, keep_rows=keep_rows,
+                                                        custom_subsets=custom_subsets)
+    else:
+        shards = get_shards(args.pred, args.workers)
+        tasks = [(args.pred, byte_range, train_stats, args.strict, keep_rows, custom_subsets) for byte_range in shards]
+        with Pool(args.workers) as pool:
+            results, test_vocab, columns, nb_test_tokens = merge_subset_results(pool.map(_evaluate_shard, tasks))
+        if not nb_test_tokens:
+            msg = "Error: 0 tokens read"
+            raise ValueError(msg)
+        print("\nNb tokens in test set: {} ({} shards)".format(nb_test_tokens, len(shards)))
 
-    # O tokens that were usually or exclusively I in training, and vice-versa
-    word_io_count = get_word_label_count_dict(train_tokens, train_gold_io)
-    test_indices_I = []
-    test_indices_O = []
-    for i,label in enumerate(test_gold_io):
-        if label == "I":
-            test_indices_I.append(i)
-        else:
-            test_indices_O.append(i)
-    test_tokens_I = [test_tokens[i] for i in test_indices_I]
-    test_labels_I = ["I" for _ in test_indices_I]
-    indices = get_diff_indices(word_io_count, test_tokens_I, test_labels_I, strict=args.strict)
-    keep_diff_I = [test_indices_I[i] for i in indices]
-    test_tokens_O = [test_tokens[i] for i in test_indices_O]
-    test_labels_O = ["O" for _ in test_indices_O]
-    indices = get_diff_indices(word_io_count, test_tokens_O, test_labels_O, strict=args.strict)
-    keep_diff_O = [test_indices_O[i] for i in indices]
-    eval_name = "diff-I"
-    to_eval.append((keep_diff_I, eval_name))
-    eval_name = "diff-O"
-    to_eval.append((keep_diff_O, eval_name))
+    # The output files are written in parallel threads once all the
+    # tables have been computed
+    write_jobs = []
+    ext = ".tsv" + COMPRESSION_EXTENSIONS[args.compress]
 
     # Write IO prefix frequencies in training set for seen test words
     # (excluding "O")
     if args.write_dir:
-        keys = ["I", "O"]
-        io_info = []
-        for word in test_vocab.intersection(train_vocab):
-            io_fd = {}
-            if word in word_io_count:
-                io_fd = word_io_count[word]
-            io_info.append([word] + [str(io_fd[k]) if k in io_fd else "0" for k in keys])
-        io_info = sorted(io_info, key=lambda x:x[0])
-        path = "{}/class_freqs_for_seen_words_IO.tsv".format(args.write_dir)
+        keys = io_counts.labels
+        words = sorted(test_vocab.intersection(io_counts.words))
+        io_info = [[word] + [str(c) for c in row] for word, row in zip(words, io_counts.counts[io_counts.encode_words(words)].tolist())]
+        path = "{}/class_freqs_for_seen_words_IO{}".format(args.write_dir, ext)
         header = ["Word"] + keys
-        write_table(io_info, path, header=header, delim="\t")
+        write_jobs.append(partial(write_table, io_info, path, header=header, delim="\t", compression=args.compress))
 
-    # I-X tokens that were usually I, but whose entity type was usually
-    # (or exclusively) not X.
-    train_indices_I = []
-    for i,label in enumerate(train_gold_io):
-        if label == "I":
-            train_indices_I.append(i)
-    train_tokens_I = [train_tokens[i] for i in train_indices_I]
-    train_etypes_I = [train_gold_bilou[i][2:] for i in train_indices_I]
-    word_etype_count = get_word_label_count_dict(train_tokens_I, train_etypes_I)
-    usually_I = set()
-    for word, io_fd in word_io_count.items():
-        i_count = 0
-        o_count = 0
-        if "I" in io_fd:
-            i_count = io_fd["I"]
-        if "O" in io_fd:
-            o_count = io_fd["O"]
-        if i_count >= o_count:
-            usually_I.add(word)
-    test_indices_UI = [i for i in test_indices_I if test_tokens[i] in usually_I]
-    test_tokens_UI = [test_tokens[i] for i in test_indices_UI]
-    test_etypes_UI = [test_gold_bilou[i][2:] for i in test_indices_UI]
-    indices = get_diff_indices(word_etype_count, test_tokens_UI, test_etypes_UI, strict=args.strict)
-    keep_diff_etype = [test_indices_UI[i] for i in indices]
-    eval_name = "diff-etype"
-    to_eval.append((keep_diff_etype, eval_name))
-    
     # Write entity type frequencies in training set for seen test words
     # (excluding "O")
     if args.write_dir:
-        keys = list(set(train_etypes_I))
-        etype_info = []
-        for word in test_vocab.intersection(word_etype_count.keys()):
-            etype_fd = word_etype_count[word]
-            etype_info.append([word] + [str(etype_fd[k]) if k in etype_fd else "0" for k in keys])
-        etype_info = sorted(etype_info, key=lambda x:x[0])
-        path = "{}/class_freqs_for_seen_words_etype.tsv".format(args.write_dir)
+        keys = etype_counts.labels
+        word_ids = etype_counts.encode_words(sorted(test_vocab.intersection(etype_counts.words)))
+        word_ids = word_ids[etype_counts.seen(word_ids)]
+        etype_info = [[etype_counts.words[i]] + [str(c) for c in row] for i, row in zip(word_ids.tolist(), etype_counts.counts[word_ids].tolist())]
+        path = "{}/class_freqs_for_seen_words_etype{}".format(args.write_dir, ext)
         header = ["Word"] + keys
-        write_table(etype_info, path, header=header, delim="\t")
-
-    # Combine the unseen and diff indices
-    keep_diff_all = sorted(set(keep_diff_I + keep_diff_O + keep_diff_etype))
-    eval_name = "diff-all"
-    to_eval.append((keep_diff_all, eval_name))
-
-    # Combine the unseen and diff indices
-    keep_hard_all = sorted(set(keep_diff_all + keep_unseen_I + keep_unseen_O))
-    eval_name = "all-unseen+diff"
-    to_eval.append((keep_hard_all, eval_name))
+        write_jobs.append(partial(write_table, etype_info, path, header=header, delim="\t", compression=args.compress))
 
     # Evaluate        
     res_nb_tokens = {}
     res_nb_words = {}
     res_nb_errors = {}
     res_ter = {}
-    for keep, eval_name in to_eval:
-        t = [test_tokens[i] for i in keep]
-        p = [test_pred_bilou[i] for i in keep]
-        g = [test_gold_bilou[i] for i in keep]
-        ter, nb_errs = compute_TER(p, g)
-        res_nb_tokens[eval_name] = len(t)
-        res_nb_words[eval_name] = len(set(t))
-        res_nb_errors[eval_name] = nb_errs
-        res_ter[eval_name] = ter
+    eval_names = list(results)
+    for eval_name in eval_names:
+        res = results[eval_name]
+        res_nb_tokens[eval_name] = res["nb_tokens"]
+        res_nb_words[eval_name] = len(res["word_counts"])
+        res_nb_errors[eval_name] = res["nb_errors"]
+        res_ter[eval_name] = res["nb_errors"] / res["nb_tokens"] if res["nb_tokens"] else 0
         if args.write_dir:
             # Write tokens with their predicted and gold labels
-            header = "Index Token Gold Predicted Correct?".split()
-            info = []
-            for ix, token, gold, pred in zip(keep, t, g, p):
-                correct = "WRONG"
-                if gold == pred:
-                    correct = "CORRECT"
-                info.append([str(ix), token, gold, pred, correct])
-            path = "{}/eval-{}.tsv".format(args.write_dir, eval_name)
-            write_table(info, path, header=header, delim="\t")
+            path = "{}/eval-{}{}".format(args.write_dir, eval_name, ext)
+            write_jobs.append(partial(write_eval_rows, path, res["rows"], *columns, compression=args.compress))
             # Write vocab
-            word_to_freq = Counter(t)
+            word_to_freq = res["word_counts"]
             vocab = sorted(word_to_freq.items(), key=lambda x:x[1], reverse=True)
             vocab = [[w,str(c)] for w,c in vocab]
             header = ["Word", "NbEvaluated"]
-            path = "{}/vocab-{}.tsv".format(args.write_dir, eval_name)
-            write_table(vocab, path, header=header, delim="\t")
+            path = "{}/vocab-{}{}".format(args.write_dir, eval_name, ext)
+            write_jobs.append(partial(write_table, vocab, path, header=header, delim="\t", compression=args.compress))
+    if args.write_dir:
+        with ThreadPoolExecutor(max(1, args.write_threads)) as executor:
+            # Consume the results to raise any exception
+            list(executor.map(lambda job: job(), write_jobs))
 
     # Write results
     res_header = ["Test tokens", "Nb tokens", "Nb words", "Nb errors", "Token error rate"]
     res_table = []
     ename_to_row_ix = {}
-    for i, (keep, e) in enumerate(to_eval):
+    for i, e in enumerate(eval_names):
         row = [e, str(res_nb_tokens[e]), str(res_nb_words[e]), str(res_nb_errors[e]), "{:.4f}".format(res_ter[e])]
         res_table.append(row)
         ename_to_row_ix[e] = i
@@ -297,6 +613,11 @@ def main():
     print_row(res_table[ename_to_row_ix["all-unseen+diff"]])
     print(line)
 
+    if custom_subsets:
+        for eval_name, _ in custom_subsets:
+            print_row(res_table[ename_to_row_ix[eval_name]])
+        print(line)
+
     # Print average score on unseen and diff
     score = (res_ter["unseen-all"] + res_ter["diff-all"]) / 2
     print("\n\nAvg TER on unseen and diff: {:.4f}\n\n".format(score))
@@ -0,0 +1,163 @@
+import sys, os, argparse
+from glob import glob
+import numpy as np
+dir_data_utils = os.path.dirname(os.path.realpath(__file__))+"/../data_utils"
+sys.path.append(dir_data_utils)
+from corpus import load_corpus
+from eval_utils import convert_bio2_to_bilou
+from data_utils import enforce_valid_labeling
+from hardeval import encode_bio2_labels, get_test_subsets, parse_custom_subsets, read_train_stats, load_train_stats
+from utils_hardeval import write_table
+
+doc = """ Compute the token error rate of several NER systems on the
+subsets of test tokens used in HardEval (see hardeval.py). The
+prediction files must contain the same tokens and gold labels, so the
+subsets are computed once, then the errors of all the systems are
+counted on each subset. The results are printed as a table with one
+row per system and one column per subset.
+
+WARNING: labels must be in BIO-2 format.
+"""
+
+
+def get_pred_paths(patterns):
+    """Given a list of paths or glob patterns, return the sorted list of
+    matching paths."""
+    paths = set()
+    for pattern in patterns:
+        matches = glob(pattern)
+        if not len(matches):
+            msg = "No files matching {}".format(pattern)
+            raise ValueError(msg)
+        paths.update(matches)
+    return sorted(paths)
+
+
+def read_predictions(paths):
+    """Read prediction files (tokens in the first column, gold and
+    predicted BIO-2 labels in the last 2 columns) that contain the same
+    tokens and gold labels.
+
+    Returns:
+    - list of test tokens
+    - list of gold test labels
+    - list containing the list of predicted labels of each system
+
+    """
+    test_tokens = None
+    test_gold_bio = None
+    test_preds_bio = []
+    for path in paths:
+        corpus = load_corpus(path)
+        tokens = corpus.get_column(0)
+        gold_bio = corpus.get_column(-2)
+        if test_tokens is None:
+            if not len(tokens):
+                msg = "Error: 0 tokens read"
+                raise ValueError(msg)
+            test_tokens = tokens
+            test_gold_bio = gold_bio
+        elif tokens != test_tokens or gold_bio != test_gold_bio:
+            msg = "Tokens or gold labels in '{}' do not match those in '{}'".format(path, paths[0])
+            raise ValueError(msg)
+        test_preds_bio.append(corpus.get_column(-1))
+    return test_tokens, test_gold_bio, test_preds_bio
+
+
+def evaluate_systems(test_tokens, test_gold_bio, test_preds_bio, train_stats, strict=False, custom_subsets=None):
+    """Compute the subsets of test tokens, then count the errors of each
+    system on each subset.
+
+    Args:
+    - test_tokens: list of test tokens
+    - test_gold_bio: list of gold test labels (BIO-2)
+    - test_preds_bio: list containing the list of predicted test
+      labels (BIO-2) of each system
+    - train_stats: dict returned by get_train_stats
+    - strict: use strict mode for the diff subsets
+    - custom_subsets: (optional) list of (name, expression) tuples
+      defining additional subsets (see get_test_subsets)
+
+    Returns:
+    - list of subset names
+    - array (nb subsets) containing the nb of tokens in each subset
+    - array (nb systems, nb subsets) containing the nb of errors of
+      each system on each subset
+
+    """
+    enforce_valid_labeling(test_gold_bio)
+    test_gold_bilou, test_is_I, test_etypes = encode_bio2_labels(test_gold_bio)
+    to_eval = get_test_subsets(test_tokens, test_is_I, test_etypes, train_stats, strict=strict,
+                               custom_subsets=custom_subsets)
+
+    # Encode the BILOU labels as ids, and find the tokens on which each
+    # system made an error
+    label_to_id = {}
+    gold_ids = np.asarray([label_to_id.setdefault(label, len(label_to_id)) for label in test_gold_bilou], dtype=np.int64)
+    errors = np.zeros((len(test_preds_bio), len(test_tokens)), dtype=bool)
+    for i, pred_bio in enumerate(test_preds_bio):
+        pred_ids = [label_to_id.setdefault(label, len(label_to_id)) for label in convert_bio2_to_bilou(pred_bio)]
+        errors[i] = np.asarray(pred_ids, dtype=np.int64) != gold_ids
+
+    eval_names = [name for _, name in to_eval]
+    nb_tokens = np.asarray([mask.sum() for mask, _ in to_eval], dtype=np.int64)
+    nb_errors = np.stack([(errors & mask).sum(1) for mask, _ in to_eval], axis=1)
+    return eval_names, nb_tokens, nb_errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=doc)
+    msg = ("Use strict mode for evaluation of tokens with surprising labels "
+           "(evaluate tokens whose labels was never observed in training only)")
+    parser.add_argument("-s", "--strict", action="store_true", help=msg)
+    group = parser.add_mutually_exclusive_group(required=True)
+    msg = ("Path of training data (text file containing whitespace-separate "
+           "columns, with tokens in the first column, and gold BIO-2 labels in the last "
+           "column).")
+    group.add_argument("-t", "--train", help=msg)
+    msg = "Path of an index of the training data written by build_hardeval_index.py"
+    group.add_argument("-i", "--train-index", help=msg)
+    msg = "(optional) path of a TSV file in which we write the token error rates"
+    parser.add_argument("-o", "--output", help=msg)
+    msg = "Define an additional subset of test tokens (see hardeval.py). Can be repeated."
+    parser.add_argument("-u", "--subset", action="append", default=[], help=msg)
+    msg = ("Paths or glob patterns of the predictions of each system (text "
+           "files containing whitespace-separate columns, with tokens in the "
+           "first column, and gold and predicted BIO-2 labels in the last 2 "
+           "columns).")
+    parser.add_argument("pred", nargs="+", help=msg)
+    args = parser.parse_args()
+
+    custom_subsets = parse_custom_subsets(args.subset)
+    paths = get_pred_paths(args.pred)
+    print("\nReading predictions of {} systems...".format(len(paths)))
+    test_tokens, test_gold_bio, test_preds_bio = read_predictions(paths)
+    print("Nb tokens in test set: {}".format(len(test_tokens)))
+
+    if args.train_index:
+        print("\nReading training index from {}...".format(os.path.abspath(args.train_index)))
+        train_stats = load_train_stats(args.train_index)
+    else:
+        train_stats = read_train_stats(args.train)
+
+    eval_names, nb_tokens, nb_errors = evaluate_systems(test_tokens, test_gold_bio, test_preds_bio, train_stats,
+                                                        strict=args.strict, custom_subsets=custom_subsets)
+    ter = nb_errors / np.maximum(nb_tokens, 1)
+
+    strict_on_or_off = "ON" if args.strict else "OFF"
+    print("\nStrict mode: {}\n".format(strict_on_or_off))
+    print("Nb tokens:")
+    for eval_name, nb in zip(eval_names, nb_tokens.tolist()):
+        print("  {}: {}".format(eval_name, nb))
+    header = ["System"] + eval_names
+    table = [[path] + ["{:.4f}".format(x) for x in row] for path, row in zip(paths, ter.tolist())]
+    print("\nToken error rates:")
+    print("\t".join(header))
+    for row in table:
+        print("\t".join(row))
+    if args.output:
+        write_table(table, args.output, header=header, delim="\t")
+
+
+if __name__ == "__main__":
+    main()
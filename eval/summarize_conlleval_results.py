@@ -1,11 +1,14 @@
-import sys, os, argparse, re
+import sys, os, argparse, re, json
 import numpy as np
 from mimetypes import guess_type
 
 doc = """ Given the path of a directory containing conlleval results
 files, extract a metric from each of the files (accuracy, precision,
 recall or FB1, where the last 3 are weighted averages over all entity
-types) and output a table that summarizes these results in 2 rows. """
+types) and output a table that summarizes these results in 2 rows.
+Results files can be the reports written by conlleval or the JSON files
+written by conlleval.py (option -j). If a report has a JSON file with
+the same name (minus the extension), we use the JSON file instead. """
 
 parser = argparse.ArgumentParser(description=doc)
 parser.add_argument("input_dir", help="path of directory containing results files")
@@ -31,12 +34,33 @@ max_lines_checked = 100
 for file_name in file_names:
     file_path = "{}/{}".format(args.input_dir, file_name)
 
-    # Check if it's a text file
+    # Check if it's a JSON file written by conlleval.py. If so, we
+    # read the scores directly (rounded the same way as in the
+    # report).
     file_type, file_encoding = guess_type(file_path)
+    if file_type == "application/json":
+        with open(file_path) as f:
+            try:
+                res = json.load(f)
+            except ValueError:
+                res = None
+        if not isinstance(res, dict) or res.get(args.metric) is None:
+            msg = "WARNING: file '{}' does not appear to contain conlleval results.".format(file_path)
+            print(msg)
+            continue
+        scores.append("{:.2f}".format(res[args.metric]))
+        header.append(file_name)
+        continue
+
+    # Check if it's a text file
     if file_type != "text/plain":
         msg = "WARNING: file '{}' does not seem to be a text file.".format(file_path)
         print(msg)
         continue
+
+    # Skip reports for which we have a JSON file
+    if os.path.splitext(file_name)[0] + ".json" in file_names:
+        continue
     
     summary_line_found=False
     line_count=0
@@ -1,5 +1,6 @@
 from __future__ import division, print_function, unicode_literals
-import string, re, unicodedata
+import string, re, unicodedata, io, gzip, itertools
+import numpy as np
 
 # Valid ASCII characters (not including whitespace)
 VALID_CHARS = string.ascii_letters + string.digits + string.punctuation
@@ -30,26 +31,6 @@ def unicode_to_ASCII(s):
     )
     return norm        
 
-def enforce_valid_bio2_labeling(labels):
-    prev_prefix = 'O'
-    prev_etype = None
-    for label_ix, label in enumerate(labels):
-        if label == 'O':
-            etype = None
-        else:
-            etype = label[2:]
-        prefix = label[0]
-        if prefix == 'I':
-            if prev_prefix == 'O':
-                msg = 'Invalid BIO-2 labeling at index %d: I follows O' % label_ix
-                raise ValueError(msg)
-            if etype != prev_etype:
-                print(labels)
-                msg = 'Invalid BIO-2 labeling at index %d: I follows label with different entity type' % label_ix
-                raise ValueError(msg)
-        prev_prefix = prefix
-        prev_etype = etype
-                
 def get_bio2_mention_offsets(labels):
     """Given a list of BIO-2 labels, find mention boundaries, yield a
     (start offset, end offset) tuple for each mention.
@@ -73,25 +54,6 @@ def get_bio2_mention_offsets(labels):
             i += 1
 
 
-def convert_bio2_to_bilou(labels):
-    """Given a list of BIO-2 labels, return list of corresponding BILOU
-    labels.
-
-    """
-    bilou_labels = ["O" for _ in range(len(labels))]
-    for (beg, end) in get_bio2_mention_offsets(labels):
-        etype = labels[beg][2:]
-        length = 1  + end - beg 
-        if length > 1:
-            bilou_labels[beg] = "B-{}".format(etype)
-            bilou_labels[end] = "L-{}".format(etype)
-            for i in range(beg+1,end):
-                bilou_labels[i] = "I-{}".format(etype)
-        else:
-            bilou_labels[beg] = "U-{}".format(etype)
-    return bilou_labels
-
-
 def compute_TER(pred, gold):
     """Given a list of predicted labels and a list of gold labels, compute
     token error rate (TER). Return TER and number of errors.
@@ -110,56 +72,266 @@ def compute_TER(pred, gold):
     return token_error_rate, nb_errors
 
 
-def get_word_label_count_dict(tokens, labels):
-    """Given a list of tokens and a list of labels, make a dict that maps
-    words to a dict that maps labels to the frequency of the label
-    given the word.
+def get_word_label_count_matrix(token_ids, label_ids, nb_words, nb_labels):
+    """Given an array of token ids and an array of label ids, return a
+    matrix (nb_words, nb_labels) containing the frequency of each label
+    given each word. Count matrices of disjoint parts of a dataset can
+    be added or subtracted.
 
     """
-    word_label_count = {}
-    for word, label in zip(tokens, labels):
-        if word not in word_label_count:
-            word_label_count[word] = {}
-        if label not in word_label_count[word]:
-            word_label_count[word][label] = 0
-        word_label_count[word][label] += 1
-    return word_label_count
-
-
-def get_diff_indices(word_label_count, test_tok, test_gold, strict=False):
-    """Get indices of test tokens whose gold label was not seen in
-    training (strict version) or was not the most frequent label in
-    training (lax version), excluding tokens that were not seen at all
-    in training.
+    token_ids = np.asarray(token_ids, dtype=np.int64)
+    label_ids = np.asarray(label_ids, dtype=np.int64)
+    counts = np.bincount(token_ids * nb_labels + label_ids, minlength=nb_words*nb_labels)
+    return counts.reshape(nb_words, nb_labels).astype(np.int32)
+
+
+class WordLabelCounts(object):
+    """Frequency of each label given each word in some training data,
+    stored as a dense matrix (nb words, nb labels), along with the
+    vocab and the list of labels that index its rows and columns.
+    Queries take arrays of word ids and label ids, and return arrays,
+    so that all the test tokens can be classified at once. Word ids
+    and label ids of -1 stand for words and labels that are not in
+    the vocab or label list (see encode_words and encode_labels): such
+    words are unseen, and such labels have a count of 0.
+
+    """
+
+    def __init__(self, counts, words=None, labels=None):
+        """Init.
+
+        Args:
+        - counts: matrix (nb words, nb labels) of label counts (see
+          get_word_label_count_matrix)
+        - words: (optional) list of words, indexed by word id
+        - labels: (optional) list of labels, indexed by label id
+
+        """
+        self.counts = np.asarray(counts, dtype=np.int32)
+        self.words = words
+        self.word_to_id = None if words is None else {w:i for i,w in enumerate(words)}
+        self.labels = labels
+        self.label_to_id = None if labels is None else {l:i for i,l in enumerate(labels)}
+
+    @classmethod
+    def from_ids(cls, token_ids, label_ids, words, labels):
+        """Count the labels of each word, given an array of token ids and
+        an array of label ids, indexing the given lists of words and
+        labels."""
+        counts = get_word_label_count_matrix(token_ids, label_ids, len(words), len(labels))
+        return cls(counts, words=words, labels=labels)
+
+    def __add__(self, other):
+        return WordLabelCounts(self.counts + other.counts, words=self.words, labels=self.labels)
+
+    def __sub__(self, other):
+        return WordLabelCounts(self.counts - other.counts, words=self.words, labels=self.labels)
+
+    def encode_words(self, tokens):
+        """Given a sequence of tokens, return array of word ids (-1 if not
+        in vocab)."""
+        return np.asarray([self.word_to_id.get(w, -1) for w in tokens], dtype=np.int64)
+
+    def encode_labels(self, labels):
+        """Given a sequence of labels, return array of label ids (-1 if
+        not in label list)."""
+        return np.asarray([self.label_to_id.get(l, -1) for l in labels], dtype=np.int64)
+
+    def totals(self):
+        """Array containing the frequency of each word."""
+        return self.counts.sum(1)
+
+    def seen(self, word_ids=None):
+        """Return boolean mask over the given word ids (or over the whole
+        vocab) indicating which words were seen at least once."""
+        seen = self.totals() > 0
+        if word_ids is None:
+            return seen
+        return np.append(seen, False)[word_ids]
+
+    def argmax(self, word_ids=None):
+        """Return the id of the most frequent label of each of the given
+        word ids (or of each word in the vocab), -1 if the word was never
+        seen. Ties are broken in favour of the label with the lowest id.
+
+        """
+        argmax = np.where(self.seen(), self.counts.argmax(1) if self.counts.shape[1] else -1, -1)
+        if word_ids is None:
+            return argmax
+        return np.append(argmax, -1)[word_ids]
+
+    def diff(self, word_ids, label_ids, strict=False):
+        """Return boolean mask over test tokens indicating which tokens
+        have a label that was never seen with that word (strict version)
+        or was not its most frequent label (lax version), excluding
+        tokens whose word was not seen at all.
+
+        Args:
+        - word_ids: array of word ids of the test tokens
+        - label_ids: array of label ids of the test tokens
+        - strict: use strict mode
+
+        Returns:
+        - boolean mask
+
+        """
+        word_ids = np.asarray(word_ids, dtype=np.int64)
+        label_ids = np.asarray(label_ids, dtype=np.int64)
+        # Pad the count matrix with a row and column of zeros, so that
+        # ids of -1 get a count of 0
+        padded = np.zeros((self.counts.shape[0]+1, self.counts.shape[1]+1), dtype=self.counts.dtype)
+        padded[:-1,:-1] = self.counts
+        label_counts = padded[word_ids, label_ids]
+        seen = self.seen(word_ids)
+        if strict:
+            return seen & (label_counts == 0)
+        return seen & (label_counts < padded.max(1)[word_ids])
+
+
+# Tokens of subset expressions (see eval_subset_expression)
+_SUBSET_EXPR_TOKEN = re.compile(r"\s*(?:(etype)\s*(==|!=)\s*([^\s&|~()]+)|([&|~()])|([^\s&|~()=!]+))")
+
+
+def _tokenize_subset_expression(expr):
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        match = _SUBSET_EXPR_TOKEN.match(expr, pos)
+        if not match:
+            msg = "Invalid subset expression '{}' (at position {})".format(expr, pos)
+            raise ValueError(msg)
+        etype, op, value, symbol, name = match.groups()
+        if etype:
+            tokens.append(("etype", (op, value)))
+        elif symbol:
+            tokens.append((symbol, None))
+        else:
+            tokens.append(("name", name))
+        pos = match.end()
+    return tokens
+
+
+def eval_subset_expression(expr, subsets, etypes):
+    """Evaluate an expression that combines subsets of test tokens
+    using the operators & (intersection), | (union), ~ (complement)
+    and parentheses, e.g. "unseen-I & etype==ORG". ~ binds tighter
+    than &, which binds tighter than |. The operands are the names of
+    subsets, or etype==X (resp. etype!=X), i.e. the tokens whose gold
+    entity type is (resp. is not) X.
 
     Args:
-    - train_tok: list of train tokens
-    - train_gold: list of train labels
-    - test_tok: list of test tokens
-    - test_gold: list of test labels
-    - strict: use strict mode
+    - expr: expression
+    - subsets: dict that maps subset names to boolean masks over the test tokens
+    - etypes: array of gold entity types of the test tokens (empty
+      string if the token is not part of a mention)
 
     Returns:
-    - list of indices 
+    - boolean mask over the test tokens
+
+    """
+    tokens = _tokenize_subset_expression(expr)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]][0] if pos[0] < len(tokens) else None
+
+    def parse_union():
+        mask = parse_intersection()
+        while peek() == "|":
+            pos[0] += 1
+            mask = mask | parse_intersection()
+        return mask
+
+    def parse_intersection():
+        mask = parse_operand()
+        while peek() == "&":
+            pos[0] += 1
+            mask = mask & parse_operand()
+        return mask
+
+    def parse_operand():
+        kind = peek()
+        if kind is None:
+            msg = "Invalid subset expression '{}' (unexpected end)".format(expr)
+            raise ValueError(msg)
+        value = tokens[pos[0]][1]
+        pos[0] += 1
+        if kind == "~":
+            return ~parse_operand()
+        if kind == "(":
+            mask = parse_union()
+            if peek() != ")":
+                msg = "Invalid subset expression '{}' (missing closing parenthesis)".format(expr)
+                raise ValueError(msg)
+            pos[0] += 1
+            return mask
+        if kind == "etype":
+            op, etype = value
+            return etypes == etype if op == "==" else etypes != etype
+        if kind == "name":
+            if value not in subsets:
+                msg = "Unknown subset '{}' in expression '{}'. Known subsets: {}".format(value, expr, ", ".join(subsets))
+                raise ValueError(msg)
+            return subsets[value]
+        msg = "Invalid subset expression '{}' (unexpected '{}')".format(expr, kind)
+        raise ValueError(msg)
+
+    mask = parse_union()
+    if pos[0] < len(tokens):
+        msg = "Invalid subset expression '{}' (unexpected '{}')".format(expr, tokens[pos[0]][0])
+        raise ValueError(msg)
+    return mask
+
+
+# Nb of rows that are rendered and written at once
+WRITE_CHUNK_SIZE = 65536
+
+# Extensions of the output files, given the compression method
+COMPRESSION_EXTENSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def open_output(path, compression=None):
+    """Open text file for writing, optionally compressed. The extension
+    of the compression method (see COMPRESSION_EXTENSIONS) is not added
+    to the path.
+
+    Args:
+    - path: path of file
+    - compression: None, "gzip", or "zstd" (requires the zstandard package)
+
+    Returns:
+    - file object
+
+    """
+    if compression is None:
+        return open(path, "w", encoding="utf-8")
+    if compression == "gzip":
+        return gzip.open(path, "wt", encoding="utf-8", compresslevel=6)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Please install zstandard (pip install zstandard) to use zstd compression.")
+        writer = zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+        return io.TextIOWrapper(writer, encoding="utf-8")
+    msg = "Unknown compression method '{}'".format(compression)
+    raise ValueError(msg)
+
+
+def write_table(table, path, header=None, delim="\t", compression=None):
+    """Given a table (iterable of rows, which are lists of strings) and an
+    optional header (list of column names), write table. Rows are
+    written in chunks of WRITE_CHUNK_SIZE rows, optionally compressed
+    (see open_output).
 
     """
-    max_label_count = {}
-    for word, label_fd in word_label_count.items():
-        max_label_count[word] = max(label_fd.values())
-    keep = []
-    for i,(word,label) in enumerate(zip(test_tok, test_gold)):
-        if word in word_label_count:
-            if label not in word_label_count[word]:
-                keep.append(i)
-            elif not strict and word_label_count[word][label] < max_label_count[word]:
-                keep.append(i)
-    return keep
-
-
-def write_table(table, path, header=None, delim="\t"):
-    """Given a table and an optional header (list of column names), write table. """
-    with open(path, "w") as f:
+    rows = iter(table)
+    with open_output(path, compression=compression) as f:
         if header:
             f.write(delim.join(header)+"\n")
-        for row in table:
-            f.write(delim.join(row)+"\n")
+        while True:
+            chunk = list(itertools.islice(rows, WRITE_CHUNK_SIZE))
+            if not chunk:
+                break
+            f.write("".join(delim.join(row)+"\n" for row in chunk))
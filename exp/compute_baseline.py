@@ -1,4 +1,5 @@
 import sys, argparse, os
+from collections import deque
 dir_data_utils = os.path.dirname(os.path.realpath(__file__))+"/../data_utils"
 sys.path.append(dir_data_utils)
 from data_utils import get_mentions_from_BIO_file
@@ -9,9 +10,155 @@ white-space separated columns with the token in the first column and
 the label in the last column, and empty lines separating
 sentences. Label encoding is presumed to be BIO-2. """
 
+
+# Policies used to resolve overlaps between the mentions found in a
+# sentence (see resolve_overlaps)
+POLICIES = ["longest-first", "leftmost-longest", "highest-frequency"]
+
+
+class MentionMatcher(object):
+    """Token-level Aho-Corasick automaton built from a list of mentions
+    (tokens joined by spaces). It finds all the occurrences of all the
+    mentions in a sequence of tokens in one left-to-right scan, without
+    building any candidate strings.
+
+    """
+
+    def __init__(self, mentions):
+        # Transitions, failure links, depth (nb tokens), index of the
+        # mention that ends in the state (-1 if none), and the nearest
+        # state on the chain of failure links that ends a mention (-1
+        # if none) of each state. State 0 is the root.
+        self.goto = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.mention_id = [-1]
+        self.out = [-1]
+        for mention_id, mention in enumerate(mentions):
+            state = 0
+            for token in mention.split(" "):
+                next_state = self.goto[state].get(token)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][token] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[state] + 1)
+                    self.mention_id.append(-1)
+                    self.out.append(-1)
+                state = next_state
+            self.mention_id[state] = mention_id
+
+        # Compute failure links breadth-first
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, child in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and token not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(token, 0)
+                self.fail[child] = fail
+                self.out[child] = fail if self.mention_id[fail] >= 0 else self.out[fail]
+                queue.append(child)
+
+    def find_all(self, tokens):
+        """Given a sequence of tokens, return list of (start, mention
+        size, mention index) tuples for all the occurrences of the
+        mentions, including overlapping ones, ordered by end offset."""
+        goto = self.goto
+        fail = self.fail
+        matches = []
+        state = 0
+        for i, token in enumerate(tokens):
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            match = state if self.mention_id[state] >= 0 else self.out[state]
+            while match > 0:
+                size = self.depth[match]
+                matches.append((i-size+1, size, self.mention_id[match]))
+                match = self.out[match]
+        return matches
+
+
+def resolve_overlaps(matches, nb_tokens, policy="longest-first", freqs=None):
+    """Select non-overlapping mentions among the matches found in a
+    sentence.
+
+    Policies:
+    - longest-first: repeatedly select the longest match that does not
+      overlap the matches already selected (the leftmost one among
+      matches of the same size)
+    - leftmost-longest: scan the sentence from left to right, select the
+      longest match that starts at the current token, and continue
+      after it
+    - highest-frequency: same as longest-first, but matches are ranked
+      by frequency in the training data first
+
+    Args:
+    - matches: list of (start, mention size, mention index) tuples,
+      ordered by end offset (see MentionMatcher.find_all)
+    - nb_tokens: nb tokens in the sentence
+    - policy: one of POLICIES
+    - freqs: list containing the frequency of each mention (required
+      by highest-frequency)
+
+    Returns:
+    - list of selected matches, ordered by start offset
+
+    """
+    selected = []
+    if not len(matches):
+        return selected
+    covered = bytearray(nb_tokens)
+    if policy == "longest-first":
+        # Bucket the matches by size (within a bucket, they are ordered
+        # by start offset). A match can only overlap a selected match at
+        # least as long if the latter covers one of its ends.
+        buckets = [[] for _ in range(max(size for (_, size, _) in matches)+1)]
+        for match in matches:
+            buckets[match[1]].append(match)
+        for bucket in reversed(buckets):
+            for match in bucket:
+                start, size, _ = match
+                if not covered[start] and not covered[start+size-1]:
+                    selected.append(match)
+                    covered[start:start+size] = b"\x01" * size
+        selected.sort()
+    elif policy == "leftmost-longest":
+        longest = [None] * nb_tokens
+        for match in matches:
+            start = match[0]
+            if longest[start] is None or match[1] > longest[start][1]:
+                longest[start] = match
+        i = 0
+        while i < nb_tokens:
+            match = longest[i]
+            if match is None:
+                i += 1
+            else:
+                selected.append(match)
+                i += match[1]
+    elif policy == "highest-frequency":
+        for match in sorted(matches, key=lambda x:(-freqs[x[2]], -x[1], x[0])):
+            start, size, _ = match
+            if covered.find(1, start, start+size) < 0:
+                selected.append(match)
+                covered[start:start+size] = b"\x01" * size
+        selected.sort()
+    else:
+        msg = "Unknown policy '{}'".format(policy)
+        raise ValueError(msg)
+    return selected
+
+
 parser = argparse.ArgumentParser(description=doc)
 parser.add_argument("-x", "--exclude_ambiguous", action="store_true",
                     help="Keep only non-ambiguous entity mentions.")
+parser.add_argument("-p", "--policy", choices=POLICIES, default="longest-first",
+                    help=("How overlaps between mentions found in a sentence are resolved "
+                          "(default: longest-first)."))
 parser.add_argument("-v", "--verbose", action="store_true")
 msg = ("Path of training set (text file in white-space separated "
        "columns with the token in the first column and the label "
@@ -71,6 +218,10 @@ if args.exclude_ambiguous and args.verbose:
 max_mention_size = max(len(mention.split()) for mention in mention2etype.keys())
 if args.verbose:
     print("Max mention size: {}".format(max_mention_size))
+mentions = list(mention2etype)
+etypes = [mention2etype[mention] for mention in mentions]
+freqs = [sum(mention_type_freq_dist[mention].values()) for mention in mentions]
+matcher = MentionMatcher(mentions)
 
 
 # Extract sentences from test set.
@@ -95,45 +246,21 @@ with open(args.output, "w") as f:
         # Extract tokens
         tokens = [line.split()[0] for line in sent]
 
-        # Find all mentions
-        mentions = []
-        for mention_size in range(1,max_mention_size+1):
-            for start in range(len(sent)-mention_size):
-                candidate = " ".join(tokens[start:start+mention_size])
-                if candidate in mention2etype:
-                    mentions.append((start, mention_size, mention2etype[candidate]))
-
-        # Eliminate overlap between mentions, keeping the longest mentions
-        sorted_mentions = sorted(mentions, key=lambda x:x[1], reverse=True)
-        marked_indices = set()
-        mentions = []
-        for (start, mention_size, etype) in sorted_mentions:
-            overlap = False
-            for index in range(start, start+mention_size):
-                if index in marked_indices:
-                    overlap = True
-                    break
-            if not overlap:
-                mentions.append((start, mention_size, etype))
-                for index in range(start, start+mention_size):
-                    marked_indices.add(index)
+        # Find all mentions, then eliminate overlap between mentions
+        matches = matcher.find_all(tokens)
+        matches = resolve_overlaps(matches, len(tokens), policy=args.policy, freqs=freqs)
 
         # Make labels
         labels = ["O" for _ in range(len(sent))]
-        for (start, mention_size, etype) in mentions:
+        for (start, mention_size, mention_id) in matches:
+            etype = etypes[mention_id]
             labels[start] = "B-" + etype
             for index in range(start+1, start+mention_size):
                 labels[index] = "I-" + etype
         
-        # Write sentence with extra column containing predictions
-        for index in range(len(sent)):
-            line = sent[index]
-            prediction = labels[index]
-            elems = line.split()
-            elems.append(prediction)
-            f.write(" ".join(elems) + "\n")
-        # Write empty line
-        f.write("\n")
+        # Write sentence with extra column containing predictions,
+        # followed by an empty line
+        f.write("".join(" ".join(line.split() + [prediction]) + "\n" for (line, prediction) in zip(sent, labels)) + "\n")
 if args.verbose:
     print("Baseline predictions written -> {}\n".format(args.output))
 
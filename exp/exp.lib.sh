@@ -257,12 +257,15 @@ prepareData() {
     prepareTestSet $1
 }
 
-# Make temporary directory $scratch.
+# Make temporary directory $scratch. Parsed datasets are cached in a
+# sub-directory of $scratch (see data_utils/corpus.py), so that the
+# python scripts called on the same file do not parse it again.
 # Input:
 # $1 - system name
 # $2 - path of directory in which we create $scratch
 mkdirScratch() {
     scratch=$(mktemp -d -p $2 -t "NER-exp-$1-XXXXXXXXXX")
+    export NER_EVAL_CACHE_DIR=$scratch/corpus_cache
 }
 
 # Set traps for execution. 
@@ -27,11 +27,11 @@ import glob
 import logging
 import os
 import random
+import sys
 from io import open
 
 import numpy as np
 import torch
-from seqeval.metrics import precision_score, recall_score, f1_score
 from tensorboardX import SummaryWriter
 from torch.nn import CrossEntropyLoss
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
@@ -41,6 +41,10 @@ from tqdm import tqdm, trange
 from transformers import AdamW, WarmupLinearSchedule
 from transformers import WEIGHTS_NAME, BertConfig, BertForTokenClassification, BertTokenizer
 
+dir_eval = os.path.dirname(os.path.realpath(__file__))+"/../eval"
+sys.path.append(dir_eval)
+from eval_utils import SpanCounts
+
 logger = logging.getLogger(__name__)
 
 class InputExample(object):
@@ -433,11 +437,16 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
                 out_label_list[i].append(label_map[out_label_ids[i][j]])
                 preds_list[i].append(label_map[preds[i][j]])
 
+    # Score the mentions (as chunks defined by conlleval, like seqeval)
+    span_counts = SpanCounts(scheme="conlleval")
+    for gold_labels, pred_labels in zip(out_label_list, preds_list):
+        span_counts.update(gold_labels, pred_labels)
+    scores = span_counts.finalize()
     results = {
         "loss": eval_loss,
-        "precision": precision_score(out_label_list, preds_list),
-        "recall": recall_score(out_label_list, preds_list),
-        "f1": f1_score(out_label_list, preds_list)
+        "precision": scores["precision"],
+        "recall": scores["recall"],
+        "f1": scores["f1"]
     }
 
     logger.info("***** Eval results %s *****", prefix)
@@ -37,7 +37,7 @@ for data_name in $test_dnames; do
     echo "Evaluating predictions..."
     path_res=$dir_results/$data_name.conlleval.txt
     path_err=$dir_results/$data_name.error-analysis.txt
-    $dir_ner_eval/eval/conlleval -d "\t" < $path_pred > $path_res
+    python $dir_ner_eval/eval/conlleval.py -d "\t" -j $dir_results/$data_name.conlleval.json < $path_pred > $path_res
     python $dir_ner_eval/eval/error_analysis.py -e BIO-2 $path_pred > $path_err
     echo "Test on $data_name completed."
 done